@@ -1,135 +1,374 @@
 import os
-import json
-import psycopg2
-import psycopg2.extras
+import time
+import passwords
+import translations
+from cache import TTLCache
 from database import db_handler
+from metrics import COUNT_BUCKETS, METRICS_DIR, METRICS_ENABLED, Registry, password_hash_metrics, throttle_metrics
+from query_trace import QUERY_TRACING, query_tracer
+from throttle import login_throttle, register_throttle
 from datetime import datetime, timedelta
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, g
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, session, jsonify, g, has_request_context
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev_key_123')
 
+# Сколько обратных прокси стоит перед приложением. Адрес клиента (ключ ограничения попыток входа)
+# берётся из X-Forwarded-For только на эту глубину; 0 - заголовкам не доверяем
+PROXY_HOPS = int(os.environ.get('PROXY_HOPS', '0'))
+if PROXY_HOPS > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS, x_proto=PROXY_HOPS, x_host=PROXY_HOPS)
+
 login_manager = LoginManager()
 login_manager.login_view = 'login'
 login_manager.init_app(app)
 
-def get_db():
-    if 'db' not in g:
-        g.db = db_handler.get_connection()
-    return g.db
+def connection_for(handler):
+    # Одно соединение на базу за запрос; при шардировании их может быть несколько
+    if 'dbs' not in g:
+        g.dbs = {}
+    if handler not in g.dbs:
+        g.dbs[handler] = handler.get_connection()
+    return g.dbs[handler]
+
+def get_db(user_id=None):
+    """Соединение запроса; при шардировании - с шардом user_id (по умолчанию текущего пользователя)."""
+    if not db_handler.shards:
+        return connection_for(db_handler)
+    if user_id is None and current_user.is_authenticated:
+        user_id = current_user.id
+    return connection_for(db_handler.for_user(user_id))
+
+def get_read_db():
+    # Чтения без записи в том же запросе можно отдать реплике
+    if not db_handler.replicas:
+        return get_db()
+    if 'read_db' not in g:
+        pinned = session.get('primary_until', 0) > time.time()
+        user_id = current_user.id if current_user.is_authenticated else None
+        g.read_db = db_handler.get_read_connection(user_id, pinned=pinned)
+    return g.read_db
 
 @app.teardown_appcontext
 def close_db(error):
-    db = g.pop('db', None)
+    for db in g.pop('dbs', {}).values():
+        db_handler.close(db)
+    db = g.pop('read_db', None)
     if db is not None:
-        db_handler.close(db) 
+        db_handler.close(db)
 
 def init_db():
     db = get_db()
     db_handler.init_db(db)
 
+def fetch_all(db, query, params, prepare=False):
+    # prepare=True - для запросов, которые повторяются в цикле на одном соединении
+    cur = db_handler.execute(db, query, params, prepare=prepare)
+    rows = cur.fetchall()
+    cur.close()
+    return rows
+
+def write_db(fn, *args, user_id=None):
+    if user_id is None and current_user.is_authenticated:
+        user_id = current_user.id
+    if db_handler.replicas and user_id is not None:
+        # Сессия общая для всех воркеров gunicorn, в отличие от закрепления внутри процесса
+        session['primary_until'] = time.time() + db_handler.primary_pins.ttl
+    # С очередью записи пишет поток-писатель, соединение запроса не нужно
+    if db_handler.write_queue_enabled:
+        return db_handler.write(fn, *args, for_user=user_id)
+    if db_handler.shards and user_id is not None:
+        # Шард для записи: дожидается конца переноса, а не берёт старый шард, как get_db
+        shard = db_handler.for_user(user_id, for_write=True)
+        return shard.write(fn, *args, conn=connection_for(shard), for_user=user_id)
+    return db_handler.write(fn, *args, conn=get_db(user_id), for_user=user_id)
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# С METRICS_DIR /metrics любого воркера отдаёт сумму по всем воркерам gunicorn/uvicorn
+metrics_registry = Registry(directory=METRICS_DIR or None)
+request_latency = metrics_registry.histogram(
+    'http_request_duration_seconds', 'Request latency by endpoint', ('endpoint', 'method'))
+requests_total = metrics_registry.counter(
+    'http_requests_total', 'Requests by endpoint and status code', ('endpoint', 'method', 'status'))
+request_db_queries = metrics_registry.histogram(
+    'http_request_db_queries', 'Database queries per request', ('endpoint',), buckets=COUNT_BUCKETS)
+request_db_seconds = metrics_registry.histogram(
+    'http_request_db_seconds', 'Database time per request', ('endpoint',))
+metrics_registry.add_collector(password_hash_metrics(passwords.hasher))
+metrics_registry.add_collector(throttle_metrics(login_throttle, register_throttle))
+
+def count_request_query(query, params, seconds):
+    if has_request_context() and 'request_started' in g:
+        g.db_queries += 1
+        g.db_seconds += seconds
+
+def start_request_timer():
+    metrics_registry.ensure_flusher()
+    g.request_started = time.perf_counter()
+    g.db_queries = 0
+    g.db_seconds = 0.0
+
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+    endpoint = request.endpoint or 'unmatched'
+    request_latency.observe(endpoint, request.method, value=time.perf_counter() - started)
+    requests_total.inc(endpoint, request.method, str(response.status_code))
+    request_db_queries.observe(endpoint, value=g.db_queries)
+    request_db_seconds.observe(endpoint, value=g.db_seconds)
+    return response
+
+def metrics_endpoint():
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return Response('Forbidden\n', status=403, mimetype='text/plain')
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
+def begin_query_unit():
+    g.query_unit = query_tracer.begin(f"web:{request.endpoint or 'unmatched'}")
+
+def end_query_unit(error):
+    token = g.pop('query_unit', None)
+    if token is not None:
+        query_tracer.end(token)
+
+if QUERY_TRACING:
+    query_tracer.install(db_handler)
+    app.before_request(begin_query_unit)
+    app.teardown_request(end_query_unit)
+
+# Когда метрики выключены, хуки не регистрируются вовсе
+if METRICS_ENABLED:
+    db_handler.add_query_listener(count_request_query)
+    app.before_request(start_request_timer)
+    app.after_request(record_request_metrics)
+    app.add_url_rule('/metrics', 'metrics', metrics_endpoint)
+
 class User(UserMixin):
-    def __init__(self, id, username, password_hash):
+    def __init__(self, id, username, password_hash=None):
         self.id = id
         self.username = username
         self.password_hash = password_hash
 
-@login_manager.user_loader
-def load_user(user_id):
-    db = get_db()
-    try:
-        cur = db.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cur.execute('SELECT * FROM users WHERE id = %s', (user_id,))
-        user = cur.fetchone()
-        cur.close()
-        if user:
-            return User(user['id'], user['username'], user['password_hash'])
-    except Exception:
-        pass
-    return None
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', '1024'))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', '300'))
+SESSION_IDENTITY = os.environ.get('SESSION_IDENTITY', '0') == '1'
+SESSION_IDENTITY_TTL = float(os.environ.get('SESSION_IDENTITY_TTL', '900'))
+# Сколько секунд процесс верит своей копии времени отзыва из session_revocations
+SESSION_REVOCATION_TTL = float(os.environ.get('SESSION_REVOCATION_TTL', '5'))
+
+# Кэш хранит только идентичность (id, username), без хеша пароля
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+# Время отзыва по user_id (0 - отзывов не было): источник истины - таблица session_revocations.
+# Сессионные идентичности, выданные не позже него, перепроверяются в БД
+revoked_identities = TTLCache(maxsize=USER_CACHE_SIZE, ttl=SESSION_REVOCATION_TTL)
+
+def remember_identity(user):
+    user_cache.set(str(user.id), User(user.id, user.username))
+    if SESSION_IDENTITY:
+        session['identity'] = [user.id, user.username, time.time()]
+
+def _revoke_identities(db, user_id, revoked_at):
+    db_handler.execute(db, '''
+        INSERT INTO session_revocations (user_id, revoked_at) VALUES (%s, %s)
+        ON CONFLICT (user_id) DO UPDATE SET revoked_at = excluded.revoked_at
+    ''', (user_id, revoked_at)).close()
+
+def invalidate_user(user_id):
+    key = str(user_id)
+    revoked_at = time.time()
+    write_db(_revoke_identities, int(user_id), revoked_at, user_id=int(user_id))
+    user_cache.pop(key)
+    revoked_identities.set(key, revoked_at)
+
+def identities_revoked_at(db, user_pk):
+    cursor = db_handler.execute(db, 'SELECT revoked_at FROM session_revocations WHERE user_id = %s', (user_pk,))
+    row = db_handler.fetchone(cursor)
+    cursor.close()
+    return row['revoked_at'] if row else 0
+
+def user_from_session(user_id, stored=None, connect=None):
+    # stored - уже разобранная сессия, когда запрос обслуживается вне Flask (asgi.py);
+    # connect(user_pk) - соединение для проверки отзыва, если его нет в кэше процесса
+    identity = (session if stored is None else stored).get('identity')
+    if not identity or str(identity[0]) != user_id:
+        return None
+    issued_at = identity[2]
+    if time.time() - issued_at > SESSION_IDENTITY_TTL:
+        return None
+    revoked_at = revoked_identities.get(user_id)
+    if revoked_at is None:
+        revoked_at = identities_revoked_at((connect or get_db)(identity[0]), identity[0])
+        revoked_identities.set(user_id, revoked_at)
+    if revoked_at >= issued_at:
+        return None
+    return User(identity[0], identity[1])
+
+def _update_password_hash(db, user_id, password_hash):
+    cursor = db_handler.execute(db, 'UPDATE users SET password_hash = %s WHERE id = %s', (password_hash, user_id))
+    cursor.close()
+
+def update_password_hash(user_id, password_hash):
+    write_db(_update_password_hash, user_id, password_hash, user_id=user_id)
+    invalidate_user(user_id)
+
+def _find_user(db, user_pk):
+    cursor = db_handler.execute(db, 'SELECT id, username FROM users WHERE id = %s', (user_pk,))
+    row = db_handler.fetchone(cursor)
+    cursor.close()
+    return row
+
+def resolve_user(user_id, stored, connect, remember=None):
+    """Пользователь сессии или None - общий путь Flask-Login и asgi.py.
+
+    Кэш процесса, затем идентичность из подписанной сессии, затем БД. connect(user_pk) даёт
+    соединение с базой пользователя; ошибки БД не глотаются и становятся ответом 500.
+    remember(user) вызывается для пользователя, прочитанного из БД.
+    """
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+
+    if SESSION_IDENTITY:
+        user = user_from_session(user_id, stored, connect)
+        if user is not None:
+            user_cache.set(user_id, user)
+            return user
 
-def load_translations():
     try:
-        with open('translation.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {}
+        user_pk = int(user_id)
+    except (TypeError, ValueError):
+        return None
 
-TRANSLATIONS = load_translations()
+    row = _find_user(connect(user_pk), user_pk)
+    if not row:
+        return None
+    user = User(row['id'], row['username'])
+    user_cache.set(user_id, user)
+    if remember is not None:
+        remember(user)
+    return user
+
+@login_manager.user_loader
+def load_user(user_id):
+    return resolve_user(user_id, session, get_db, remember=remember_identity)
 
 @app.context_processor
 def inject_conf_var():
+    translations.maybe_reload()
     lang = session.get('lang', 'ru')
     theme = session.get('theme', 'dark')
     return dict(
         lang=lang,
         theme=theme,
-        t=lambda key: TRANSLATIONS.get(lang, {}).get(key, key),
-        translations=TRANSLATIONS.get(lang, {})
+        t=translations.translator(lang),
+        translations=translations.get_table(lang),
+        i18n_bundle=translations.js_bundle(lang)
     )
 
-@app.route('/api/tasks', methods=['GET'])
-@login_required
-def api_get_tasks():
-    db = get_db()
-    cur = db.cursor(cursor_factory=psycopg2.extras.DictCursor)
+# Наибольшая страница /api/tasks?limit=...; без limit список отдаётся целиком, как раньше
+TASKS_PAGE_MAX = int(os.environ.get('TASKS_PAGE_MAX', '200'))
+
+def task_page(args):
+    """(limit, before) из параметров запроса: limit None - все задачи, before - id последней загруженной задачи."""
+    try:
+        limit = int(args['limit']) if 'limit' in args else None
+        before = int(args['before']) if 'before' in args else None
+    except ValueError:
+        return None, None
+    if limit is not None:
+        limit = min(max(limit, 1), TASKS_PAGE_MAX)
+    return limit, before
+
+def task_with_subtasks(db, task_row, prepare=False):
+    subtasks_rows = fetch_all(db, '''
+        SELECT * FROM tasks 
+        WHERE parent_id = %s 
+        ORDER BY id ASC
+    ''', (task_row['id'],), prepare=prepare)
+    
+    subtasks = [dict(row) for row in subtasks_rows]
+    
+    task_status = task_row['status']
+    if subtasks:
+        done_subtasks = sum(1 for st in subtasks if st['status'] == 'done')
+        if done_subtasks == 0:
+            task_status = 'not_started'
+        elif done_subtasks == len(subtasks):
+            task_status = 'done'
+        else:
+            task_status = 'in_progress'
     
-    cur.execute('''
+    task_dict = dict(task_row)
+    task_dict['subtasks'] = subtasks
+    task_dict['computed_status'] = task_status
+    return task_dict
+
+def load_tasks(db, user_id, limit=None, before=None):
+    """Задачи верхнего уровня с подзадачами и вычисленным статусом - тело ответа /api/tasks.
+
+    before - id задачи-курсора: отдаются задачи, идущие в списке после неё.
+    None, если курсора больше нет (задачу удалили).
+    """
+    query = '''
         SELECT * FROM tasks 
         WHERE user_id = %s AND parent_id IS NULL 
-        ORDER BY created_at DESC
-    ''', (current_user.id,))
-    tasks_rows = cur.fetchall()
-    
-    tasks = []
-    for task_row in tasks_rows:
-        cur.execute('''
-            SELECT * FROM tasks 
-            WHERE parent_id = %s 
-            ORDER BY id ASC
-        ''', (task_row['id'],))
-        subtasks_rows = cur.fetchall()
-        
-        subtasks = [dict(row) for row in subtasks_rows]
-        
-        task_status = task_row['status']
-        if subtasks:
-            done_subtasks = sum(1 for st in subtasks if st['status'] == 'done')
-            if done_subtasks == 0:
-                task_status = 'not_started'
-            elif done_subtasks == len(subtasks):
-                task_status = 'done'
-            else:
-                task_status = 'in_progress'
-        
-        task_dict = dict(task_row)
-        task_dict['subtasks'] = subtasks
-        task_dict['computed_status'] = task_status
-        tasks.append(task_dict)
-    
-    cur.close()
+    '''
+    params = (user_id,)
+    if before is not None:
+        # Позиция (created_at, id), а не номер строки: удаление и архивация задач не сдвигают страницы.
+        # Архивированный курсор по-прежнему задаёт позицию через tasks_history
+        anchor = fetch_all(db, 'SELECT created_at FROM tasks_history WHERE id = %s AND user_id = %s',
+                           (before, user_id))
+        if not anchor:
+            return None
+        query += ' AND (created_at < %s OR (created_at = %s AND id < %s))'
+        params += (anchor[0]['created_at'], anchor[0]['created_at'], before)
+    # id в сортировке делает порядок однозначным, иначе страницы могли бы пересекаться
+    query += ' ORDER BY created_at DESC, id DESC'
+    if limit is not None:
+        query += ' LIMIT %s'
+        params += (limit,)
+    tasks_rows = fetch_all(db, query, params)
+    return [task_with_subtasks(db, task_row, prepare=len(tasks_rows) > 1) for task_row in tasks_rows]
+
+def load_task(db, user_id, task_id):
+    """Одна задача верхнего уровня в том же виде, что в /api/tasks; None - у пользователя её нет."""
+    rows = fetch_all(db, 'SELECT * FROM tasks WHERE id = %s AND user_id = %s AND parent_id IS NULL',
+                     (task_id, user_id))
+    return task_with_subtasks(db, rows[0]) if rows else None
+
+@app.route('/api/tasks', methods=['GET'])
+@login_required
+def api_get_tasks():
+    tasks = load_tasks(get_read_db(), current_user.id, *task_page(request.args))
+    if tasks is None:
+        return jsonify({'error': 'Cursor task not found'}), 409
     return jsonify(tasks)
 
-@app.route('/api/stats/<period>', methods=['GET'])
+@app.route('/api/task/<int:id>', methods=['GET'])
 @login_required
-def api_get_stats(period):
-    db = get_db()
-    cur = db.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    
-    cur.execute('''
+def api_get_task(id):
+    task = load_task(get_read_db(), current_user.id, id)
+    if task is None:
+        return jsonify({'error': 'Task not found'}), 404
+    return jsonify(task)
+
+def load_stats(db, user_id, period):
+    """Статистика за период - тело ответа /api/stats/<period>."""
+    all_tasks = fetch_all(db, '''
         SELECT * FROM tasks WHERE user_id = %s AND parent_id IS NULL
-    ''', (current_user.id,))
-    all_tasks = cur.fetchall()
+    ''', (user_id,))
     
     not_started = 0
     in_progress = 0
     done = 0
     
     for task in all_tasks:
-        cur.execute('SELECT * FROM tasks WHERE parent_id = %s', (task['id'],))
-        subtasks = cur.fetchall()
+        subtasks = fetch_all(db, 'SELECT * FROM tasks WHERE parent_id = %s', (task['id'],), prepare=len(all_tasks) > 1)
         if subtasks:
             done_subs = sum(1 for st in subtasks if st['status'] == 'done')
             if done_subs == 0:
@@ -144,6 +383,12 @@ def api_get_stats(period):
             else:
                 not_started += 1
     
+    # Архивируются только полностью выполненные задачи
+    archived = fetch_all(db, '''
+        SELECT COUNT(*) as count FROM tasks_archive WHERE user_id = %s AND parent_id IS NULL
+    ''', (user_id,))[0]['count']
+    done += archived
+    
     now = datetime.now()
     
     if period == 'hour':
@@ -162,27 +407,25 @@ def api_get_stats(period):
         period_start = now - timedelta(days=365*3)
         group_by = "TO_CHAR(completed_at, 'YYYY')"
     
-    cur.execute(f'''
+    productivity_query = fetch_all(db, f'''
         SELECT {group_by} as period, COUNT(*) as count
-        FROM tasks
+        FROM tasks_history
         WHERE user_id = %s AND status = 'done' AND completed_at IS NOT NULL 
               AND parent_id IS NULL AND completed_at >= %s
         GROUP BY {group_by}
         ORDER BY period ASC
-    ''', (current_user.id, period_start.isoformat()))
-    productivity_query = cur.fetchall()
+    ''', (user_id, period_start.isoformat()))
     
     productivity = [{'period': row['period'], 'count': row['count']} for row in productivity_query]
     
-    cur.execute(f'''
+    top_periods_query = fetch_all(db, f'''
         SELECT {group_by} as period, COUNT(*) as count
-        FROM tasks
+        FROM tasks_history
         WHERE user_id = %s AND status = 'done' AND completed_at IS NOT NULL AND parent_id IS NULL
         GROUP BY {group_by}
         ORDER BY count DESC
         LIMIT 5
-    ''', (current_user.id,))
-    top_periods_query = cur.fetchall()
+    ''', (user_id,))
     
     top_periods = []
     for row in top_periods_query:
@@ -198,18 +441,16 @@ def api_get_stats(period):
             pass
         top_periods.append({'period': formatted, 'count': row['count']})
     
-    cur.execute('''
+    priority_stats = fetch_all(db, '''
         SELECT priority, COUNT(*) as count
-        FROM tasks
+        FROM tasks_history
         WHERE user_id = %s AND parent_id IS NULL
         GROUP BY priority
-    ''', (current_user.id,))
-    priority_stats = cur.fetchall()
+    ''', (user_id,))
     
     priorities = {row['priority']: row['count'] for row in priority_stats}
-    cur.close()
     
-    return jsonify({
+    return {
         'status': {
             'not_started': not_started,
             'in_progress': in_progress,
@@ -218,94 +459,89 @@ def api_get_stats(period):
         'productivity': productivity,
         'top_periods': top_periods,
         'priorities': priorities,
-        'total': len(all_tasks)
-    })
+        'total': len(all_tasks) + archived
+    }
 
-@app.route('/api/task', methods=['POST'])
+@app.route('/api/stats/<period>', methods=['GET'])
 @login_required
-def api_add_task():
-    db = get_db()
-    data = request.json
-    cur = db.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    
-    cur.execute('''
-        INSERT INTO tasks (title, description, priority, user_id, deadline, status)
-        VALUES (%s, %s, %s, %s, %s, 'not_started')
-        RETURNING id
-    ''', (data.get('title'), data.get('description'), data.get('priority', 'medium'), 
-          current_user.id, data.get('deadline')))
-    
-    task_id = cur.fetchone()['id']
+def api_get_stats(period):
+    return jsonify(load_stats(get_read_db(), current_user.id, period))
+
+def _api_add_task(db, user_id, data):
+    task_id = db_handler.insert_task(db, title=data.get('title'), description=data.get('description'),
+                                     priority=data.get('priority', 'medium'), user_id=user_id,
+                                     deadline=data.get('deadline'), status='not_started')
     
     if data.get('subtasks'):
         for subtask in data['subtasks']:
             if subtask.strip():
-                cur.execute('''
-                    INSERT INTO tasks (title, user_id, parent_id, status)
-                    VALUES (%s, %s, %s, 'not_started')
-                ''', (subtask, current_user.id, task_id))
+                db_handler.insert_task(db, title=subtask, user_id=user_id, parent_id=task_id, status='not_started')
     
-    db.commit()
-    cur.close()
-    return jsonify({'success': True, 'id': task_id})
+    db_handler.touch_tasks(db, user_id)
+    return task_id
 
-@app.route('/api/task/<int:id>', methods=['PUT'])
+@app.route('/api/task', methods=['POST'])
 @login_required
-def api_update_task(id):
-    db = get_db()
-    cur = db.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    
-    cur.execute('SELECT * FROM tasks WHERE id = %s', (id,))
+def api_add_task():
+    task_id = write_db(_api_add_task, current_user.id, request.json)
+    return jsonify({'success': True, 'id': task_id})
+
+def _api_update_task(db, task_id, user_id, action):
+    cur = db_handler.execute(db, 'SELECT * FROM tasks WHERE id = %s', (task_id,))
     task = cur.fetchone()
+    cur.close()
     
-    if not task or task['user_id'] != current_user.id:
-        cur.close()
-        return jsonify({'error': 'Access denied'}), 403
-    
-    data = request.json
-    action = data.get('action')
+    if not task or task['user_id'] != user_id:
+        return False
     
     if action == 'toggle':
-        cur.execute('SELECT * FROM tasks WHERE parent_id = %s', (id,))
+        cur = db_handler.execute(db, 'SELECT * FROM tasks WHERE parent_id = %s', (task_id,))
         subtasks = cur.fetchall()
+        cur.close()
         
         new_status = 'not_started' if task['status'] == 'done' else 'done'
         completed_at = datetime.utcnow().isoformat() if new_status == 'done' else None
         
-        cur.execute('UPDATE tasks SET status = %s, completed_at = %s WHERE id = %s', 
-                   (new_status, completed_at, id))
+        db_handler.execute(db, 'UPDATE tasks SET status = %s, completed_at = %s WHERE id = %s', 
+                           (new_status, completed_at, task_id)).close()
         
         if subtasks:
             for subtask in subtasks:
-                cur.execute('UPDATE tasks SET status = %s, completed_at = %s WHERE id = %s', 
-                           (new_status, completed_at, subtask['id']))
+                db_handler.execute(db, 'UPDATE tasks SET status = %s, completed_at = %s WHERE id = %s', 
+                                   (new_status, completed_at, subtask['id']), prepare=len(subtasks) > 1).close()
     
     elif action == 'toggle_subtask':
         new_status = 'not_started' if task['status'] == 'done' else 'done'
         completed_at = datetime.utcnow().isoformat() if new_status == 'done' else None
-        cur.execute('UPDATE tasks SET status = %s, completed_at = %s WHERE id = %s', 
-                   (new_status, completed_at, id))
+        db_handler.execute(db, 'UPDATE tasks SET status = %s, completed_at = %s WHERE id = %s', 
+                           (new_status, completed_at, task_id)).close()
     
-    db.commit()
-    cur.close()
+    db_handler.touch_tasks(db, user_id)
+    return True
+
+@app.route('/api/task/<int:id>', methods=['PUT'])
+@login_required
+def api_update_task(id):
+    if not write_db(_api_update_task, id, current_user.id, request.json.get('action')):
+        return jsonify({'error': 'Access denied'}), 403
     return jsonify({'success': True})
 
+def _api_delete_task(db, task_id, user_id):
+    cur = db_handler.execute(db, 'SELECT * FROM tasks WHERE id = %s', (task_id,))
+    task = cur.fetchone()
+    cur.close()
+    
+    if task and task['user_id'] == user_id:
+        db_handler.execute(db, 'DELETE FROM tasks WHERE id = %s OR parent_id = %s', (task_id, task_id)).close()
+        db_handler.touch_tasks(db, user_id)
+        return True
+    return False
+
 @app.route('/api/task/<int:id>', methods=['DELETE'])
 @login_required
 def api_delete_task(id):
-    db = get_db()
-    cur = db.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    
-    cur.execute('SELECT * FROM tasks WHERE id = %s', (id,))
-    task = cur.fetchone()
-    
-    if task and task['user_id'] == current_user.id:
-        cur.execute('DELETE FROM tasks WHERE id = %s OR parent_id = %s', (id, id))
-        db.commit()
-        cur.close()
+    if write_db(_api_delete_task, id, current_user.id):
         return jsonify({'success': True})
-    
-    cur.close()
     return jsonify({'error': 'Access denied'}), 403
 
 @app.route('/set_lang/<language>')
@@ -331,60 +567,89 @@ def login():
         return redirect(url_for('index'))
     
     if request.method == 'POST':
-        db = get_db()
         username = request.form.get('username')
         password = request.form.get('password')
         
-        cur = db.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cur.execute('SELECT * FROM users WHERE username = %s', (username,))
-        user_row = cur.fetchone()
-        cur.close()
+        if not login_throttle.allow(username, request.remote_addr):
+            flash('error_too_many_attempts')
+            return render_template('login.html'), 429
+        
+        # При шардировании справочник подсказывает, на каком шарде искать пользователя
+        handler = db_handler.for_username(username)
+        user_row = None
+        if handler is not None:
+            cur = handler.execute(connection_for(handler), 'SELECT * FROM users WHERE username = %s', (username,))
+            user_row = handler.fetchone(cur)
+            cur.close()
         
-        if user_row and check_password_hash(user_row['password_hash'], password):
-            user = User(user_row['id'], user_row['username'], user_row['password_hash'])
+        ok = False
+        if user_row:
+            ok, new_hash = passwords.verify_password(user_row['password_hash'], password)
+        
+        if ok:
+            if new_hash:
+                update_password_hash(user_row['id'], new_hash)
+            user = User(user_row['id'], user_row['username'])
             login_user(user)
+            remember_identity(user)
             return redirect(url_for('index'))
         else:
             flash('error_login_invalid')
     
     return render_template('login.html')
 
+def _register_user(db, user_id, username, password_hash):
+    if user_id is not None:
+        # С шардированием id выдаёт справочник пользователей
+        db_handler.execute(db, 'INSERT INTO users (id, username, password_hash) VALUES (%s, %s, %s)',
+                           (user_id, username, password_hash)).close()
+        return user_id
+    cur = db_handler.execute(db, '''
+        INSERT INTO users (username, password_hash) 
+        VALUES (%s, %s)
+        RETURNING id
+    ''', (username, password_hash))
+    user_id = cur.fetchone()['id']
+    cur.close()
+    return user_id
+
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if current_user.is_authenticated:
         return redirect(url_for('index'))
     
     if request.method == 'POST':
-        db = get_db()
         username = request.form.get('username')
         password = request.form.get('password')
         
+        if not register_throttle.allow(username, request.remote_addr):
+            flash('error_too_many_attempts')
+            return render_template('register.html'), 429
+        
         if len(password) < 8:
             flash('error_pass_short')
             return redirect(url_for('register'))
         
-        cur = db.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cur.execute('SELECT * FROM users WHERE username = %s', (username,))
-        existing = cur.fetchone()
+        if db_handler.shards:
+            existing = db_handler.for_username(username) is not None
+        else:
+            cur = db_handler.execute(get_db(), 'SELECT id FROM users WHERE username = %s', (username,))
+            existing = db_handler.fetchone(cur)
+            cur.close()
         
         if existing:
-            cur.close()
             flash('error_user_exists')
             return redirect(url_for('register'))
         
-        hashed_pw = generate_password_hash(password)
-        cur.execute('''
-            INSERT INTO users (username, password_hash) 
-            VALUES (%s, %s)
-            RETURNING id
-        ''', (username, hashed_pw))
-        
-        user_id = cur.fetchone()['id']
-        db.commit()
-        cur.close()
+        hashed_pw = passwords.hash_password(password)
+        if db_handler.shards:
+            user_id = db_handler.create_user(_register_user, username, hashed_pw)
+        else:
+            user_id = write_db(_register_user, None, username, hashed_pw)
         
-        user = User(user_id, username, hashed_pw)
+        user = User(user_id, username)
         login_user(user)
+        remember_identity(user)
         return redirect(url_for('index'))
     
     return render_template('register.html')
@@ -392,6 +657,8 @@ def register():
 @app.route('/logout')
 @login_required
 def logout():
+    invalidate_user(current_user.id)
+    session.pop('identity', None)
     logout_user()
     return redirect(url_for('login'))
 
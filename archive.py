@@ -0,0 +1,94 @@
+import argparse
+import os
+import time
+from datetime import datetime, timedelta
+
+from database import TASK_COLUMNS, db_handler
+
+# Выполненные задачи старше N дней уходят в tasks_archive (0 - архивация выключена)
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '0'))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', '500'))
+# Пауза между пачками, чтобы не держать блокировку записи подряд
+ARCHIVE_BATCH_PAUSE_MS = float(os.environ.get('ARCHIVE_BATCH_PAUSE_MS', '50'))
+ARCHIVE_INTERVAL = float(os.environ.get('ARCHIVE_INTERVAL', '3600'))
+
+
+def _cutoff(handler, days, now=None):
+    cutoff = (now or datetime.utcnow()) - timedelta(days=days)
+    return cutoff if handler.use_postgresql else cutoff.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _archive_batch(db, handler, cutoff, batch_size):
+    # Задача архивируется целиком: сама выполнена и ни одной открытой подзадачи
+    cursor = handler.execute(db, '''
+        SELECT id, user_id FROM tasks t
+        WHERE t.parent_id IS NULL AND t.status = 'done' AND t.completed_at < %s
+              AND NOT EXISTS (SELECT 1 FROM tasks s WHERE s.parent_id = t.id AND s.status != 'done')
+        ORDER BY t.completed_at ASC
+        LIMIT %s
+    ''', (cutoff, batch_size))
+    rows = handler.fetchall(cursor)
+    cursor.close()
+    ids = [row['id'] for row in rows]
+    if not ids:
+        return 0
+
+    marks = ', '.join(['%s'] * len(ids))
+    columns = ', '.join(TASK_COLUMNS)
+    handler.execute(db, f'''
+        INSERT INTO tasks_archive ({columns})
+        SELECT {columns} FROM tasks WHERE id IN ({marks}) OR parent_id IN ({marks})
+    ''', ids + ids).close()
+    handler.execute(db, f'DELETE FROM tasks WHERE parent_id IN ({marks})', ids).close()
+    handler.execute(db, f'DELETE FROM tasks WHERE id IN ({marks})', ids).close()
+    for user_id in sorted({row['user_id'] for row in rows}):
+        handler.touch_tasks(db, user_id)
+    return len(ids)
+
+
+def archive_completed_tasks(handler=None, older_than_days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE,
+                            pause_ms=ARCHIVE_BATCH_PAUSE_MS, max_batches=None):
+    """Переносит выполненные задачи с подзадачами в tasks_archive пачками; возвращает число задач.
+
+    Без handler обходит все базы с задачами: при шардировании у каждого шарда свой архив.
+    """
+    if older_than_days <= 0:
+        return 0
+    if handler is None:
+        return sum(archive_completed_tasks(shard, older_than_days, batch_size, pause_ms, max_batches)
+                   for shard in db_handler.user_databases())
+    cutoff = _cutoff(handler, older_than_days)
+    moved = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        # Каждая пачка - отдельная транзакция, в том числе через очередь записи
+        count = handler.write(_archive_batch, handler, cutoff, batch_size)
+        moved += count
+        batches += 1
+        if count < batch_size:
+            break
+        if pause_ms:
+            time.sleep(pause_ms / 1000.0)
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Перенос старых выполненных задач в tasks_archive')
+    parser.add_argument('--days', type=int, default=ARCHIVE_AFTER_DAYS or 180)
+    parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE)
+    parser.add_argument('--max-batches', type=int)
+    args = parser.parse_args()
+
+    conn = db_handler.get_connection()
+    db_handler.init_db(conn)
+    db_handler.close(conn)
+
+    started = time.perf_counter()
+    moved = archive_completed_tasks(older_than_days=args.days, batch_size=args.batch_size,
+                                    max_batches=args.max_batches)
+    print(f"✓ Archived {moved} tasks completed more than {args.days} days ago "
+          f"in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,412 @@
+"""ASGI-вход веб-приложения: WEB_SERVER=uvicorn.
+
+Маршруты /api/* обслуживаются здесь без потока на запрос: ожидание клиента и
+очереди стоит одну корутину, а в потоках выполняется только работа с базой
+(пул ASGI_DB_THREADS). Остальные страницы по-прежнему отдаёт Flask через
+небольшой мост WSGI в отдельном пуле. Тела ответов API строят те же функции,
+что и во Flask (load_tasks, load_stats, _api_*), поэтому JSON не отличается.
+"""
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import re
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import parse_qsl, urlencode
+
+from flask.sessions import SecureCookieSession
+from itsdangerous import BadSignature
+from werkzeug.http import dump_cookie, parse_cookie
+
+import app as web
+from database import db_handler
+from metrics import METRICS_ENABLED, asgi_metrics
+from query_trace import QUERY_TRACING, query_tracer
+
+# Потоки для запросов к базе: столько запросов /api/* ждут БД одновременно, остальные ждут в asyncio
+ASGI_DB_THREADS = int(os.environ.get('ASGI_DB_THREADS', '16'))
+# Потоки для страниц Flask (всё, кроме /api/*)
+ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', '4'))
+# Запросов в обработке одновременно; остальные ждут слота не дольше ASGI_QUEUE_TIMEOUT и получают 503
+ASGI_MAX_CONCURRENCY = int(os.environ.get('ASGI_MAX_CONCURRENCY', '256'))
+ASGI_QUEUE_TIMEOUT = float(os.environ.get('ASGI_QUEUE_TIMEOUT', '10'))
+ASGI_MAX_BODY_KB = int(os.environ.get('ASGI_MAX_BODY_KB', '1024'))
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message, headers=()):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = list(headers)
+
+
+class ConcurrencyLimit:
+    """Ограничивает число запросов в обработке; лишние ждут в очереди корутинами, а не потоками."""
+
+    def __init__(self, limit=ASGI_MAX_CONCURRENCY, timeout=ASGI_QUEUE_TIMEOUT):
+        self.limit = limit
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.counters = {'admitted': 0, 'rejected': 0}
+        self._semaphore = None
+        self._loop = None
+
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Семафор привязан к циклу событий, а в тестах цикл бывает не один
+            self._semaphore = asyncio.Semaphore(self.limit)
+            self._loop = loop
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.counters['rejected'] += 1
+            raise HTTPError(503, 'Server is busy', [(b'retry-after', b'1')]) from None
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        self.counters['admitted'] += 1
+
+    async def __aexit__(self, *exc_info):
+        self.active -= 1
+        self._semaphore.release()
+
+
+class AsyncDatabase:
+    """Awaitable-доступ к базе: единицы работы fn(conn, ...) выполняются в ограниченном пуле потоков.
+
+    Выбор шарда и реплики, подготовленные запросы и очередь записи SQLite остаются
+    за DatabaseHandler, как и для Flask-маршрутов.
+    """
+
+    def __init__(self, handler, threads=ASGI_DB_THREADS):
+        self.handler = handler
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asgi-db')
+
+    async def _run(self, fn, *args, **kwargs):
+        # Контекст копируется, чтобы запросы попали в единицу работы query_trace этого запроса
+        call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+
+    def _read(self, user_id, pinned, fn, *args):
+        conn = self.handler.get_read_connection(user_id, pinned=pinned)
+        try:
+            return fn(conn, *args)
+        finally:
+            self.handler.close(conn)
+
+    async def read(self, user_id, fn, *args, pinned=False):
+        return await self._run(self._read, user_id, pinned, fn, *args)
+
+    async def write(self, user_id, fn, *args):
+        return await self._run(self.handler.write, fn, *args, for_user=user_id)
+
+    def _connected(self, fn, *args):
+        opened = {}
+
+        def connect(user_id):
+            # Соединение открывается, только если fn действительно пошла в базу
+            if user_id not in opened:
+                opened[user_id] = self.handler.get_read_connection(user_id, pinned=True)
+            return opened[user_id]
+
+        try:
+            return fn(*args, connect)
+        finally:
+            for conn in opened.values():
+                self.handler.close(conn)
+
+    async def call(self, fn, *args):
+        """fn(*args, connect) в пуле потоков; connect(user_id) - соединение с основной базой пользователя."""
+        return await self._run(self._connected, fn, *args)
+
+
+database = AsyncDatabase(db_handler)
+limit = ConcurrencyLimit()
+wsgi_executor = ThreadPoolExecutor(max_workers=ASGI_WSGI_THREADS, thread_name_prefix='asgi-wsgi')
+
+if METRICS_ENABLED:
+    web.metrics_registry.add_collector(asgi_metrics(limit))
+
+
+class Request:
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.query_string = scope.get('query_string', b'').decode('latin-1')
+        self.headers = {}
+        for name, value in scope['headers']:
+            self.headers.setdefault(name.decode('latin-1').lower(), value.decode('latin-1'))
+        self.body = body
+        self.session = load_session(parse_cookie(self.headers.get('cookie', '')))
+        self.session_modified = False
+        self.user_id = None
+
+    def json(self):
+        # Те же требования, что у request.json во Flask
+        mimetype = self.headers.get('content-type', '').split(';', 1)[0].strip().lower()
+        if not (mimetype == 'application/json' or (mimetype.startswith('application/') and mimetype.endswith('+json'))):
+            raise HTTPError(415, 'Expected a JSON body')
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            raise HTTPError(400, 'Malformed JSON body') from None
+
+    def read_pinned(self):
+        return self.session.get('primary_until', 0) > time.time()
+
+    def pin_to_primary(self):
+        # Как write_db: следующие чтения пользователя на время окна идут в основную базу
+        if db_handler.replicas:
+            self.session['primary_until'] = time.time() + db_handler.primary_pins.ttl
+            self.session_modified = True
+
+
+def load_session(cookies):
+    """Сессия Flask из cookie: та же подпись и срок жизни, что у SecureCookieSessionInterface."""
+    interface = web.app.session_interface
+    value = cookies.get(interface.get_cookie_name(web.app))
+    if not value:
+        return SecureCookieSession()
+    serializer = interface.get_signing_serializer(web.app)
+    try:
+        return SecureCookieSession(serializer.loads(value, max_age=int(web.app.permanent_session_lifetime.total_seconds())))
+    except BadSignature:
+        return SecureCookieSession()
+
+
+def session_cookie(session):
+    interface, flask_app = web.app.session_interface, web.app
+    value = interface.get_signing_serializer(flask_app).dumps(dict(session))
+    return dump_cookie(
+        interface.get_cookie_name(flask_app), value,
+        expires=interface.get_expiration_time(flask_app, session),
+        domain=interface.get_cookie_domain(flask_app),
+        path=interface.get_cookie_path(flask_app),
+        secure=interface.get_cookie_secure(flask_app),
+        httponly=interface.get_cookie_httponly(flask_app),
+        samesite=interface.get_cookie_samesite(flask_app),
+    )
+
+
+async def authenticate(request):
+    """id пользователя сессии или None - тот же resolve_user, что у load_user во Flask-Login."""
+    user_id = request.session.get('_user_id')
+    if user_id is None:
+        return None
+    user = web.user_cache.get(user_id)
+    if user is None:
+        # Дальше возможны запросы к базе - не в потоке цикла событий
+        user = await database.call(web.resolve_user, user_id, request.session)
+    return None if user is None else user.id
+
+
+async def api_get_tasks(request):
+    page = web.task_page(dict(parse_qsl(request.query_string)))
+    tasks = await database.read(request.user_id, web.load_tasks, request.user_id, *page, pinned=request.read_pinned())
+    if tasks is None:
+        return 409, {'error': 'Cursor task not found'}
+    return 200, tasks
+
+
+async def api_get_task(request, id):
+    task = await database.read(request.user_id, web.load_task, request.user_id, int(id), pinned=request.read_pinned())
+    if task is None:
+        return 404, {'error': 'Task not found'}
+    return 200, task
+
+
+async def api_get_stats(request, period):
+    return 200, await database.read(request.user_id, web.load_stats, request.user_id, period,
+                                    pinned=request.read_pinned())
+
+
+async def api_add_task(request):
+    data = request.json()
+    request.pin_to_primary()
+    task_id = await database.write(request.user_id, web._api_add_task, request.user_id, data)
+    return 200, {'success': True, 'id': task_id}
+
+
+async def api_update_task(request, id):
+    action = request.json().get('action')
+    request.pin_to_primary()
+    if not await database.write(request.user_id, web._api_update_task, int(id), request.user_id, action):
+        return 403, {'error': 'Access denied'}
+    return 200, {'success': True}
+
+
+async def api_delete_task(request, id):
+    request.pin_to_primary()
+    if await database.write(request.user_id, web._api_delete_task, int(id), request.user_id):
+        return 200, {'success': True}
+    return 403, {'error': 'Access denied'}
+
+
+# (метод, путь, обработчик); имя обработчика совпадает с endpoint Flask - метки метрик общие
+ROUTES = [(method, re.compile(pattern), handler) for method, pattern, handler in (
+    ('GET', r'/api/tasks', api_get_tasks),
+    ('GET', r'/api/stats/(?P<period>[^/]+)', api_get_stats),
+    ('POST', r'/api/task', api_add_task),
+    ('GET', r'/api/task/(?P<id>\d+)', api_get_task),
+    ('PUT', r'/api/task/(?P<id>\d+)', api_update_task),
+    ('DELETE', r'/api/task/(?P<id>\d+)', api_delete_task),
+)]
+
+
+def match_route(method, path):
+    for route_method, pattern, handler in ROUTES:
+        found = pattern.fullmatch(path)
+        if found and route_method == method:
+            return handler, found.groupdict()
+    # Остальное, в том числе 404 и 405 для /api/*, отвечает Flask
+    return None, None
+
+
+def json_response(status, payload, headers=()):
+    body = web.app.json.dumps(payload).encode('utf-8') + b'\n'
+    return status, [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())] + list(headers), body
+
+
+def login_redirect(request):
+    # Как login_required с login_view='login': 302 на страницу входа с next
+    target = request.path + (f'?{request.query_string}' if request.query_string else '')
+    location = f"/login?{urlencode({'next': target})}"
+    return 302, [(b'location', location.encode('latin-1')), (b'content-length', b'0')], b''
+
+
+async def handle_api(request, handler, params):
+    request.user_id = await authenticate(request)
+    if request.user_id is None:
+        return login_redirect(request)
+    status, payload = await handler(request, **params)
+    headers = [(b'set-cookie', session_cookie(request.session).encode('latin-1'))] if request.session_modified else []
+    return json_response(status, payload, headers)
+
+
+def wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+    for name, value in scope['headers']:
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = f'HTTP_{key}'
+        value = value.decode('latin-1')
+        if key in environ:
+            value = environ[key] + ('; ' if key == 'HTTP_COOKIE' else ',') + value
+        environ[key] = value
+    return environ
+
+
+def run_wsgi(environ):
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, headers]
+
+    result = web.app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    status, headers = started
+    return (int(status.split(' ', 1)[0]),
+            [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers], body)
+
+
+async def read_body(receive):
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > ASGI_MAX_BODY_KB * 1024:
+            raise HTTPError(413, 'Request body too large')
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+def record_metrics(handler, method, status, started):
+    web.metrics_registry.ensure_flusher()
+    web.request_latency.observe(handler.__name__, method, value=time.perf_counter() - started)
+    web.requests_total.inc(handler.__name__, method, str(status))
+
+
+async def handle_http(scope, receive, send):
+    started = time.perf_counter()
+    handler, params = match_route(scope['method'], scope['path'])
+    try:
+        # Тело читается до занятия слота: медленный клиент не держит ни слот, ни поток
+        body = await read_body(receive)
+        if body is None:
+            return
+        async with limit:
+            if handler is None:
+                response = await asyncio.get_running_loop().run_in_executor(
+                    wsgi_executor, run_wsgi, wsgi_environ(scope, body))
+            else:
+                token = query_tracer.begin(f'web:{handler.__name__}') if QUERY_TRACING else None
+                try:
+                    response = await handle_api(Request(scope, body), handler, params)
+                finally:
+                    if token is not None:
+                        query_tracer.end(token)
+    except HTTPError as e:
+        response = json_response(e.status, {'error': e.message}, e.headers)
+    except Exception:
+        traceback.print_exc()
+        response = json_response(500, {'error': 'Internal Server Error'})
+    status, headers, content = response
+    if handler is not None and METRICS_ENABLED:
+        record_metrics(handler, scope['method'], status, started)
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': content})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # Начатые запросы к базе дорабатывают, новых пул не принимает
+            database.executor.shutdown(wait=False)
+            wsgi_executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    elif scope['type'] == 'http':
+        await handle_http(scope, receive, send)
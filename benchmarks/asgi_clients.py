@@ -0,0 +1,174 @@
+"""Тысячи одновременных клиентов /api/* на gunicorn и на uvicorn (asgi.py).
+
+Каждый клиент держит своё keep-alive соединение и с паузой "на размышление"
+читает список задач и переключает задачу. Сравниваются задержки, отказы и
+число потоков ОС у процессов сервера. Сессии подписываются тем же SECRET_KEY,
+что у сервера, поэтому вход через /login не нужен и сработает на SQLite.
+Запуск из корня проекта:
+
+    python -m benchmarks.asgi_clients --clients 2000 --duration 20
+"""
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+from benchmarks.suite import percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def start_server(server, port, database_url, workers, threads):
+    env = dict(os.environ, PORT=str(port), DATABASE_URL=database_url, WEB_SERVER=server,
+               WEB_WORKERS=str(workers), WEB_THREADS=str(threads))
+    process = subprocess.Popen([sys.executable, '-c', 'import main; main.run_flask_app()'], cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{server} exited during startup")
+        try:
+            with urllib.request.urlopen(base_url + '/login', timeout=1):
+                return process, base_url
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"{server} did not start in 30s")
+
+
+def process_tree_threads(pid):
+    """Потоки ОС у процесса и всех его потомков (Linux, /proc)."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    total, stack = 0, [pid]
+    while stack:
+        current = stack.pop()
+        try:
+            total += len(os.listdir(f'/proc/{current}/task'))
+        except OSError:
+            pass
+        stack.extend(children.get(current, []))
+    return total
+
+
+def session_cookies(users):
+    from flask.sessions import SecureCookieSessionInterface
+
+    from app import app
+
+    serializer = SecureCookieSessionInterface().get_signing_serializer(app)
+    return [{'session': serializer.dumps({'_user_id': str(user_id), '_fresh': True})} for user_id, _ in users]
+
+
+async def run_clients(base_url, cookies, clients, duration, think_ms, pid):
+    import httpx
+
+    latencies, failures, busy = [], 0, 0
+    peak_threads = 0
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as http:
+        deadline = time.monotonic() + duration
+
+        async def client(index):
+            nonlocal failures, busy
+            rng = random.Random(index)
+            jar = cookies[index % len(cookies)]
+            task_ids = []
+            # Клиенты подключаются не все в одну миллисекунду
+            await asyncio.sleep(rng.uniform(0, think_ms / 1000.0))
+            while time.monotonic() < deadline:
+                started = time.perf_counter()
+                try:
+                    if task_ids and rng.random() < 0.2:
+                        response = await http.put(f'/api/task/{rng.choice(task_ids)}', json={'action': 'toggle'},
+                                                  cookies=jar)
+                    else:
+                        response = await http.get('/api/tasks', cookies=jar)
+                        if response.status_code == 200:
+                            task_ids = [task['id'] for task in response.json()]
+                except httpx.HTTPError:
+                    failures += 1
+                else:
+                    if response.status_code == 503:
+                        busy += 1
+                    elif response.status_code != 200:
+                        failures += 1
+                    else:
+                        latencies.append(time.perf_counter() - started)
+                await asyncio.sleep(rng.uniform(0.5, 1.5) * think_ms / 1000.0)
+
+        async def sample_threads():
+            nonlocal peak_threads
+            while time.monotonic() < deadline:
+                peak_threads = max(peak_threads, process_tree_threads(pid))
+                await asyncio.sleep(0.5)
+
+        started = time.monotonic()
+        await asyncio.gather(sample_threads(), *(client(i) for i in range(clients)))
+    return latencies, failures, busy, peak_threads, time.monotonic() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--servers', default='gunicorn,uvicorn')
+    parser.add_argument('--clients', type=int, default=2000, help='одновременных клиентов (соединений)')
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--think-ms', type=float, default=1000, help='пауза клиента между запросами')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--tasks', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4, help='WEB_THREADS для gunicorn')
+    parser.add_argument('--port', type=int, default=8110)
+    args = parser.parse_args()
+
+    import resource
+
+    # Каждому клиенту нужен сокет, серверу - ещё один на соединение
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, args.clients * 2 + 256)), hard))
+
+    with tempfile.TemporaryDirectory() as workdir:
+        database_url = f"sqlite:///{os.path.join(workdir, 'asgi_clients.db')}"
+        os.environ['DATABASE_URL'] = database_url
+        os.environ['SQLITE_CHECKPOINT_INTERVAL'] = '0'
+        from benchmarks.seed import seed
+        from database import DatabaseHandler
+
+        users = seed(DatabaseHandler(database_url), args.users, args.tasks, 2, random.Random(1))
+        cookies = session_cookies(users)
+
+        print(f"{args.clients} clients, think {args.think_ms:.0f} ms, {args.duration:.0f}s per server")
+        print(f"{'server':<10} {'requests':>9} {'failed':>7} {'503':>6} {'req/s':>8} "
+              f"{'p50, ms':>9} {'p95, ms':>9} {'p99, ms':>9} {'threads':>8}")
+        for index, server in enumerate(args.servers.split(',')):
+            process, base_url = start_server(server, args.port + index, database_url, args.workers, args.threads)
+            try:
+                latencies, failures, busy, threads, elapsed = asyncio.run(
+                    run_clients(base_url, cookies, args.clients, args.duration, args.think_ms, process.pid))
+            finally:
+                process.terminate()
+                process.wait(timeout=30)
+            if not latencies:
+                print(f"{server:<10} {0:>9} {failures:>7} {busy:>6}")
+                continue
+            print(f"{server:<10} {len(latencies):>9} {failures:>7} {busy:>6} {len(latencies) / elapsed:>8.1f} "
+                  f"{percentile(latencies, 0.5) * 1000:>9.1f} {percentile(latencies, 0.95) * 1000:>9.1f} "
+                  f"{percentile(latencies, 0.99) * 1000:>9.1f} {threads:>8}")
+
+
+if __name__ == '__main__':
+    main()
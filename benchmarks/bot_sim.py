@@ -0,0 +1,254 @@
+"""Офлайн-симулятор трафика бота без Telegram.
+
+Синтетические Update проходят через настоящие Application и ConversationHandler
+из bot.build_application, а Bot API заменён заглушкой, которая записывает
+исходящие вызовы и имитирует их задержку. Запуск из корня проекта:
+
+    python -m benchmarks.bot_sim --chats 200 --rounds 3 --api-latency-ms 40
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import tempfile
+import time
+from collections import Counter
+
+from benchmarks.suite import percentile
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Simulator', 'username': 'sim_bot'}
+FIRST_CHAT_ID = 10_000_000
+
+
+class StubRequest:
+    """Заглушка BaseRequest: отвечает как Bot API и считает вызовы."""
+
+    def __init__(self, latency=0.0, jitter=0.0, seed=0):
+        from telegram.request import BaseRequest
+
+        # Подмешиваем базовый класс лениво, чтобы модуль импортировался без telegram
+        self.__class__ = type('StubRequest', (StubRequest, BaseRequest), {})
+        self.latency = latency
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.calls = Counter()
+        self.message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _result(self, endpoint, params):
+        if endpoint == 'getMe':
+            return BOT_USER
+        if endpoint in ('sendMessage', 'editMessageText'):
+            chat_id = int(params.get('chat_id') or 0)
+            return {
+                'message_id': int(params.get('message_id') or next(self.message_ids)),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': BOT_USER,
+                'text': params.get('text', ''),
+            }
+        return True
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] += 1
+        if endpoint != 'getMe' and (self.latency or self.jitter):
+            await asyncio.sleep(max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter)))
+        body = {'ok': True, 'result': self._result(endpoint, params)}
+        return 200, json.dumps(body).encode('utf-8')
+
+
+class ChatScript:
+    def __init__(self, application, chat_id, username, password):
+        self.application = application
+        self.chat_id = chat_id
+        self.username = username
+        self.password = password
+        self.user = {'id': chat_id, 'is_bot': False, 'first_name': f'User{chat_id}'}
+        self.chat = {'id': chat_id, 'type': 'private'}
+        self.message_id = 0
+
+    def _next_message_id(self):
+        self.message_id += 1
+        return self.message_id
+
+    def _message(self, text, from_user):
+        message = {'message_id': self._next_message_id(), 'date': int(time.time()), 'chat': self.chat,
+                   'from': from_user, 'text': text}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return message
+
+    async def _feed(self, payload):
+        from telegram import Update
+
+        payload['update_id'] = next(Simulation.update_ids)
+        update = Update.de_json(payload, self.application.bot)
+        app = self.application
+        await app.update_processor.process_update(update, app.process_update(update))
+        Simulation.updates += 1
+
+    async def send(self, text):
+        await self._feed({'message': self._message(text, self.user)})
+
+    async def tap(self, data):
+        await self._feed({'callback_query': {
+            'id': str(next(Simulation.update_ids)),
+            'from': self.user,
+            'chat_instance': str(self.chat_id),
+            'data': data,
+            'message': self._message('…', BOT_USER),
+        }})
+
+    async def login(self):
+        await self.send('/start')
+        await self.tap('lang_en')
+        await self.tap('auth_login')
+        await self.send(self.username)
+        await self.send(self.password)
+
+    async def add_task(self, rng):
+        await self.tap('menu_add_task')
+        await self.send(f"Simulated task {rng.randint(1, 10 ** 6)}")
+        await self.send('/skip')
+        await self.tap(f"priority_{rng.choice(('low', 'medium', 'high'))}")
+        await self.send('/skip')
+        await self.tap('subtasks_no')
+
+    async def list_tasks(self):
+        await self.tap('menu_tasks')
+        await self.tap('tasks_page_1')
+        await self.tap('menu_main')
+
+    async def toggle(self, task_id):
+        await self.tap(f'task_{task_id}')
+        await self.tap(f'toggle_{task_id}')
+        await self.tap('menu_tasks')
+
+
+class Simulation:
+    update_ids = itertools.count(1)
+    updates = 0
+
+
+async def timed(flows, name, coroutine):
+    started = time.perf_counter()
+    await coroutine
+    flows.setdefault(name, []).append(time.perf_counter() - started)
+
+
+async def run_chat(script, rounds, flows, rng, first_task_id):
+    await timed(flows, 'login', script.login())
+    for _ in range(rounds):
+        await timed(flows, 'add_task', script.add_task(rng))
+        await timed(flows, 'list', script.list_tasks())
+        task_id = first_task_id(script)
+        if task_id:
+            await timed(flows, 'toggle', script.toggle(task_id))
+
+
+async def simulate(args):
+    import bot
+    import outbound
+    from benchmarks.seed import BENCH_PASSWORD, seed
+    from database import db_handler
+    from telegram.ext import Application
+
+    rng = random.Random(args.seed)
+    users = seed(db_handler, args.chats, args.tasks, 2, rng, prefix='botsim_')
+    user_ids = {username: user_id for user_id, username in users}
+
+    stub = StubRequest(args.api_latency_ms / 1000.0, args.api_jitter_ms / 1000.0, args.seed)
+    builder = (Application.builder().token('123456:SIMULATOR').request(stub)
+               .get_updates_request(StubRequest()).concurrent_updates(args.concurrent_updates))
+    # По умолчанию меряем обработчики, а не початовый темп Telegram
+    outbound.OUTBOUND_QUEUE = args.outbound
+    application = bot.build_application(builder=builder)
+
+    errors = Counter()
+
+    async def count_error(update, context):
+        errors[type(context.error).__name__] += 1
+
+    application.add_error_handler(count_error)
+
+    def first_task_id(script):
+        tasks = bot.get_user_tasks(user_ids[script.username])
+        return tasks[0]['id'] if tasks else None
+
+    flows = {}
+    scripts = [ChatScript(application, FIRST_CHAT_ID + i, username, BENCH_PASSWORD)
+               for i, (_, username) in enumerate(users)]
+    async with application:
+        started = time.perf_counter()
+        await asyncio.gather(*(run_chat(script, args.rounds, flows, random.Random(i), first_task_id)
+                               for i, script in enumerate(scripts)))
+        elapsed = time.perf_counter() - started
+
+    return elapsed, flows, stub.calls, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chats', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=2, help='циклов add/list/toggle на чат')
+    parser.add_argument('--tasks', type=int, default=10, help='задач у каждого пользователя заранее')
+    parser.add_argument('--api-latency-ms', type=float, default=30)
+    parser.add_argument('--api-jitter-ms', type=float, default=10)
+    parser.add_argument('--concurrent-updates', type=int, default=1,
+                        help='как в Application: 1 - последовательная обработка, как в bot.main')
+    parser.add_argument('--outbound', action='store_true',
+                        help='пропускать вызовы через очередь outbound (скрипт жмёт кнопки быстрее человека)')
+    parser.add_argument('--database-url', help='по умолчанию - временная база SQLite')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='сохранить сводку в JSON')
+    args = parser.parse_args()
+
+    tmp = None
+    if not args.database_url:
+        tmp = tempfile.TemporaryDirectory()
+        args.database_url = f"sqlite:///{os.path.join(tmp.name, 'botsim.db')}"
+    os.environ['DATABASE_URL'] = args.database_url
+    # Симулятор шлёт все попытки входа с заранее известным паролем
+    os.environ.setdefault('LOGIN_USER_RATE', '0')
+    os.environ.setdefault('LOGIN_SOURCE_RATE', '0')
+
+    elapsed, flows, calls, errors = asyncio.run(simulate(args))
+
+    print(f"\n{Simulation.updates} updates from {args.chats} chats in {elapsed:.2f}s "
+          f"= {Simulation.updates / elapsed:.1f} updates/s")
+    print(f"\n{'flow':<10} {'runs':>6} {'p50, ms':>9} {'p95, ms':>9} {'max, ms':>9}")
+    summary = {'updates': Simulation.updates, 'elapsed': elapsed,
+               'updates_per_second': Simulation.updates / elapsed, 'flows': {},
+               'api_calls': dict(calls), 'errors': dict(errors)}
+    for name, samples in flows.items():
+        row = {'runs': len(samples), 'p50_ms': percentile(samples, 0.5) * 1000,
+               'p95_ms': percentile(samples, 0.95) * 1000, 'max_ms': max(samples) * 1000}
+        summary['flows'][name] = row
+        print(f"{name:<10} {row['runs']:>6} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['max_ms']:>9.1f}")
+    print("\nBot API calls: " + ', '.join(f"{k}={v}" for k, v in sorted(calls.items())))
+    if errors:
+        print("Handler errors: " + ', '.join(f"{k}={v}" for k, v in errors.items()))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+    if tmp is not None:
+        tmp.cleanup()
+
+
+if __name__ == '__main__':
+    main()
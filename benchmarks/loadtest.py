@@ -0,0 +1,260 @@
+"""HTTP-нагрузка на API веб-приложения с пулом синтетических пользователей.
+
+Запуск из корня проекта:
+
+    DATABASE_URL=postgresql://localhost/taskbench \\
+        python -m benchmarks.loadtest --start-server --seed-users 50 --concurrency 20 --duration 30
+
+Без --start-server нагрузка идёт на --url; ограничение попыток входа на
+сервере в этом случае нужно отключить (LOGIN_SOURCE_RATE=0).
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from benchmarks.suite import percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MIX = 'tasks=5,stats=3,add=1,toggle=2'
+PERIODS = ('hour', 'day', 'week', 'month', 'year')
+
+
+class Client:
+    def __init__(self, base_url, username, password, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        self.task_ids = []
+
+    def request(self, method, path, payload=None, form=None):
+        data = None
+        headers = {}
+        if payload is not None:
+            data = json.dumps(payload).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        elif form is not None:
+            data = urllib.parse.urlencode(form).encode('utf-8')
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        req = urllib.request.Request(self.base_url + path, data=data, headers=headers, method=method)
+        try:
+            with self.opener.open(req, timeout=self.timeout) as response:
+                return response.status, response.read(), response.geturl()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read(), e.geturl()
+
+    def login(self):
+        status, _, final_url = self.request('POST', '/login', form={
+            'username': self.username, 'password': self.password})
+        if status != 200 or urllib.parse.urlparse(final_url).path.startswith('/login'):
+            raise RuntimeError(f"login failed for {self.username} (HTTP {status})")
+        self.refresh_tasks()
+
+    def refresh_tasks(self):
+        status, body, _ = self.request('GET', '/api/tasks')
+        if status == 200:
+            self.task_ids = [task['id'] for task in json.loads(body)]
+        return status
+
+
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, endpoint, seconds, ok):
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+
+def action_tasks(client, rng):
+    return 'GET /api/tasks', client.refresh_tasks()
+
+
+def action_stats(client, rng):
+    status, _, _ = client.request('GET', f'/api/stats/{rng.choice(PERIODS)}')
+    return 'GET /api/stats/<period>', status
+
+
+def action_add(client, rng):
+    status, body, _ = client.request('POST', '/api/task', payload={
+        'title': f"Load test {rng.randint(1, 10 ** 6)}",
+        'description': 'generated by benchmarks.loadtest',
+        'priority': rng.choice(('low', 'medium', 'high')),
+        'subtasks': ['step 1', 'step 2'] if rng.random() < 0.3 else [],
+    })
+    if status == 200:
+        client.task_ids.append(json.loads(body)['id'])
+    return 'POST /api/task', status
+
+
+def action_toggle(client, rng):
+    if not client.task_ids:
+        return action_tasks(client, rng)
+    status, _, _ = client.request('PUT', f'/api/task/{rng.choice(client.task_ids)}', payload={'action': 'toggle'})
+    return 'PUT /api/task/<id>', status
+
+
+ACTIONS = {'tasks': action_tasks, 'stats': action_stats, 'add': action_add, 'toggle': action_toggle}
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ACTIONS:
+            raise SystemExit(f"unknown action in --mix: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def worker(clients, mix, deadline, stats, seed):
+    rng = random.Random(seed)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    while time.monotonic() < deadline:
+        client = rng.choice(clients)
+        action = ACTIONS[rng.choices(names, weights)[0]]
+        started = time.perf_counter()
+        try:
+            endpoint, status = action(client, rng)
+            ok = 200 <= status < 300
+        except Exception:
+            endpoint, ok = action.__name__, False
+        stats.record(endpoint, time.perf_counter() - started, ok)
+
+
+def start_server(port, database_url, workers, threads):
+    env = dict(os.environ, PORT=str(port), DATABASE_URL=database_url, WEB_WORKERS=str(workers),
+               WEB_THREADS=str(threads), LOGIN_SOURCE_RATE='0', LOGIN_USER_RATE='0')
+    process = subprocess.Popen([sys.executable, '-c', 'import main; main.run_flask_app()'], cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("server exited during startup")
+        try:
+            with urllib.request.urlopen(base_url + '/login', timeout=1):
+                return process, base_url
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("server did not start in 30s")
+
+
+def existing_users(handler, prefix, limit):
+    # При шардировании DATABASE_URL хранит справочник, а строки users лежат на шардах
+    if handler.shards:
+        query = 'SELECT username FROM user_directory WHERE username LIKE %s ORDER BY user_id LIMIT %s'
+    else:
+        query = 'SELECT username FROM users WHERE username LIKE %s ORDER BY id LIMIT %s'
+    conn = handler.get_connection()
+    cursor = handler.execute(conn, query, (prefix + '%', limit))
+    names = [row['username'] for row in handler.fetchall(cursor)]
+    cursor.close()
+    handler.close(conn)
+    return names
+
+
+def report(stats, elapsed):
+    total = sum(len(v) for v in stats.latencies.values())
+    print(f"\n{'endpoint':<28} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50, ms':>9} {'p95, ms':>9} {'p99, ms':>9}")
+    summary = {}
+    for endpoint, samples in sorted(stats.latencies.items()):
+        row = {
+            'requests': len(samples),
+            'errors': stats.errors.get(endpoint, 0),
+            'rps': len(samples) / elapsed,
+            'p50_ms': percentile(samples, 0.50) * 1000,
+            'p95_ms': percentile(samples, 0.95) * 1000,
+            'p99_ms': percentile(samples, 0.99) * 1000,
+        }
+        summary[endpoint] = row
+        print(f"{endpoint:<28} {row['requests']:>9} {row['errors']:>7} {row['rps']:>8.1f} "
+              f"{row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f}")
+    print(f"{'total':<28} {total:>9} {sum(stats.errors.values()):>7} {total / elapsed:>8.1f}")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--start-server', action='store_true', help='поднять gunicorn локально')
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--seed-users', type=int, default=0, help='создать столько пользователей перед стартом')
+    parser.add_argument('--tasks', type=int, default=20, help='задач у каждого созданного пользователя')
+    parser.add_argument('--users', type=int, default=50, help='размер пула пользователей')
+    parser.add_argument('--prefix', default='bench_')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument('--output', help='сохранить сводку в JSON')
+    args = parser.parse_args()
+
+    from benchmarks.seed import BENCH_PASSWORD, seed
+    from database import DatabaseHandler
+
+    mix = parse_mix(args.mix)
+    server = None
+    base_url = args.url
+    if args.database_url:
+        handler = DatabaseHandler(args.database_url)
+        if args.seed_users:
+            seed(handler, args.seed_users, args.tasks, 2, random.Random(), prefix=args.prefix)
+        usernames = existing_users(handler, args.prefix, args.users)
+    else:
+        raise SystemExit("--database-url (or DATABASE_URL) is needed to find the synthetic users")
+    if not usernames:
+        raise SystemExit(f"no users with prefix {args.prefix!r}; use --seed-users")
+
+    try:
+        if args.start_server:
+            server, base_url = start_server(args.port, args.database_url, args.workers, args.threads)
+
+        clients = [Client(base_url, name, BENCH_PASSWORD) for name in usernames]
+        print(f"Logging in {len(clients)} users...")
+        for client in clients:
+            client.login()
+
+        print(f"Running {args.concurrency} clients for {args.duration:.0f}s against {base_url}...")
+        stats = Stats()
+        deadline = time.monotonic() + args.duration
+        threads = [threading.Thread(target=worker, args=(clients, mix, deadline, stats, i))
+                   for i in range(args.concurrency)]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        summary = report(stats, time.monotonic() - started)
+
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump({'concurrency': args.concurrency, 'duration': args.duration, 'mix': mix,
+                           'endpoints': summary}, f, indent=2)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""Массовая рассылка и интерактивные ответы через очередь outbound против отправки напрямую.
+
+Имитация Telegram применяет flood-лимиты (общий на бота и на каждый чат) и
+отвечает 429 с retry_after при превышении. Пока идёт рассылка по многим чатам,
+пользователи нажимают кнопки; сравниваются задержки их ответов и число 429.
+Запуск из корня проекта:
+
+    python -m benchmarks.outbound --bulk 600 --chats 300 --interactive 60
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from benchmarks.suite import percentile
+
+
+class FakeTelegram:
+    """Flood-контроль, похожий на Telegram: превышение даёт RetryAfter и штрафную паузу."""
+
+    def __init__(self, global_rate, chat_interval, penalty, latency):
+        self.global_rate = global_rate
+        self.chat_interval = chat_interval
+        self.penalty = penalty
+        self.latency = latency
+        self.window = []
+        self.last_by_chat = {}
+        self.blocked_until = 0.0
+        self.accepted = 0
+        self.rejected = 0
+
+    async def send(self, chat_id):
+        from telegram.error import RetryAfter
+
+        await asyncio.sleep(self.latency)
+        now = time.monotonic()
+        self.window = [t for t in self.window if now - t < 1.0]
+        last = self.last_by_chat.get(chat_id)
+        if (now < self.blocked_until or len(self.window) >= self.global_rate
+                or (last is not None and now - last < self.chat_interval)):
+            self.rejected += 1
+            self.blocked_until = max(self.blocked_until, now + self.penalty)
+            raise RetryAfter(self.penalty)
+        self.window.append(now)
+        self.last_by_chat[chat_id] = now
+        self.accepted += 1
+        return True
+
+
+async def naive_send(telegram, chat_id, lane, max_retries):
+    # Без очереди: отправка сразу, на 429 - ждём retry_after и повторяем
+    from telegram.error import RetryAfter
+
+    for attempt in range(max_retries + 1):
+        try:
+            return await telegram.send(chat_id)
+        except RetryAfter as e:
+            if attempt == max_retries:
+                raise
+            await asyncio.sleep(float(e.retry_after))
+
+
+def dispatcher_send(dispatcher):
+    async def send(telegram, chat_id, lane, max_retries):
+        return await dispatcher.process_request(
+            telegram.send, (chat_id,), {}, 'sendMessage', {'chat_id': chat_id}, {'lane': lane})
+    return send
+
+
+async def run(mode, args):
+    from outbound import BULK, INTERACTIVE, OutboundDispatcher
+
+    rng = random.Random(args.seed)
+    telegram = FakeTelegram(args.telegram_rate, 1.0, args.penalty, args.latency_ms / 1000.0)
+    dispatcher = None
+    if mode == 'naive':
+        send = naive_send
+    else:
+        dispatcher = OutboundDispatcher(global_rate=args.telegram_rate * 0.9, chat_rate=1.0, chat_burst=1,
+                                        max_retries=args.max_retries)
+        await dispatcher.initialize()
+        send = dispatcher_send(dispatcher)
+
+    latencies = {'bulk': [], 'interactive': []}
+    failures = {'bulk': 0, 'interactive': 0}
+
+    async def one(chat_id, lane):
+        started = time.monotonic()
+        try:
+            await send(telegram, chat_id, lane, args.max_retries)
+        except Exception:
+            failures[lane] += 1
+            return
+        latencies[lane].append(time.monotonic() - started)
+
+    async def interactive():
+        # Пользователи из отдельного диапазона чатов нажимают кнопки во время рассылки
+        tasks = []
+        for i in range(args.interactive):
+            await asyncio.sleep(rng.uniform(0, 2 * args.bulk / args.telegram_rate / args.interactive))
+            tasks.append(asyncio.create_task(one(10 ** 6 + i, INTERACTIVE)))
+        await asyncio.gather(*tasks)
+
+    started = time.monotonic()
+    bulk_tasks = [asyncio.create_task(one(i % args.chats, BULK)) for i in range(args.bulk)]
+    await asyncio.gather(interactive(), *bulk_tasks)
+    elapsed = time.monotonic() - started
+    if dispatcher is not None:
+        await dispatcher.shutdown()
+    return latencies, failures, telegram, elapsed
+
+
+def report(mode, latencies, failures, telegram, elapsed):
+    print(f"\n[{mode}] {elapsed:.1f}s, {telegram.accepted} accepted, {telegram.rejected} rejected with 429")
+    print(f"{'lane':<12} {'sent':>6} {'failed':>7} {'p50, ms':>9} {'p95, ms':>9} {'max, ms':>9}")
+    for lane, samples in latencies.items():
+        if not samples:
+            print(f"{lane:<12} {0:>6} {failures[lane]:>7}")
+            continue
+        print(f"{lane:<12} {len(samples):>6} {failures[lane]:>7} {percentile(samples, 0.5) * 1000:>9.0f} "
+              f"{percentile(samples, 0.95) * 1000:>9.0f} {max(samples) * 1000:>9.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bulk', type=int, default=600, help='сообщений в рассылке')
+    parser.add_argument('--chats', type=int, default=300, help='получателей рассылки')
+    parser.add_argument('--interactive', type=int, default=60, help='ответов пользователям во время рассылки')
+    parser.add_argument('--telegram-rate', type=float, default=30, help='общий лимит имитации, сообщений/с')
+    parser.add_argument('--penalty', type=float, default=1.0, help='retry_after при превышении, секунды')
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--max-retries', type=int, default=3)
+    parser.add_argument('--modes', default='naive,dispatcher')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    for mode in args.modes.split(','):
+        report(mode, *asyncio.run(run(mode, args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""Выигрыш от подготовленных запросов на локальном PostgreSQL.
+
+Каждый горячий запрос выполняется много раз на одном соединении: сначала
+обычным текстом (разбор и планирование на каждый вызов), затем через
+PREPARE/EXECUTE. Затем тот же запрос выполняется один раз на новом соединении:
+пула нет, и PREPARE там - лишнее обращение к серверу. Отдельно сравниваются
+целые единицы работы бота.
+Запуск из корня проекта:
+
+    DATABASE_URL=postgresql://localhost/taskbench python -m benchmarks.prepared --tasks 200
+"""
+import argparse
+import os
+import random
+import statistics
+import time
+
+PERIODS = ('hour', 'day', 'week', 'month', 'year')
+
+
+def time_query(handler, conn, query, params, prepare, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        cursor = handler.execute(conn, query, params, prepare=prepare)
+        cursor.fetchall()
+        cursor.close()
+        samples.append(time.perf_counter() - started)
+    conn.rollback()
+    return statistics.median(samples)
+
+
+def time_one_shot(handler, query, params, prepare, repeat):
+    # Как в приложении: соединение на единицу работы, запрос выполняется на нём один раз
+    samples = []
+    for _ in range(repeat):
+        conn = handler.get_connection()
+        started = time.perf_counter()
+        cursor = handler.execute(conn, query, params, prepare=prepare)
+        cursor.fetchall()
+        cursor.close()
+        samples.append(time.perf_counter() - started)
+        handler.close(conn)
+    return statistics.median(samples)
+
+
+def planning_ms(handler, conn, query, params):
+    # EXPLAIN ANALYZE показывает, сколько сервер тратит на планирование одного вызова
+    cursor = handler.execute(conn, f'EXPLAIN (ANALYZE, SUMMARY) {query}', params)
+    lines = [row['QUERY PLAN'] for row in cursor.fetchall()]
+    cursor.close()
+    conn.rollback()
+    for line in lines:
+        if line.startswith('Planning Time'):
+            return float(line.split(':')[1].split()[0])
+    return None
+
+
+def hot_queries(user_id, task_id):
+    month_ago = '2000-01-01T00:00:00'
+    return {
+        'tasks by user': ('''
+            SELECT * FROM tasks
+            WHERE user_id = %s AND parent_id IS NULL
+            ORDER BY created_at DESC
+        ''', (user_id,)),
+        'subtasks by parent': ('SELECT * FROM tasks WHERE parent_id = %s ORDER BY id ASC', (task_id,)),
+        'task by id': ('SELECT * FROM tasks WHERE id = %s', (task_id,)),
+        'productivity': ('''
+            SELECT TO_CHAR(completed_at, 'YYYY-MM') as period, COUNT(*) as count
+            FROM tasks
+            WHERE user_id = %s AND status = 'done' AND completed_at IS NOT NULL
+                  AND parent_id IS NULL AND completed_at >= %s
+            GROUP BY TO_CHAR(completed_at, 'YYYY-MM')
+            ORDER BY period ASC
+        ''', (user_id, month_ago)),
+        'priorities': ('''
+            SELECT priority, COUNT(*) as count
+            FROM tasks
+            WHERE user_id = %s AND parent_id IS NULL
+            GROUP BY priority
+        ''', (user_id,)),
+    }
+
+
+def time_unit(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--tasks', type=int, default=200, help='задач у измеряемого пользователя')
+    parser.add_argument('--repeat', type=int, default=500)
+    args = parser.parse_args()
+
+    if not args.database_url or not args.database_url.startswith(('postgresql', 'postgres')):
+        raise SystemExit("PREPARE is PostgreSQL-only: pass --database-url postgresql://...")
+    os.environ['DATABASE_URL'] = args.database_url
+
+    import bot
+    from benchmarks.seed import seed
+    from database import db_handler
+
+    (user_id, _), = seed(db_handler, 1, args.tasks, 3, random.Random(1), prefix='prepared_')
+    conn = db_handler.get_connection()
+    cursor = db_handler.execute(conn, 'SELECT MIN(parent_id) AS id FROM tasks WHERE user_id = %s', (user_id,))
+    task_id = cursor.fetchone()['id']
+    cursor.close()
+
+    print(f"{'query':<20} {'plain, us':>10} {'prepared, us':>13} {'saved':>7} {'planning, us':>13}")
+    for name, (query, params) in hot_queries(user_id, task_id).items():
+        plain = time_query(db_handler, conn, query, params, False, args.repeat)
+        prepared = time_query(db_handler, conn, query, params, True, args.repeat)
+        planning = planning_ms(db_handler, conn, query, params)
+        print(f"{name:<20} {plain * 1e6:>10.1f} {prepared * 1e6:>13.1f} {(1 - prepared / plain) * 100:>6.1f}% "
+              f"{planning * 1000 if planning is not None else float('nan'):>13.1f}")
+    db_handler.close(conn)
+
+    print(f"\n{'one-shot query':<20} {'plain, us':>10} {'prepared, us':>13} {'saved':>7}")
+    for name, (query, params) in hot_queries(user_id, task_id).items():
+        plain = time_one_shot(db_handler, query, params, False, args.repeat // 10)
+        prepared = time_one_shot(db_handler, query, params, True, args.repeat // 10)
+        print(f"{name:<20} {plain * 1e6:>10.1f} {prepared * 1e6:>13.1f} {(1 - prepared / plain) * 100:>6.1f}%")
+
+    # Целые единицы работы: новое соединение на вызов, как в bot.py
+    units = {'bot.get_user_tasks': lambda: bot.get_user_tasks(user_id)}
+    for period in PERIODS:
+        units[f'bot.get_stats[{period}]'] = lambda period=period: bot.get_stats(user_id, period)
+    repeat = max(10, args.repeat // 10)
+    print(f"\n{'unit of work':<24} {'plain, ms':>10} {'prepared, ms':>13} {'saved':>7}")
+    for name, fn in units.items():
+        db_handler.prepared_statements = False
+        plain = time_unit(fn, repeat)
+        db_handler.prepared_statements = True
+        prepared = time_unit(fn, repeat)
+        print(f"{name:<24} {plain * 1000:>10.2f} {prepared * 1000:>13.2f} {(1 - prepared / plain) * 100:>6.1f}%")
+    print(f"\nprepare stats: {db_handler.prepare_stats}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Проверка маршрутизации чтений на реплику на двух локальных базах SQLite.
+
+Основная база и "реплика" - два файла; репликация имитируется копированием
+через backup API. Запуск из корня проекта:
+
+    python -m benchmarks.replicas
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+
+def replicate(primary_path, replica_path):
+    src = sqlite3.connect(primary_path)
+    dst = sqlite3.connect(replica_path)
+    src.backup(dst)
+    dst.close()
+    src.close()
+
+
+def count_tasks(handler, user_id, conn):
+    cursor = handler.execute(conn, 'SELECT COUNT(*) AS n FROM tasks WHERE user_id = %s', (user_id,))
+    n = handler.fetchone(cursor)['n']
+    cursor.close()
+    return n
+
+
+def read_count(handler, user_id):
+    conn = handler.get_read_connection(user_id)
+    try:
+        return count_tasks(handler, user_id, conn)
+    finally:
+        handler.close(conn)
+
+
+def check(label, ok):
+    print(f"{'✓' if ok else '✗'} {label}")
+    if not ok:
+        raise SystemExit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--window', type=float, default=0.5, help='окно read-your-writes, секунды')
+    args = parser.parse_args()
+
+    from benchmarks.seed import seed
+    from database import DatabaseHandler
+
+    with tempfile.TemporaryDirectory() as workdir:
+        primary_path = os.path.join(workdir, 'primary.db')
+        replica_path = os.path.join(workdir, 'replica.db')
+        handler = DatabaseHandler(f'sqlite:///{primary_path}', checkpoint_interval=0,
+                                  replica_urls=[f'sqlite:///{replica_path}'], read_your_writes_window=args.window)
+        (writer, _), (reader, _) = seed(handler, 2, 5, 0, random.Random(1), prefix='replica_')
+        replicate(primary_path, replica_path)
+        replica = handler.replicas[0]
+        # Проверяем реплику перед каждым соединением, чтобы сбой был виден сразу
+        replica.check_interval = 0
+        replica.retry_interval = 0.2
+
+        def add_task(db, user_id):
+            handler.execute(db, "INSERT INTO tasks (title, user_id, status) VALUES ('new', %s, 'not_started')",
+                            (user_id,)).close()
+
+        handler.write(add_task, writer, for_user=writer)
+        check("writer reads its own write from the primary right after writing", read_count(handler, writer) == 6)
+        check("other users keep reading from the replica", handler.read_routing['replica'] == 0 and
+              read_count(handler, reader) == 5 and handler.read_routing['replica'] == 1)
+
+        time.sleep(args.window + 0.1)
+        check("after the window the writer goes back to the (lagging) replica", read_count(handler, writer) == 5)
+        replicate(primary_path, replica_path)
+        check("once replicated the replica returns the new row", read_count(handler, writer) == 6)
+
+        os.rename(replica_path, replica_path + '.down')
+        fallbacks = handler.read_routing['primary_fallback']
+        check("with the replica gone reads fall back to the primary",
+              read_count(handler, reader) == 5 and handler.read_routing['primary_fallback'] == fallbacks + 1)
+        check("the replica is marked unhealthy", not replica.healthy)
+
+        os.rename(replica_path + '.down', replica_path)
+        time.sleep(replica.retry_interval + 0.05)
+        before = handler.read_routing['replica']
+        check("after the retry interval the replica is probed and used again",
+              read_count(handler, reader) == 5 and replica.healthy and handler.read_routing['replica'] == before + 1)
+
+        print(handler.replica_status())
+
+
+if __name__ == '__main__':
+    main()
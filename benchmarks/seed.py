@@ -0,0 +1,136 @@
+"""Генератор синтетических данных: N пользователей x M задач x K подзадач.
+
+Запуск из корня проекта:
+
+    python -m benchmarks.seed --users 100 --tasks 50 --subtasks 3 --database-url sqlite:///bench.db
+"""
+import argparse
+import os
+import random
+from datetime import datetime, timedelta
+
+BENCH_PASSWORD = 'benchmark-password'
+BENCH_PREFIX = 'bench_'
+
+PRIORITIES = ('low', 'medium', 'high')
+PRIORITY_WEIGHTS = (0.3, 0.5, 0.2)
+# Доля выполненных задач; у задач с подзадачами часть подзадач остаётся открытой
+DONE_RATIO = 0.55
+DEADLINE_RATIO = 0.4
+HISTORY_DAYS = 365
+
+WORDS = ('report', 'review', 'deploy', 'call', 'email', 'plan', 'fix', 'design', 'write', 'read',
+         'update', 'test', 'meeting', 'invoice', 'backup', 'refactor', 'release', 'notes')
+
+
+def _title(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 5))).capitalize()
+
+
+def _timestamp(value, use_postgresql):
+    return value if use_postgresql else value.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _next_id(handler, conn, table):
+    cursor = handler.execute(conn, f'SELECT MAX(id) AS max_id FROM {table}')
+    row = handler.fetchone(cursor)
+    cursor.close()
+    return (row['max_id'] or 0) + 1
+
+
+def generate_tasks(rng, user_id, count, subtasks, next_task_id, now, use_postgresql):
+    rows = []
+    for _ in range(count):
+        task_id = next_task_id
+        next_task_id += 1
+        created = now - timedelta(days=rng.random() * HISTORY_DAYS, seconds=rng.randint(0, 86399))
+        done = rng.random() < DONE_RATIO
+        # Время выполнения - логнормальное, от минут до нескольких недель
+        completed = created + timedelta(hours=rng.lognormvariate(2.5, 1.2)) if done else None
+        if completed and completed > now:
+            completed = now
+        deadline = None
+        if rng.random() < DEADLINE_RATIO:
+            deadline = (created + timedelta(days=rng.randint(1, 60))).strftime('%Y-%m-%d')
+        priority = rng.choices(PRIORITIES, PRIORITY_WEIGHTS)[0]
+        description = _title(rng) if rng.random() < 0.6 else None
+
+        rows.append((task_id, _title(rng), description, 'done' if done else 'not_started', priority, deadline,
+                     user_id, None, _timestamp(created, use_postgresql),
+                     _timestamp(completed, use_postgresql) if completed else None))
+
+        sub_count = rng.randint(0, subtasks * 2) if subtasks else 0
+        for _ in range(sub_count):
+            sub_done = done or rng.random() < 0.4
+            sub_completed = (completed or created + timedelta(hours=rng.lognormvariate(1.5, 1.0))) if sub_done else None
+            if sub_completed and sub_completed > now:
+                sub_completed = now
+            rows.append((next_task_id, _title(rng), None, 'done' if sub_done else 'not_started', 'medium', None,
+                         user_id, task_id, _timestamp(created, use_postgresql),
+                         _timestamp(sub_completed, use_postgresql) if sub_completed else None))
+            next_task_id += 1
+    return rows, next_task_id
+
+
+def seed(handler, users, tasks, subtasks, rng=None, prefix=BENCH_PREFIX, password_hash=None):
+    """Создаёт пользователей с задачами и возвращает список (user_id, username)."""
+    import passwords
+
+    rng = rng or random.Random(42)
+    password_hash = password_hash or passwords.hash_password(BENCH_PASSWORD)
+    use_postgresql = handler.use_postgresql
+    now = datetime.utcnow()
+
+    conn = handler.get_connection()
+    handler.init_db(conn)
+    next_user_id = _next_id(handler, conn, 'users')
+    next_task_id = _next_id(handler, conn, 'tasks')
+
+    created = []
+    user_rows = []
+    task_rows = []
+    for i in range(users):
+        user_id = next_user_id + i
+        username = f"{prefix}{user_id:07d}"
+        user_rows.append((user_id, username, password_hash))
+        created.append((user_id, username))
+        rows, next_task_id = generate_tasks(rng, user_id, tasks, subtasks, next_task_id, now, use_postgresql)
+        task_rows.extend(rows)
+
+    placeholder = '%s' if use_postgresql else '?'
+    cursor = conn.cursor()
+    cursor.executemany(
+        f'INSERT INTO users (id, username, password_hash) VALUES ({", ".join([placeholder] * 3)})', user_rows)
+    cursor.executemany(
+        'INSERT INTO tasks (id, title, description, status, priority, deadline, user_id, parent_id, '
+        f'created_at, completed_at) VALUES ({", ".join([placeholder] * 10)})', task_rows)
+    if use_postgresql:
+        # Явные id не двигают SERIAL-последовательности
+        cursor.execute("SELECT setval(pg_get_serial_sequence('users', 'id'), (SELECT MAX(id) FROM users))")
+        cursor.execute("SELECT setval(pg_get_serial_sequence('tasks', 'id'), (SELECT MAX(id) FROM tasks))")
+    cursor.close()
+    handler.commit(conn)
+    handler.close(conn)
+    return created
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--tasks', type=int, default=50, help='задач на пользователя')
+    parser.add_argument('--subtasks', type=int, default=3, help='среднее число подзадач на задачу')
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL', 'sqlite:///bench.db'))
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--prefix', default=BENCH_PREFIX)
+    args = parser.parse_args()
+
+    from database import DatabaseHandler
+
+    handler = DatabaseHandler(args.database_url)
+    users = seed(handler, args.users, args.tasks, args.subtasks, random.Random(args.seed), args.prefix)
+    print(f"✓ Seeded {len(users)} users x {args.tasks} tasks into {args.database_url[:50]}")
+    print(f"  Password for all generated users: {BENCH_PASSWORD}")
+
+
+if __name__ == '__main__':
+    main()
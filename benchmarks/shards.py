@@ -0,0 +1,170 @@
+"""Проверка шардирования пользователей на нескольких локальных файлах SQLite.
+
+Справочник и три шарда - отдельные файлы. Пользователи создаются через bot.py и
+веб-приложение, затем один из них переносится на другой шард, пока в это время
+для него идут записи. Запуск из корня проекта:
+
+    python -m benchmarks.shards --users 30
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+
+def check(label, ok):
+    print(f"{'✓' if ok else '✗'} {label}")
+    if not ok:
+        raise SystemExit(1)
+
+
+def rows_in(path, query, params=()):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(query, params).fetchall()
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=30)
+    parser.add_argument('--shards', type=int, default=3)
+    parser.add_argument('--map-ttl', type=float, default=0.5, help='SHARD_MAP_TTL на время проверки, секунды')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        shard_paths = [os.path.join(workdir, f'shard{i}.db') for i in range(args.shards)]
+        os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'directory.db')}"
+        os.environ['DATABASE_SHARD_URLS'] = ','.join(f'sqlite:///{path}' for path in shard_paths)
+        os.environ['SHARD_MAP_TTL'] = str(args.map_ttl)
+        os.environ['SQLITE_CHECKPOINT_INTERVAL'] = '0'
+
+        import archive
+        import bot
+        import shards
+        from database import SHARD_ID_STRIDE, UserMoving, db_handler
+
+        conn = db_handler.get_connection()
+        db_handler.init_db(conn)
+        db_handler.close(conn)
+
+        user_ids = {}
+        for i in range(args.users):
+            username = f'shard_user_{i}'
+            user_ids[username] = bot.create_user(username, 'hash')
+            bot.add_task(user_ids[username], f'Task of {username}', None, 'medium', None, ['a', 'b'])
+        placement = {index: users for index, _, users, _ in shards.status()}
+        print(f"users per shard: {placement}")
+        check("every shard got users", all(placement.values()) and sum(placement.values()) == args.users)
+
+        misplaced = 0
+        for username, user_id in user_ids.items():
+            index = db_handler.shard_index(user_id)
+            for other, path in enumerate(shard_paths):
+                found = rows_in(path, 'SELECT COUNT(*) FROM tasks WHERE user_id = ?', (user_id,))[0][0]
+                misplaced += (found != 3) if other == index else (found != 0)
+        check("each user's rows live only on the user's shard", misplaced == 0)
+
+        ranges_ok = all(min_id is None or min_id > index * SHARD_ID_STRIDE
+                        for index, path in enumerate(shard_paths)
+                        for (min_id,) in rows_in(path, 'SELECT MIN(id) FROM tasks'))
+        check("task ids come from the shard's own id range", ranges_ok)
+
+        username, user_id = next(iter(user_ids.items()))
+        check("login lookup finds the user through the directory",
+              bot.get_user_by_username(username)['id'] == user_id and bot.get_user_by_username('nobody') is None)
+        check("usernames stay unique across shards", bot.create_user(username, 'hash') is None)
+
+        from app import app
+        client = app.test_client()
+        response = client.post('/register', data={'username': 'web_user', 'password': 'password123'})
+        check("web registration goes through the directory", response.status_code == 302)
+        client.post('/api/task', json={'title': 'From the web', 'subtasks': ['x']})
+        tasks = client.get('/api/tasks').get_json()
+        check("web API reads and writes the user's shard", [task['title'] for task in tasks] == ['From the web'])
+        client = app.test_client()
+        response = client.post('/login', data={'username': 'web_user', 'password': 'password123'})
+        check("web login finds the user on its shard",
+              response.status_code == 302 and response.headers['Location'].endswith('/') and
+              [task['title'] for task in client.get('/api/tasks').get_json()] == ['From the web'])
+        response = app.test_client().post('/login', data={'username': 'web_user', 'password': 'wrong-password'})
+        check("a wrong password is rejected", response.status_code == 200)
+
+        # Перенос под нагрузкой: параллельный поток всё это время добавляет пользователю задачи
+        source = db_handler.shard_index(user_id)
+        target = (source + 1) % args.shards
+        added, refused, web_added = [], [], []
+        stop = threading.Event()
+        web_client = app.test_client()
+        with web_client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+
+        def writer():
+            # Бот не ждёт конца переноса: запись сразу отклоняется, пользователь повторяет её позже
+            while not stop.is_set():
+                started = time.monotonic()
+                try:
+                    bot.add_task(user_id, 'Written during the move', None, 'low', None, [])
+                except UserMoving:
+                    refused.append(time.monotonic() - started)
+                else:
+                    added.append(time.monotonic())
+                time.sleep(0.02)
+
+        def web_writer():
+            # Веб-приложение дожидается конца переноса и пишет уже на новый шард
+            while not stop.is_set():
+                response = web_client.post('/api/task', json={'title': 'Web write during the move', 'subtasks': []})
+                if response.status_code == 200:
+                    web_added.append(response.get_json()['id'])
+                time.sleep(0.05)
+
+        threads = [threading.Thread(target=writer), threading.Thread(target=web_writer)]
+        for thread in threads:
+            thread.start()
+        started = time.monotonic()
+        copied = shards.move_user(user_id, target)
+        time.sleep(0.2)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        print(f"moved in {time.monotonic() - started:.1f}s: {copied}; {len(added)} bot and {len(web_added)} web "
+              f"writes ran meanwhile, {len(refused)} bot writes were refused for a retry")
+        check("bot writes to a moving user fail fast instead of blocking",
+              bool(refused) and max(refused) < 0.5)
+
+        expected = 3 + len(added) + len(web_added)
+        check("no write was lost during the move",
+              len(bot.get_user_tasks(user_id)) == 1 + len(added) + len(web_added) and
+              rows_in(shard_paths[target], 'SELECT COUNT(*) FROM tasks WHERE user_id = ?', (user_id,))[0][0] == expected)
+        kept = {task['id'] for task in bot.get_user_tasks(user_id)}
+        check("web writes made during the move are on the new shard", bool(web_added) and set(web_added) <= kept)
+        check("the old shard no longer has the user's rows",
+              rows_in(shard_paths[source], 'SELECT COUNT(*) FROM tasks WHERE user_id = ?', (user_id,))[0][0] == 0 and
+              rows_in(shard_paths[source], 'SELECT COUNT(*) FROM users WHERE id = ?', (user_id,))[0][0] == 0)
+        check("the directory points to the new shard", db_handler.shard_index(user_id) == target)
+
+        task = bot.get_user_tasks(user_id)[-1]
+        check("moved tasks keep their ids and stay writable",
+              bot.toggle_task(task['id'], user_id) and bot.get_user_tasks(user_id)[-1]['status'] == 'done')
+        check("jobs walk every shard", archive.archive_completed_tasks(older_than_days=1) == 0)
+
+        # Перенос вниз: на шард с меньшим номером приезжают id из чужого, большего диапазона
+        mover = next(uid for uid in user_ids.values() if db_handler.shard_index(uid) == args.shards - 1)
+        lower = args.shards - 2
+        shards.move_user(mover, lower, settle=args.map_ttl + 0.1)
+        neighbour = next(uid for uid in user_ids.values()
+                         if uid != mover and db_handler.shard_index(uid) == args.shards - 1)
+        new_ids = [bot.add_task(mover, 'After a downward move', None, 'low', None, []),
+                   bot.add_task(neighbour, 'On the source shard', None, 'low', None, [])]
+        check("both shards keep issuing ids from their own range after a downward move",
+              new_ids[0] // SHARD_ID_STRIDE == lower and new_ids[1] // SHARD_ID_STRIDE == args.shards - 1)
+        print(db_handler.shard_status())
+
+
+if __name__ == '__main__':
+    main()
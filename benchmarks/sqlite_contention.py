@@ -0,0 +1,184 @@
+"""Конкурентная запись в один файл SQLite из двух процессов, как у веб-приложения и бота.
+
+Каждый режим получает свою копию одной и той же базы; процессы "web" и "bot"
+с несколькими потоками одновременно переключают, читают и добавляют задачи
+через функции bot.py. Запуск из корня проекта:
+
+    python -m benchmarks.sqlite_contention --threads 4 --duration 10
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.suite import percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = {
+    'default': {'SQLITE_TUNING': '0', 'SQLITE_WRITE_QUEUE': '0'},
+    'tuned': {'SQLITE_TUNING': '1', 'SQLITE_WRITE_QUEUE': '0'},
+    # Один поток-писатель на процесс с групповыми коммитами
+    'queued': {'SQLITE_TUNING': '1', 'SQLITE_WRITE_QUEUE': '1'},
+}
+# toggle - основная нагрузка на запись, list - чтение, add - вставка
+DEFAULT_MIX = 'toggle=6,list=3,add=1'
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ('toggle', 'list', 'add'):
+            raise SystemExit(f"unknown operation in --mix: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def run_worker(args):
+    """Выполняется в дочернем процессе; настройки базы приходят через окружение."""
+    import sqlite3
+
+    import bot
+
+    rng = random.Random(args.seed)
+    users = json.loads(args.users)
+    mix = parse_mix(args.mix)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    lock = threading.Lock()
+    latencies = {name: [] for name in names}
+    errors = {}
+
+    def loop(seed):
+        local = random.Random(seed)
+        while time.time() < args.start_at + args.duration:
+            user_id, task_ids = local.choice(users)
+            op = local.choices(names, weights)[0]
+            started = time.perf_counter()
+            try:
+                if op == 'toggle':
+                    bot.toggle_task(local.choice(task_ids), user_id)
+                elif op == 'list':
+                    bot.get_user_tasks(user_id)
+                else:
+                    bot.add_task(user_id, 'Contention task', None, 'medium', None, ['a', 'b'])
+            except sqlite3.OperationalError as e:
+                with lock:
+                    errors[str(e)] = errors.get(str(e), 0) + 1
+                continue
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies[op].append(elapsed)
+
+    delay = args.start_at - time.time()
+    if delay > 0:
+        time.sleep(delay)
+    threads = [threading.Thread(target=loop, args=(rng.random(),)) for _ in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    json.dump({'latencies': latencies, 'errors': errors}, sys.stdout)
+
+
+def prepare_template(path, users, tasks):
+    from benchmarks.seed import seed
+    from database import DatabaseHandler
+
+    handler = DatabaseHandler(f'sqlite:///{path}', sqlite_tuning=False, checkpoint_interval=0)
+    created = seed(handler, users, tasks, 2, random.Random(7), prefix='contention_')
+    conn = handler.get_connection()
+    result = []
+    for user_id, _ in created:
+        cursor = handler.execute(conn, 'SELECT id FROM tasks WHERE user_id = %s AND parent_id IS NULL', (user_id,))
+        result.append((user_id, [row['id'] for row in handler.fetchall(cursor)]))
+        cursor.close()
+    handler.close(conn)
+    return result
+
+
+def run_mode(mode, template, workdir, users, args):
+    path = os.path.join(workdir, f'{mode}.db')
+    shutil.copyfile(template, path)
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{path}', **MODES[mode])
+    start_at = time.time() + 3
+    processes = []
+    for i, role in enumerate(('web', 'bot')):
+        command = [sys.executable, '-m', 'benchmarks.sqlite_contention', '--worker', '--threads', str(args.threads),
+                   '--duration', str(args.duration), '--start-at', str(start_at), '--seed', str(i),
+                   '--mix', args.mix, '--users', json.dumps(users)]
+        processes.append((role, subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.PIPE)))
+
+    latencies = {}
+    errors = {}
+    for role, process in processes:
+        out, _ = process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(f"{mode}/{role} worker failed with exit code {process.returncode}")
+        result = json.loads(out)
+        for op, samples in result['latencies'].items():
+            latencies.setdefault(op, []).extend(samples)
+        for message, count in result['errors'].items():
+            errors[message] = errors.get(message, 0) + count
+    return latencies, errors
+
+
+def report(mode, latencies, errors, duration):
+    total = sum(len(samples) for samples in latencies.values())
+    failed = sum(errors.values())
+    print(f"\n[{mode}] {total / duration:.1f} ops/s, {failed} errors")
+    print(f"{'op':<8} {'ops':>7} {'p50, ms':>9} {'p95, ms':>9} {'p99, ms':>9}")
+    summary = {'ops_per_second': total / duration, 'errors': errors, 'ops': {}}
+    for op, samples in latencies.items():
+        if not samples:
+            continue
+        row = {'ops': len(samples), 'p50_ms': percentile(samples, 0.5) * 1000,
+               'p95_ms': percentile(samples, 0.95) * 1000, 'p99_ms': percentile(samples, 0.99) * 1000}
+        summary['ops'][op] = row
+        print(f"{op:<8} {row['ops']:>7} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f}")
+    for message, count in errors.items():
+        print(f"  {count}x {message}")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=4, help='потоков в каждом из двух процессов')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--users', default='20', help='число пользователей (в режиме --worker - их задачи)')
+    parser.add_argument('--tasks', type=int, default=50)
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='веса операций, например toggle=1')
+    parser.add_argument('--output', help='сохранить сводку в JSON')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--start-at', type=float, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--seed', type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    parse_mix(args.mix)
+    if args.worker:
+        run_worker(args)
+        return
+
+    with tempfile.TemporaryDirectory() as workdir:
+        template = os.path.join(workdir, 'template.db')
+        users = prepare_template(template, int(args.users), args.tasks)
+        summary = {}
+        for mode in args.modes.split(','):
+            print(f"Running {mode}: 2 processes x {args.threads} threads for {args.duration:g}s...")
+            latencies, errors = run_mode(mode, template, workdir, users, args)
+            summary[mode] = report(mode, latencies, errors, args.duration)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
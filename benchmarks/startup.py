@@ -0,0 +1,95 @@
+"""Время холодного старта процессов: импорт модулей и готовность к работе.
+
+Запуск из корня проекта:
+
+    python -m benchmarks.startup --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Каждый сценарий печатает JSON с длительностью импорта и выхода в рабочее состояние
+SCENARIOS = {
+    'database': '''
+import database
+imported = time.perf_counter()
+conn = database.db_handler.get_connection()
+database.db_handler.init_db(conn)
+database.db_handler.close(conn)
+''',
+    'app': '''
+import app
+imported = time.perf_counter()
+import translations
+translations.catalog.load()
+with app.app.app_context():
+    app.init_db()
+app.app.test_client().get('/login')
+''',
+    'bot': '''
+import bot
+imported = time.perf_counter()
+bot.translations.catalog.load()
+bot.build_application(token='123456:BENCHMARK')
+''',
+    'main': '''
+import main
+imported = time.perf_counter()
+''',
+}
+
+TEMPLATE = '''
+import io, contextlib, json, sys, time
+started = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+{body}
+    ready = time.perf_counter()
+print(json.dumps({{"import": imported - started, "ready": ready - started}}))
+'''
+
+
+def run_once(name, database_url):
+    body = '\n'.join('    ' + line for line in SCENARIOS[name].strip().splitlines())
+    code = TEMPLATE.format(body=body)
+    env = dict(os.environ, DATABASE_URL=database_url)
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    total = time.perf_counter() - started
+    result = json.loads(output.strip().splitlines()[-1])
+    result['process'] = total
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--only', choices=sorted(SCENARIOS), action='append')
+    parser.add_argument('--json', help='сохранить результаты в файл')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        database_url = f"sqlite:///{os.path.join(tmp, 'startup.db')}"
+        for name in args.only or SCENARIOS:
+            runs = [run_once(name, database_url) for _ in range(args.runs)]
+            results[name] = {key: statistics.median(r[key] for r in runs) for key in ('import', 'ready', 'process')}
+
+    print(f"{'process':<10} {'import, ms':>12} {'ready, ms':>12} {'total, ms':>12}")
+    for name, r in results.items():
+        print(f"{name:<10} {r['import'] * 1000:>12.1f} {r['ready'] * 1000:>12.1f} {r['process'] * 1000:>12.1f}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""Бенчмарки горячих путей бота и API на нескольких объёмах данных.
+
+Запуск из корня проекта:
+
+    python -m benchmarks.suite --sizes 10,100,1000 --output results.json
+    python -m benchmarks.suite --compare results.json
+
+Для каждого размера создаётся отдельный пользователь с таким числом задач
+поверх фонового набора данных. /api/stats группирует по TO_CHAR PostgreSQL,
+поэтому на SQLite пропускаются только его замеры; остальные API-маршруты
+меряются на обеих базах.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+PERIODS = ('hour', 'day', 'week', 'month', 'year')
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(samples):
+    return {
+        'runs': len(samples),
+        'min_ms': round(min(samples) * 1000, 3),
+        'median_ms': round(statistics.median(samples) * 1000, 3),
+        'p95_ms': round(percentile(samples, 0.95) * 1000, 3),
+        'mean_ms': round(statistics.fmean(samples) * 1000, 3),
+    }
+
+
+def measure(fn, repeat, warmup=2):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def first_ids(handler, user_id):
+    conn = handler.get_connection()
+    cursor = handler.execute(conn, '''
+        SELECT id FROM tasks WHERE user_id = %s AND parent_id IS NULL ORDER BY id ASC LIMIT 1
+    ''', (user_id,))
+    task = handler.fetchone(cursor)
+    cursor.close()
+    cursor = handler.execute(conn, '''
+        SELECT id FROM tasks WHERE user_id = %s AND parent_id IS NOT NULL ORDER BY id ASC LIMIT 1
+    ''', (user_id,))
+    subtask = handler.fetchone(cursor)
+    cursor.close()
+    handler.close(conn)
+    return task['id'] if task else None, subtask['id'] if subtask else None
+
+
+def bot_cases(bot, user_id, task_id, subtask_id):
+    cases = {'bot.get_user_tasks': lambda: bot.get_user_tasks(user_id)}
+    for period in PERIODS:
+        cases[f'bot.get_stats[{period}]'] = lambda period=period: bot.get_stats(user_id, period)
+    if task_id:
+        cases['bot.toggle_task'] = lambda: bot.toggle_task(task_id, user_id)
+    if subtask_id:
+        cases['bot.toggle_subtask'] = lambda: bot.toggle_subtask(subtask_id, user_id)
+    return cases
+
+
+def api_cases(app_module, user_id, task_id, subtask_id, stats=True):
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+
+    def get(path):
+        response = client.get(path)
+        assert response.status_code == 200, (path, response.status_code)
+
+    def put(task, action):
+        response = client.put(f'/api/task/{task}', json={'action': action})
+        assert response.status_code == 200, (task, response.status_code)
+
+    cases = {'api.get_tasks': lambda: get('/api/tasks')}
+    for period in PERIODS if stats else ():
+        cases[f'api.get_stats[{period}]'] = lambda period=period: get(f'/api/stats/{period}')
+    if task_id:
+        cases['api.toggle'] = lambda: put(task_id, 'toggle')
+    if subtask_id:
+        cases['api.toggle_subtask'] = lambda: put(subtask_id, 'toggle_subtask')
+    return cases
+
+
+def compare(current, previous):
+    print(f"\n{'case':<32} {'size':>6} {'before, ms':>12} {'after, ms':>12} {'change':>8}")
+    for size, cases in current['results'].items():
+        for name, stats in cases.items():
+            before = previous.get('results', {}).get(size, {}).get(name)
+            if not before:
+                continue
+            change = (stats['median_ms'] - before['median_ms']) / before['median_ms'] * 100 if before['median_ms'] else 0
+            print(f"{name:<32} {size:>6} {before['median_ms']:>12.3f} {stats['median_ms']:>12.3f} {change:>+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', help='по умолчанию - временная база SQLite')
+    parser.add_argument('--sizes', default='10,100,1000', help='число задач у измеряемого пользователя')
+    parser.add_argument('--users', type=int, default=50, help='фоновые пользователи')
+    parser.add_argument('--tasks', type=int, default=20, help='задач у фонового пользователя')
+    parser.add_argument('--subtasks', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='сохранить результаты в JSON')
+    parser.add_argument('--compare', help='сравнить с результатами предыдущего запуска')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    tmp = None
+    if not args.database_url:
+        tmp = tempfile.TemporaryDirectory()
+        args.database_url = f"sqlite:///{os.path.join(tmp.name, 'bench.db')}"
+    # Модули приложения читают DATABASE_URL при импорте
+    os.environ['DATABASE_URL'] = args.database_url
+
+    import app as app_module
+    import bot
+    from benchmarks.seed import seed
+    from database import db_handler
+
+    rng = random.Random(args.seed)
+    print(f"Seeding {args.users} background users x {args.tasks} tasks...")
+    seed(db_handler, args.users, args.tasks, args.subtasks, rng)
+
+    results = {}
+    for size in sizes:
+        (user_id, _), = seed(db_handler, 1, size, args.subtasks, rng, prefix=f'bench_size{size}_')
+        task_id, subtask_id = first_ids(db_handler, user_id)
+
+        cases = bot_cases(bot, user_id, task_id, subtask_id)
+        cases.update(api_cases(app_module, user_id, task_id, subtask_id, stats=db_handler.use_postgresql))
+
+        results[str(size)] = {}
+        for name, fn in cases.items():
+            stats = measure(fn, args.repeat)
+            results[str(size)][name] = stats
+            print(f"{name:<32} {size:>6} tasks  median {stats['median_ms']:>9.3f} ms  p95 {stats['p95_ms']:>9.3f} ms")
+
+    if not db_handler.use_postgresql:
+        print("\napi.get_stats cases skipped: /api/stats needs PostgreSQL (TO_CHAR)")
+
+    report = {
+        'meta': {
+            'time': datetime.utcnow().isoformat(),
+            'revision': git_revision(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'backend': 'postgresql' if db_handler.use_postgresql else 'sqlite',
+            'sizes': sizes,
+            'background': {'users': args.users, 'tasks': args.tasks, 'subtasks': args.subtasks},
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"\n✓ Results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(report, json.load(f))
+
+    if tmp is not None:
+        tmp.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,27 @@
-import json
+import asyncio
 import os
+import time
+import traceback
+import archive
+import outbound
+import passwords
+import reminders
+import translations
 from datetime import datetime, timedelta
-from werkzeug.security import generate_password_hash, check_password_hash
 
 try:
-    from database import db_handler
+    from database import UserMoving, db_handler
 except ImportError:
     print("ERROR: database.py not found!")
     import sys
     sys.exit(1)
 
+from cache import TTLCache
+from metrics import METRICS_ENABLED
+from query_trace import QUERY_TRACING, query_tracer
+from throttle import login_throttle, register_throttle
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -18,10 +29,19 @@ from telegram.ext import (
     CallbackQueryHandler,
     ConversationHandler,
     ContextTypes,
+    TypeHandler,
     filters,
 )
 
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
+# Повторные нажатия той же кнопки в течение окна после действия поглощаются (0 - выключено)
+CALLBACK_COALESCE_MS = float(os.environ.get('CALLBACK_COALESCE_MS', '700'))
+RENDER_CACHE_SIZE = int(os.environ.get('RENDER_CACHE_SIZE', '4096'))
+# Виды сбрасываются по версии задач в БД; TTL только освобождает память от неиспользуемых
+RENDER_CACHE_TTL = float(os.environ.get('RENDER_CACHE_TTL', '60'))
+# Сколько секунд бот верит запомненной версии задач пользователя, не читая её из БД:
+# записи самого бота видны сразу, записи веб-приложения - не позже чем через это время
+TASK_VERSION_TTL = float(os.environ.get('TASK_VERSION_TTL', '5'))
 
 LANGUAGE_SELECT, AUTH_CHOICE, LOGIN_USERNAME, LOGIN_PASSWORD = range(4)
 REGISTER_USERNAME, REGISTER_PASSWORD = range(4, 6)
@@ -29,55 +49,97 @@ MAIN_MENU, ADD_TASK_TITLE, ADD_TASK_DESCRIPTION = range(6, 9)
 ADD_TASK_PRIORITY, ADD_TASK_DEADLINE, ADD_TASK_SUBTASKS = range(9, 12)
 ADD_SUBTASK_INPUT = 12
 
-def load_translations():
-    try:
-        with open('translation.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {}
+t = translations.t
+
+# Готовые (текст, клавиатура, parse_mode) списка и карточек задач
+render_cache = TTLCache(maxsize=RENDER_CACHE_SIZE, ttl=RENDER_CACHE_TTL)
+# user_id -> версия задач из task_versions; без записи версия читается из БД
+task_versions = TTLCache(maxsize=RENDER_CACHE_SIZE, ttl=TASK_VERSION_TTL)
 
-TRANSLATIONS = load_translations()
+def tasks_changed(user_id):
+    # После записи бота следующий показ сверится с БД
+    task_versions.pop(user_id)
 
-def t(lang, key):
-    return TRANSLATIONS.get(lang, {}).get(key, key)
+def cached_view(kind, user_id, lang, item, render):
+    # Версию в task_versions меняет любая запись задач - бот, веб-приложение или архивация;
+    # старые ключи просто вытесняются
+    version = task_versions.get(user_id)
+    if version is not None:
+        view = render_cache.get((kind, user_id, version, item, lang))
+        if view is not None:
+            return view
+    # Версия и строки читаются на одном соединении, версия первой: старые строки не попадут
+    # в кэш под новой версией, даже если реплики отстают по-разному
+    db = db_handler.get_read_connection(user_id)
+    try:
+        version = db_handler.tasks_version(db, user_id)
+        task_versions.set(user_id, version)
+        key = (kind, user_id, version, item, lang)
+        view = render_cache.get(key)
+        if view is None:
+            view = render(user_id, lang, item, db)
+            # None - показывать нечего (задачи нет); такой ответ не кэшируется
+            if view is not None:
+                render_cache.set(key, view)
+    finally:
+        db_handler.close(db)
+    return view
 
 def get_user_by_username(username):
-    db = db_handler.get_connection()
+    handler = db_handler.for_username(username)
+    if handler is None:
+        return None
+    db = handler.get_connection()
     cursor = db_handler.execute(db, 'SELECT * FROM users WHERE username = %s', (username,))
     user = db_handler.fetchone(cursor)
     cursor.close()
     db_handler.close(db)
     return user
 
-def create_user(username, password):
-    db = db_handler.get_connection()
-    hashed_pw = generate_password_hash(password)
-    try:
-        if db_handler.use_postgresql:
-            cursor = db_handler.execute(db, 'INSERT INTO users (username, password_hash) VALUES (%s, %s) RETURNING id', (username, hashed_pw))
-            user_id = db_handler.get_lastrowid(cursor, db)
-        else:
-            cursor = db_handler.execute(db, 'INSERT INTO users (username, password_hash) VALUES (%s, %s)', (username, hashed_pw))
-            user_id = db_handler.get_lastrowid(cursor)
-        
+def _create_user(db, user_id, username, hashed_pw):
+    if user_id is not None:
+        # С шардированием id выдаёт справочник пользователей
+        cursor = db_handler.execute(db, 'INSERT INTO users (id, username, password_hash) VALUES (%s, %s, %s)',
+                                    (user_id, username, hashed_pw))
         cursor.close()
-        db_handler.commit(db)
-        db_handler.close(db)
         return user_id
+    if db_handler.use_postgresql:
+        cursor = db_handler.execute(db, 'INSERT INTO users (username, password_hash) VALUES (%s, %s) RETURNING id', (username, hashed_pw))
+        user_id = db_handler.get_lastrowid(cursor, db)
+    else:
+        cursor = db_handler.execute(db, 'INSERT INTO users (username, password_hash) VALUES (%s, %s)', (username, hashed_pw))
+        user_id = db_handler.get_lastrowid(cursor)
+    cursor.close()
+    return user_id
+
+def create_user(username, hashed_pw):
+    try:
+        return db_handler.create_user(_create_user, username, hashed_pw)
     except Exception as e:
         print(f"Error creating user: {e}")
-        try:
-            cursor.close()
-        except:
-            pass
-        db_handler.close(db)
         return None
 
-def verify_password(user, password):
-    return check_password_hash(user['password_hash'], password)
+def _update_password_hash(db, user_id, password_hash):
+    cursor = db_handler.execute(db, 'UPDATE users SET password_hash = %s WHERE id = %s', (password_hash, user_id))
+    cursor.close()
+
+def update_password_hash(user_id, password_hash):
+    db_handler.write(_update_password_hash, user_id, password_hash, for_user=user_id, move_wait=0)
 
-def get_user_tasks(user_id):
-    db = db_handler.get_connection()
+async def verify_password(user, password):
+    ok, new_hash = await passwords.verify_password_async(user['password_hash'], password)
+    if ok and new_hash:
+        try:
+            update_password_hash(user['id'], new_hash)
+        except UserMoving:
+            # Перехеширование не срочное - пройдёт при следующем входе
+            pass
+    return ok
+
+def get_user_tasks(user_id, db=None):
+    own = db is None
+    if own:
+        db = db_handler.get_read_connection(user_id)
     cursor = db_handler.execute(db, '''
         SELECT * FROM tasks 
         WHERE user_id = %s AND parent_id IS NULL 
@@ -92,7 +154,7 @@ def get_user_tasks(user_id):
             SELECT * FROM tasks 
             WHERE parent_id = %s 
             ORDER BY id ASC
-        ''', (task_row['id'],))
+        ''', (task_row['id'],), prepare=len(tasks_rows) > 1)
         subtasks_rows = db_handler.fetchall(cursor)
         cursor.close()
         
@@ -122,49 +184,34 @@ def get_user_tasks(user_id):
         task_dict['computed_status'] = task_status
         tasks.append(task_dict)
     
-    db_handler.close(db)
+    if own:
+        db_handler.close(db)
     return tasks
 
-def add_task(user_id, title, description, priority, deadline, subtasks):
-    db = db_handler.get_connection()
-    
-    if db_handler.use_postgresql:
-        cursor = db_handler.execute(db, '''
-            INSERT INTO tasks (title, description, priority, user_id, deadline, status)
-            VALUES (%s, %s, %s, %s, %s, 'not_started')
-            RETURNING id
-        ''', (title, description, priority, user_id, deadline))
-        task_id = db_handler.get_lastrowid(cursor, db)
-    else:
-        cursor = db_handler.execute(db, '''
-            INSERT INTO tasks (title, description, priority, user_id, deadline, status)
-            VALUES (%s, %s, %s, %s, %s, 'not_started')
-        ''', (title, description, priority, user_id, deadline))
-        task_id = db_handler.get_lastrowid(cursor)
-    
-    cursor.close()
+def _add_task(db, user_id, title, description, priority, deadline, subtasks):
+    task_id = db_handler.insert_task(db, title=title, description=description, priority=priority,
+                                     user_id=user_id, deadline=deadline, status='not_started')
     
     if subtasks:
         for subtask in subtasks:
             if subtask.strip():
-                cursor = db_handler.execute(db, '''
-                    INSERT INTO tasks (title, user_id, parent_id, status)
-                    VALUES (%s, %s, %s, 'not_started')
-                ''', (subtask, user_id, task_id))
-                cursor.close()
+                db_handler.insert_task(db, title=subtask, user_id=user_id, parent_id=task_id, status='not_started')
     
-    db_handler.commit(db)
-    db_handler.close(db)
+    db_handler.touch_tasks(db, user_id)
     return task_id
 
-def toggle_task(task_id, user_id):
-    db = db_handler.get_connection()
+def add_task(user_id, title, description, priority, deadline, subtasks):
+    task_id = db_handler.write(_add_task, user_id, title, description, priority, deadline, subtasks,
+                               for_user=user_id, move_wait=0)
+    tasks_changed(user_id)
+    return task_id
+
+def _toggle_task(db, task_id, user_id):
     cursor = db_handler.execute(db, 'SELECT * FROM tasks WHERE id = %s', (task_id,))
     task = db_handler.fetchone(cursor)
     cursor.close()
     
     if not task or task['user_id'] != user_id:
-        db_handler.close(db)
         return False
     
     cursor = db_handler.execute(db, 'SELECT * FROM tasks WHERE parent_id = %s', (task_id,))
@@ -181,21 +228,23 @@ def toggle_task(task_id, user_id):
     if subtasks:
         for subtask in subtasks:
             cursor = db_handler.execute(db, 'UPDATE tasks SET status = %s, completed_at = %s WHERE id = %s', 
-                      (new_status, completed_at, subtask['id']))
+                      (new_status, completed_at, subtask['id']), prepare=len(subtasks) > 1)
             cursor.close()
     
-    db_handler.commit(db)
-    db_handler.close(db)
+    db_handler.touch_tasks(db, user_id)
     return True
 
-def toggle_subtask(subtask_id, user_id):
-    db = db_handler.get_connection()
+def toggle_task(task_id, user_id):
+    toggled = db_handler.write(_toggle_task, task_id, user_id, for_user=user_id, move_wait=0)
+    tasks_changed(user_id)
+    return toggled
+
+def _toggle_subtask(db, subtask_id, user_id):
     cursor = db_handler.execute(db, 'SELECT * FROM tasks WHERE id = %s', (subtask_id,))
     task = db_handler.fetchone(cursor)
     cursor.close()
     
     if not task or task['user_id'] != user_id:
-        db_handler.close(db)
         return False
     
     new_status = 'not_started' if task['status'] == 'done' else 'done'
@@ -204,12 +253,15 @@ def toggle_subtask(subtask_id, user_id):
               (new_status, completed_at, subtask_id))
     cursor.close()
     
-    db_handler.commit(db)
-    db_handler.close(db)
+    db_handler.touch_tasks(db, user_id)
     return True
 
-def delete_task(task_id, user_id):
-    db = db_handler.get_connection()
+def toggle_subtask(subtask_id, user_id):
+    toggled = db_handler.write(_toggle_subtask, subtask_id, user_id, for_user=user_id, move_wait=0)
+    tasks_changed(user_id)
+    return toggled
+
+def _delete_task(db, task_id, user_id):
     cursor = db_handler.execute(db, 'SELECT * FROM tasks WHERE id = %s', (task_id,))
     task = db_handler.fetchone(cursor)
     cursor.close()
@@ -217,15 +269,18 @@ def delete_task(task_id, user_id):
     if task and task['user_id'] == user_id:
         cursor = db_handler.execute(db, 'DELETE FROM tasks WHERE id = %s OR parent_id = %s', (task_id, task_id))
         cursor.close()
-        db_handler.commit(db)
-        db_handler.close(db)
+        db_handler.touch_tasks(db, user_id)
         return True
     
-    db_handler.close(db)
     return False
 
+def delete_task(task_id, user_id):
+    deleted = db_handler.write(_delete_task, task_id, user_id, for_user=user_id, move_wait=0)
+    tasks_changed(user_id)
+    return deleted
+
 def get_stats(user_id, period):
-    db = db_handler.get_connection()
+    db = db_handler.get_read_connection(user_id)
     
     cursor = db_handler.execute(db, '''
         SELECT * FROM tasks WHERE user_id = %s AND parent_id IS NULL
@@ -238,7 +293,7 @@ def get_stats(user_id, period):
     done = 0
     
     for task in all_tasks:
-        cursor = db_handler.execute(db, 'SELECT * FROM tasks WHERE parent_id = %s', (task['id'],))
+        cursor = db_handler.execute(db, 'SELECT * FROM tasks WHERE parent_id = %s', (task['id'],), prepare=len(all_tasks) > 1)
         subtasks = db_handler.fetchall(cursor)
         cursor.close()
         
@@ -256,6 +311,14 @@ def get_stats(user_id, period):
             else:
                 not_started += 1
     
+    # Архивируются только полностью выполненные задачи
+    cursor = db_handler.execute(db, '''
+        SELECT COUNT(*) as count FROM tasks_archive WHERE user_id = %s AND parent_id IS NULL
+    ''', (user_id,))
+    archived = db_handler.fetchone(cursor)['count']
+    cursor.close()
+    done += archived
+    
     now = datetime.now()
     
     if db_handler.use_postgresql:
@@ -283,7 +346,7 @@ def get_stats(user_id, period):
     
     cursor = db_handler.execute(db, f'''
         SELECT {group_by} as period, COUNT(*) as count
-        FROM tasks
+        FROM tasks_history
         WHERE user_id = %s AND status = 'done' AND completed_at IS NOT NULL 
               AND parent_id IS NULL AND completed_at >= %s
         GROUP BY {group_by}
@@ -296,7 +359,7 @@ def get_stats(user_id, period):
     
     cursor = db_handler.execute(db, '''
         SELECT priority, COUNT(*) as count
-        FROM tasks
+        FROM tasks_history
         WHERE user_id = %s AND parent_id IS NULL
         GROUP BY priority
     ''', (user_id,))
@@ -307,7 +370,7 @@ def get_stats(user_id, period):
     
     cursor = db_handler.execute(db, f'''
         SELECT {group_by} as period, COUNT(*) as count
-        FROM tasks
+        FROM tasks_history
         WHERE user_id = %s AND status = 'done' AND completed_at IS NOT NULL AND parent_id IS NULL
         GROUP BY {group_by}
         ORDER BY count DESC
@@ -329,7 +392,7 @@ def get_stats(user_id, period):
         'productivity': productivity,
         'priorities': priorities,
         'top_periods': top_periods,
-        'total': len(all_tasks)
+        'total': len(all_tasks) + archived
     }
 
 def format_stats_text(stats, lang, period):
@@ -364,6 +427,48 @@ def format_stats_text(stats, lang, period):
     
     return text
 
+def tap_key(query):
+    # Дубли приходят с одного и того же сообщения; то же действие с другого сообщения - новое нажатие
+    message_id = query.message.message_id if query.message else query.inline_message_id
+    return f"{message_id}:{query.data}"
+
+def claim_tap(context, key):
+    """True - нажатие начинает новую серию; False - повтор, который поглощает уже начатое действие."""
+    if CALLBACK_COALESCE_MS <= 0:
+        return True
+    taps = context.chat_data.setdefault('taps', {})
+    now = time.monotonic()
+    busy_until = taps.get(key)
+    if busy_until is not None and busy_until > now:
+        # Серия продлевается, пока пользователь продолжает жать; пока действие идёт, срок бесконечен
+        taps[key] = max(busy_until, now + CALLBACK_COALESCE_MS / 1000.0)
+        return False
+    for expired in [k for k, until in taps.items() if until <= now]:
+        del taps[expired]
+    taps[key] = float('inf')
+    return True
+
+def release_tap(context, key):
+    if CALLBACK_COALESCE_MS > 0:
+        context.chat_data['taps'][key] = time.monotonic() + CALLBACK_COALESCE_MS / 1000.0
+
+async def edit_message(query, context, text, reply_markup=None, parse_mode=None):
+    # Последний отправленный вид сообщения: одинаковую правку Telegram всё равно отклонит
+    rendered = context.chat_data.setdefault('rendered', {})
+    key = query.message.message_id if query.message else query.inline_message_id
+    signature = (text, parse_mode, reply_markup.to_json() if reply_markup else None)
+    if rendered.get(key) == signature:
+        return
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+    except BadRequest as e:
+        if 'not modified' not in str(e).lower():
+            raise
+    rendered.pop(key, None)
+    rendered[key] = signature
+    while len(rendered) > 8:
+        del rendered[next(iter(rendered))]
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
         [InlineKeyboardButton("🇬🇧 EN", callback_data="lang_en"),
@@ -393,7 +498,7 @@ async def language_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     welcome_text = f"{t(lang, 'bot_welcome')}\n\n{t(lang, 'bot_auth_prompt')}"
-    await query.edit_message_text(welcome_text, reply_markup=reply_markup)
+    await edit_message(query, context, welcome_text, reply_markup=reply_markup)
     
     return AUTH_CHOICE
 
@@ -406,7 +511,7 @@ async def auth_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     context.user_data['auth_type'] = choice
     
-    await query.edit_message_text(t(lang, 'bot_enter_username'))
+    await edit_message(query, context, t(lang, 'bot_enter_username'))
     
     if choice == 'login':
         return LOGIN_USERNAME
@@ -425,11 +530,16 @@ async def login_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = context.user_data['username']
     password = update.message.text.strip()
     
+    if not login_throttle.allow(username, update.effective_user.id):
+        await update.message.reply_text(t(lang, 'error_too_many_attempts'))
+        return LOGIN_PASSWORD
+    
     user = get_user_by_username(username)
     
-    if user and verify_password(user, password):
+    if user and await verify_password(user, password):
         context.user_data['user_id'] = user['id']
         context.user_data['username'] = username
+        reminders.remember_chat(user['id'], update.effective_chat.id, lang)
         
         success_text = t(lang, 'bot_login_success').format(username)
         await update.message.reply_text(success_text)
@@ -460,15 +570,21 @@ async def register_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = context.user_data['username']
     password = update.message.text.strip()
     
+    if not register_throttle.allow(username, update.effective_user.id):
+        await update.message.reply_text(t(lang, 'error_too_many_attempts'))
+        return REGISTER_PASSWORD
+    
     if len(password) < 8:
         await update.message.reply_text(t(lang, 'error_pass_short') + "\n\n" + t(lang, 'bot_enter_password'))
         return REGISTER_PASSWORD
     
-    user_id = create_user(username, password)
+    hashed_pw = await passwords.hash_password_async(password)
+    user_id = create_user(username, hashed_pw)
     
     if user_id:
         context.user_data['user_id'] = user_id
         context.user_data['username'] = username
+        reminders.remember_chat(user_id, update.effective_chat.id, lang)
         
         success_text = t(lang, 'bot_register_success').format(username)
         await update.message.reply_text(success_text)
@@ -502,7 +618,7 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if update.callback_query:
         try:
-            await update.callback_query.edit_message_text(text, reply_markup=reply_markup)
+            await edit_message(update.callback_query, context, text, reply_markup=reply_markup)
         except:
             await update.callback_query.message.reply_text(text, reply_markup=reply_markup)
     else:
@@ -528,21 +644,12 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     return MAIN_MENU
 
-async def show_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE, page=0):
-    lang = context.user_data.get('lang', 'en')
-    user_id = context.user_data.get('user_id')
-    
-    tasks = get_user_tasks(user_id)
+def render_task_list(user_id, lang, page, db=None):
+    tasks = get_user_tasks(user_id, db)
     
     if not tasks:
         keyboard = [[InlineKeyboardButton(t(lang, 'bot_back'), callback_data="menu_main")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await update.callback_query.edit_message_text(
-            t(lang, 'bot_no_tasks'),
-            reply_markup=reply_markup
-        )
-        return
+        return t(lang, 'bot_no_tasks'), InlineKeyboardMarkup(keyboard), None
     
     tasks_per_page = 5
     total_pages = (len(tasks) + tasks_per_page - 1) // tasks_per_page
@@ -587,13 +694,14 @@ async def show_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE, page=0)
     
     keyboard.append([InlineKeyboardButton(t(lang, 'bot_back'), callback_data="menu_main")])
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    return text, InlineKeyboardMarkup(keyboard), 'Markdown'
+
+async def show_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE, page=0):
+    lang = context.user_data.get('lang', 'en')
+    user_id = context.user_data.get('user_id')
     
-    await update.callback_query.edit_message_text(
-        text,
-        reply_markup=reply_markup,
-        parse_mode='Markdown'
-    )
+    text, reply_markup, parse_mode = cached_view('list', user_id, lang, page, render_task_list)
+    await edit_message(update.callback_query, context, text, reply_markup=reply_markup, parse_mode=parse_mode)
 
 async def task_page_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -608,16 +716,15 @@ async def task_detail_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     await query.answer()
     
-    lang = context.user_data.get('lang', 'en')
     task_id = int(query.data.split('_')[1])
-    user_id = context.user_data.get('user_id')
-    
-    tasks = get_user_tasks(user_id)
+    return await show_task_detail(update, context, task_id)
+
+def render_task_detail(user_id, lang, task_id, db=None):
+    tasks = get_user_tasks(user_id, db)
     task = next((t for t in tasks if t['id'] == task_id), None)
     
     if not task:
-        await query.edit_message_text("Error")
-        return MAIN_MENU
+        return None
     
     status_emoji = "✅" if task['computed_status'] == 'done' else "⏳" if task['computed_status'] == 'in_progress' else "📋"
     task_priority = task.get('priority', 'medium')
@@ -662,9 +769,15 @@ async def task_detail_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
             )])
         keyboard = subtask_buttons + keyboard
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    return text, InlineKeyboardMarkup(keyboard), 'Markdown'
+
+async def show_task_detail(update: Update, context: ContextTypes.DEFAULT_TYPE, task_id):
+    lang = context.user_data.get('lang', 'en')
+    user_id = context.user_data.get('user_id')
     
-    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+    view = cached_view('detail', user_id, lang, task_id, render_task_detail)
+    text, reply_markup, parse_mode = view if view is not None else ("Error", None, None)
+    await edit_message(update.callback_query, context, text, reply_markup=reply_markup, parse_mode=parse_mode)
     
     return MAIN_MENU
 
@@ -675,12 +788,16 @@ async def toggle_task_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     task_id = int(query.data.split('_')[1])
     user_id = context.user_data.get('user_id')
     
-    toggle_task(task_id, user_id)
-    
     await query.answer(t(lang, 'bot_task_completed'))
+    key = tap_key(query)
+    if not claim_tap(context, key):
+        return MAIN_MENU
     
-    query.data = f"task_{task_id}"
-    await task_detail_handler(update, context)
+    try:
+        toggle_task(task_id, user_id)
+        await show_task_detail(update, context, task_id)
+    finally:
+        release_tap(context, key)
     
     return MAIN_MENU
 
@@ -691,20 +808,25 @@ async def toggle_subtask_handler(update: Update, context: ContextTypes.DEFAULT_T
     subtask_id = int(query.data.split('_')[1])
     user_id = context.user_data.get('user_id')
     
-    toggle_subtask(subtask_id, user_id)
-    
-    db = db_handler.get_connection()
-    cursor = db_handler.execute(db, 'SELECT parent_id FROM tasks WHERE id = %s', (subtask_id,))
-    parent = db_handler.fetchone(cursor)
-    cursor.close()
-    db_handler.close(db)
-    
     await query.answer(t(lang, 'bot_task_completed'))
+    key = tap_key(query)
+    if not claim_tap(context, key):
+        return MAIN_MENU
     
-    if parent:
-        parent_id = parent['parent_id']
-        query.data = f"task_{parent_id}"
-        await task_detail_handler(update, context)
+    try:
+        toggle_subtask(subtask_id, user_id)
+        
+        db = db_handler.get_read_connection(user_id, pinned=True)
+        cursor = db_handler.execute(db, 'SELECT parent_id FROM tasks WHERE id = %s', (subtask_id,))
+        parent = db_handler.fetchone(cursor)
+        cursor.close()
+        db_handler.close(db)
+        
+        if parent:
+            parent_id = parent['parent_id']
+            await show_task_detail(update, context, parent_id)
+    finally:
+        release_tap(context, key)
     
     return MAIN_MENU
 
@@ -726,7 +848,7 @@ async def delete_task_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     confirm_text = t(lang, 'bot_confirm_delete').format(task['title'])
-    await query.edit_message_text(confirm_text, reply_markup=reply_markup)
+    await edit_message(query, context, confirm_text, reply_markup=reply_markup)
     
     return MAIN_MENU
 
@@ -749,7 +871,7 @@ async def start_add_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     context.user_data['new_task'] = {}
     
-    await update.callback_query.edit_message_text(t(lang, 'bot_enter_task_title'))
+    await edit_message(update.callback_query, context, t(lang, 'bot_enter_task_title'))
     
     return ADD_TASK_TITLE
 
@@ -790,7 +912,7 @@ async def add_task_priority(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     context.user_data['new_task']['priority'] = priority
     
-    await query.edit_message_text(t(lang, 'bot_enter_deadline'))
+    await edit_message(query, context, t(lang, 'bot_enter_deadline'))
     
     return ADD_TASK_DEADLINE
 
@@ -838,7 +960,7 @@ async def add_task_subtasks_choice(update: Update, context: ContextTypes.DEFAULT
             []
         )
         
-        await query.edit_message_text(t(lang, 'bot_task_added'))
+        await edit_message(query, context, t(lang, 'bot_task_added'))
         
         keyboard = [[InlineKeyboardButton(t(lang, 'bot_back'), callback_data="menu_main")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -850,7 +972,7 @@ async def add_task_subtasks_choice(update: Update, context: ContextTypes.DEFAULT
         context.user_data['subtask_count'] = 1
         
         subtask_prompt = t(lang, 'bot_enter_subtask').format(1)
-        await query.edit_message_text(subtask_prompt)
+        await edit_message(query, context, subtask_prompt)
         
         return ADD_SUBTASK_INPUT
 
@@ -898,7 +1020,7 @@ async def show_stats_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await update.callback_query.edit_message_text(
+    await edit_message(update.callback_query, context, 
         t(lang, 'bot_stats_period'),
         reply_markup=reply_markup
     )
@@ -917,7 +1039,7 @@ async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [[InlineKeyboardButton(t(lang, 'bot_back'), callback_data="menu_main")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await query.edit_message_text(stats_text, reply_markup=reply_markup, parse_mode='Markdown')
+    await edit_message(query, context, stats_text, reply_markup=reply_markup, parse_mode='Markdown')
     
     return MAIN_MENU
 
@@ -931,7 +1053,7 @@ async def show_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await update.callback_query.edit_message_text(
+    await edit_message(update.callback_query, context, 
         t(lang, 'bot_settings'),
         reply_markup=reply_markup
     )
@@ -952,7 +1074,7 @@ async def settings_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await query.edit_message_text(
+        await edit_message(query, context, 
             t(lang, 'bot_select_language'),
             reply_markup=reply_markup
         )
@@ -963,7 +1085,7 @@ async def settings_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await query.edit_message_text(
+        await edit_message(query, context, 
             t(lang, 'bot_confirm_logout'),
             reply_markup=reply_markup
         )
@@ -975,6 +1097,8 @@ async def set_language_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     
     new_lang = query.data.split('_')[1]
     context.user_data['lang'] = new_lang
+    if context.user_data.get('user_id'):
+        reminders.remember_chat(context.user_data['user_id'], update.effective_chat.id, new_lang)
     
     await query.answer(t(new_lang, 'bot_change_language'))
     await show_main_menu(update, context)
@@ -985,6 +1109,8 @@ async def logout_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     
     lang = context.user_data.get('lang', 'en')
+    if context.user_data.get('user_id'):
+        reminders.forget_chat(context.user_data['user_id'])
     
     context.user_data.clear()
     context.user_data['lang'] = lang
@@ -997,7 +1123,7 @@ async def logout_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     await query.answer(t(lang, 'bot_logout'))
-    await query.edit_message_text(
+    await edit_message(query, context, 
         "🌐 Choose language / Выберите язык / Tilni tanlang:",
         reply_markup=reply_markup
     )
@@ -1014,8 +1140,54 @@ async def restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     return await start(update, context)
 
-def main():
-    application = Application.builder().token(BOT_TOKEN).build()
+async def reload_translations_hook(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if translations.maybe_reload():
+        render_cache.clear()
+
+def wrap_conversation_callbacks(conv_handler, wrap):
+    handlers = list(conv_handler.entry_points) + list(conv_handler.fallbacks)
+    for state_handlers in conv_handler.states.values():
+        handlers.extend(state_handlers)
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            wrap_conversation_callbacks(handler, wrap)
+        else:
+            handler.callback = wrap(handler.callback)
+
+async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    # Записи бота не ждут переноса пользователя на другой шард, чтобы не останавливать цикл событий
+    if isinstance(context.error, UserMoving) and isinstance(update, Update) and update.effective_chat:
+        lang = context.user_data.get('lang', 'en') if context.user_data is not None else 'en'
+        await context.bot.send_message(update.effective_chat.id, t(lang, 'bot_try_again'))
+        return
+    print(f"⚠ Error while handling an update: {context.error!r}")
+    traceback.print_exception(context.error)
+
+async def archive_job(context: ContextTypes.DEFAULT_TYPE):
+    # Перенос идёт пачками в отдельном потоке, чтобы не блокировать обработку апдейтов
+    moved = await asyncio.to_thread(archive.archive_completed_tasks)
+    if moved:
+        task_versions.clear()
+        print(f"Archived {moved} completed tasks")
+
+def build_application(token=None, ready=None, builder=None, instrument=METRICS_ENABLED):
+    if instrument:
+        import bot_metrics
+    if builder is None:
+        builder = Application.builder().token(token or BOT_TOKEN)
+        if instrument:
+            builder = bot_metrics.instrument_builder(builder)
+    if outbound.OUTBOUND_QUEUE:
+        # Все исходящие вызовы с chat_id идут через общую очередь с учётом лимитов Telegram
+        dispatcher = outbound.OutboundDispatcher()
+        builder = builder.rate_limiter(dispatcher)
+        if instrument:
+            bot_metrics.instrument_dispatcher(dispatcher)
+    if ready is not None:
+        async def signal_ready(application):
+            ready.set()
+        builder = builder.post_init(signal_ready)
+    application = builder.build()
     
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('start', start)],
@@ -1077,7 +1249,38 @@ def main():
         allow_reentry=True,
     )
     
+    if QUERY_TRACING:
+        query_tracer.install(db_handler)
+        wrap_conversation_callbacks(conv_handler, query_tracer.trace_callback)
+    if instrument:
+        wrap_conversation_callbacks(conv_handler, bot_metrics.instrument_callback)
+    
+    application.add_handler(TypeHandler(Update, reload_translations_hook), group=-1)
     application.add_handler(conv_handler)
+    application.add_error_handler(on_error)
+    
+    # Одна повторяющаяся задача на всё: без таймеров на каждого пользователя или задачу
+    if reminders.REMINDERS_ENABLED:
+        if application.job_queue is None:
+            print("⚠ Deadline reminders need JobQueue: pip install 'python-telegram-bot[job-queue]'")
+        else:
+            application.job_queue.run_repeating(reminders.reminder_job, interval=reminders.REMINDER_INTERVAL,
+                                                first=30, name='reminders')
+    if archive.ARCHIVE_AFTER_DAYS > 0:
+        if application.job_queue is None:
+            print("⚠ ARCHIVE_AFTER_DAYS is set but JobQueue is unavailable (pip install 'python-telegram-bot[job-queue]'); "
+                  "run python archive.py from cron instead")
+        else:
+            application.job_queue.run_repeating(archive_job, interval=archive.ARCHIVE_INTERVAL, first=60,
+                                                name='archive')
+    return application
+
+def main(ready=None):
+    translations.catalog.load()
+    application = build_application(ready=ready)
+    if METRICS_ENABLED:
+        import bot_metrics
+        bot_metrics.start_exporters()
     
     db_type = 'PostgreSQL' if db_handler.use_postgresql else 'SQLite'
     print(f"Bot started successfully! (Using {db_type})")
@@ -0,0 +1,90 @@
+import functools
+import os
+import time
+
+from telegram.request import HTTPXRequest
+
+import passwords
+from metrics import Registry, outbound_metrics, password_hash_metrics, throttle_metrics
+from throttle import login_throttle, register_throttle
+
+BOT_METRICS_PORT = int(os.environ.get('BOT_METRICS_PORT', '0'))
+BOT_METRICS_DUMP_INTERVAL = float(os.environ.get('BOT_METRICS_DUMP_INTERVAL', '0'))
+BOT_METRICS_DUMP_PATH = os.environ.get('BOT_METRICS_DUMP_PATH')
+
+registry = Registry()
+handler_latency = registry.histogram(
+    'bot_handler_duration_seconds', 'Conversation handler callback latency', ('handler',))
+handler_errors = registry.counter(
+    'bot_handler_errors_total', 'Conversation handler callbacks that raised', ('handler',))
+handlers_in_flight = registry.gauge(
+    'bot_handlers_in_flight', 'Conversation handler callbacks currently running', ('handler',))
+api_latency = registry.histogram(
+    'bot_api_duration_seconds', 'Telegram Bot API call latency', ('method',))
+api_errors = registry.counter(
+    'bot_api_errors_total', 'Telegram Bot API calls that failed', ('method', 'status'))
+api_in_flight = registry.gauge(
+    'bot_api_in_flight', 'Telegram Bot API calls currently in progress', ('method',))
+registry.add_collector(password_hash_metrics(passwords.hasher))
+registry.add_collector(throttle_metrics(login_throttle, register_throttle))
+
+
+def instrument_callback(callback):
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        handlers_in_flight.inc(name)
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_latency.observe(name, value=time.perf_counter() - started)
+            handlers_in_flight.dec(name)
+
+    return wrapper
+
+
+class InstrumentedRequest(HTTPXRequest):
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        api_in_flight.inc(api_method)
+        started = time.perf_counter()
+        try:
+            status, payload = await super().do_request(
+                url, method, request_data=request_data, read_timeout=read_timeout,
+                write_timeout=write_timeout, connect_timeout=connect_timeout, pool_timeout=pool_timeout)
+        except Exception as e:
+            api_errors.inc(api_method, type(e).__name__)
+            raise
+        finally:
+            api_latency.observe(api_method, value=time.perf_counter() - started)
+            api_in_flight.dec(api_method)
+        if status >= 400:
+            api_errors.inc(api_method, str(status))
+        return status, payload
+
+
+def instrument_builder(builder):
+    # Те же размеры пулов, что ApplicationBuilder выставляет по умолчанию
+    return (builder
+            .request(InstrumentedRequest(connection_pool_size=256))
+            .get_updates_request(InstrumentedRequest(connection_pool_size=1)))
+
+
+def instrument_dispatcher(dispatcher):
+    registry.add_collector(outbound_metrics(dispatcher))
+
+
+def start_exporters():
+    from metrics import dump_metrics_periodically, serve_metrics
+
+    if BOT_METRICS_PORT:
+        serve_metrics(registry, BOT_METRICS_PORT)
+        print(f"✓ Bot metrics on http://127.0.0.1:{BOT_METRICS_PORT}/metrics")
+    if BOT_METRICS_DUMP_INTERVAL:
+        dump_metrics_periodically(registry, BOT_METRICS_DUMP_INTERVAL, BOT_METRICS_DUMP_PATH)
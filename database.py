@@ -1,44 +1,739 @@
+import hashlib
+import itertools
 import os
+import queue
+import re
 import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+
+from cache import TTLCache
 
 DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///site.db')
-USE_POSTGRESQL = DATABASE_URL.startswith(('postgresql', 'postgres'))
 
-print(f"[Database Config]")
-print(f"  DATABASE_URL: {DATABASE_URL[:50]}...")
-print(f"  Type: {'PostgreSQL' if USE_POSTGRESQL else 'SQLite'}")
+# Продакшен-режим SQLite: WAL и прагмы на каждом соединении (0 - настройки sqlite3 по умолчанию)
+SQLITE_TUNING = os.environ.get('SQLITE_TUNING', '1') == '1'
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL').upper()
+SQLITE_CACHE_SIZE_KB = int(os.environ.get('SQLITE_CACHE_SIZE_KB', '16384'))
+SQLITE_MMAP_SIZE_MB = int(os.environ.get('SQLITE_MMAP_SIZE_MB', '128'))
+# Фоновый checkpoint WAL в каждом процессе (0 - только автоматический checkpoint SQLite)
+SQLITE_CHECKPOINT_INTERVAL = float(os.environ.get('SQLITE_CHECKPOINT_INTERVAL', '60'))
+SQLITE_CHECKPOINT_MODE = os.environ.get('SQLITE_CHECKPOINT_MODE', 'PASSIVE').upper()
+
+# Очередь записи: все записи процесса идут через один поток и коммитятся группами (только SQLite)
+SQLITE_WRITE_QUEUE = os.environ.get('SQLITE_WRITE_QUEUE', '0') == '1'
+WRITE_BATCH_SIZE = int(os.environ.get('WRITE_BATCH_SIZE', '64'))
+# Сколько самая старая операция в пачке может ждать попутчиков до коммита
+WRITE_BATCH_DELAY_MS = float(os.environ.get('WRITE_BATCH_DELAY_MS', '2'))
+WRITE_TIMEOUT = float(os.environ.get('WRITE_TIMEOUT', '30'))
+
+# Горячие запросы PostgreSQL готовятся (PREPARE) один раз на соединение.
+# Выключите за PgBouncer в режиме transaction pooling
+PREPARED_STATEMENTS = os.environ.get('PREPARED_STATEMENTS', '1') == '1'
+
+# Реплики только для чтения, через запятую; тот же тип базы, что и DATABASE_URL
+DATABASE_REPLICA_URLS = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+# Как часто проверять живую реплику и через сколько повторять попытку после сбоя, секунды
+REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL', '10'))
+REPLICA_RETRY_INTERVAL = float(os.environ.get('REPLICA_RETRY_INTERVAL', '30'))
+# Сколько секунд после записи пользователь читает с основной базы (read-your-writes)
+READ_YOUR_WRITES_WINDOW = float(os.environ.get('READ_YOUR_WRITES_WINDOW', '5'))
+
+# Шардирование по пользователям: базы-шарды через запятую, тот же тип базы, что и DATABASE_URL.
+# DATABASE_URL тогда хранит справочник user_directory: username -> (user_id, шард)
+DATABASE_SHARD_URLS = [url.strip() for url in os.environ.get('DATABASE_SHARD_URLS', '').split(',') if url.strip()]
+# Сколько секунд процесс помнит, на каком шарде пользователь
+SHARD_MAP_TTL = float(os.environ.get('SHARD_MAP_TTL', '5'))
+# Сколько запись из веб-приложения и фоновых задач ждёт пользователя, которого сейчас переносят
+# на другой шард (shards.py move); бот не ждёт и просит повторить действие
+SHARD_MOVE_WAIT = float(os.environ.get('SHARD_MOVE_WAIT', '30'))
+# Шард i выдаёт id задач из [i * SHARD_ID_STRIDE, (i + 1) * SHARD_ID_STRIDE): id уникальны везде
+# и не конфликтуют при переносе (на SQLite - через счётчик шарда, см. insert_task)
+SHARD_ID_STRIDE = int(os.environ.get('SHARD_ID_STRIDE', '100000000'))
+
+# Колонки tasks в порядке, общем для tasks, tasks_archive и представления tasks_history
+TASK_COLUMNS = ('id', 'title', 'description', 'status', 'priority', 'deadline', 'user_id', 'parent_id',
+                'created_at', 'completed_at')
+
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+CHECKPOINT_MODES = ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE')
+
+
+class UserMoving(TimeoutError):
+    """Пользователя переносят на другой шард: запись можно повторить чуть позже."""
+
+
+def is_postgresql_url(url):
+    return url.startswith(('postgresql', 'postgres'))
+
+
+def numbered_placeholders(query):
+    """%s -> $1, $2, ... для PREPARE; %% в тексте без параметров становится %."""
+    counter = itertools.count(1)
+    parts = query.split('%%')
+    return '%'.join(re.sub(r'%s', lambda _: f'${next(counter)}', part) for part in parts)
+
+
+def statement_name(query):
+    # Имя зависит только от текста, поэтому одинаково во всех соединениях и процессах
+    return 'ps_' + hashlib.sha1(query.encode('utf-8')).hexdigest()[:16]
+
+
+def safe_url(url):
+    # Логин и пароль из URL в логи не попадают
+    return re.sub(r'//[^/@]*@', '//***@', url)
+
+
+class TracedCursor:
+    def __init__(self, cursor, listeners):
+        self._cursor = cursor
+        self._listeners = listeners
+
+    def _notify(self, query, params, seconds):
+        for listener in self._listeners:
+            listener(query, params, seconds)
+
+    def execute(self, query, params=None):
+        started = time.perf_counter()
+        try:
+            if params is None:
+                return self._cursor.execute(query)
+            return self._cursor.execute(query, params)
+        finally:
+            self._notify(query, params, time.perf_counter() - started)
+
+    def executemany(self, query, seq_of_params):
+        started = time.perf_counter()
+        try:
+            return self._cursor.executemany(query, seq_of_params)
+        finally:
+            self._notify(query, None, time.perf_counter() - started)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class TracedConnection:
+    def __init__(self, conn, listeners):
+        self._conn = conn
+        self._listeners = listeners
+
+    def cursor(self, *args, **kwargs):
+        return TracedCursor(self._conn.cursor(*args, **kwargs), self._listeners)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class WalCheckpointer:
+    """Фоновый поток, периодически переносящий WAL в основной файл базы."""
+
+    def __init__(self, db_path, interval, mode=SQLITE_CHECKPOINT_MODE):
+        if mode not in CHECKPOINT_MODES:
+            raise ValueError(f"SQLITE_CHECKPOINT_MODE must be one of {', '.join(CHECKPOINT_MODES)}")
+        self.db_path = db_path
+        self.interval = interval
+        self.mode = mode
+        self.runs = 0
+        self.busy = 0
+        self.last_result = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='sqlite-checkpoint', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def checkpoint(self):
+        conn = sqlite3.connect(self.db_path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000.0)
+        try:
+            # (busy, страниц в WAL, перенесено страниц)
+            busy, log_pages, moved = conn.execute(f'PRAGMA wal_checkpoint({self.mode})').fetchone()
+        finally:
+            conn.close()
+        self.runs += 1
+        self.busy += busy
+        self.last_result = (busy, log_pages, moved)
+        return self.last_result
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.checkpoint()
+            except sqlite3.Error as e:
+                print(f"[sqlite] checkpoint failed: {e}")
+
+
+class WriteCoordinator:
+    """Единственный писатель процесса: выполняет fn(conn, *args) пачками в одной транзакции.
 
-if USE_POSTGRESQL:
-    try:
-        import psycopg2
-        from psycopg2.extras import RealDictCursor
+    Каждая операция идёт в своей точке сохранения, поэтому ошибка одной операции
+    откатывает только её, а вызывающий получает свой результат или исключение.
+    """
 
-        HAS_PSYCOPG2 = True
-        print(f"  psycopg2: Available")
-    except ImportError:
-        print("  psycopg2: NOT INSTALLED - Falling back to SQLite")
-        HAS_PSYCOPG2 = False
-        USE_POSTGRESQL = False
-        DATABASE_URL = 'sqlite:///site.db'
-else:
-    HAS_PSYCOPG2 = False
-    print(f"  psycopg2: Not needed")
+    def __init__(self, handler, batch_size=WRITE_BATCH_SIZE, batch_delay_ms=WRITE_BATCH_DELAY_MS):
+        self.handler = handler
+        self.batch_size = max(1, batch_size)
+        self.batch_delay = batch_delay_ms / 1000.0
+        self.batches = 0
+        self.operations = 0
+        self.failed_commits = 0
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        self._queue.put((time.monotonic(), future, fn, args, kwargs))
+        return future
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'operations': self.operations,
+            'failed_commits': self.failed_commits,
+            'avg_batch': self.operations / self.batches if self.batches else 0.0,
+            'queued': self._queue.qsize(),
+        }
+
+    def _collect(self):
+        first = self._queue.get()
+        batch = [first]
+        deadline = first[0] + self.batch_delay
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        conn = None
+        while True:
+            batch = self._collect()
+            try:
+                if conn is None:
+                    conn = self.handler.get_connection()
+                self._commit_batch(conn, batch)
+            except Exception as e:
+                self.failed_commits += 1
+                for _, future, _, _, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                if conn is not None:
+                    try:
+                        conn.rollback()
+                        conn.close()
+                    except sqlite3.Error:
+                        pass
+                    conn = None
+
+    def _commit_batch(self, conn, batch):
+        results = []
+        cursor = conn.cursor()
+        # IMMEDIATE берёт блокировку записи сразу, а не при первом UPDATE
+        cursor.execute('BEGIN IMMEDIATE')
+        for _, future, fn, args, kwargs in batch:
+            if not future.set_running_or_notify_cancel():
+                continue
+            cursor.execute('SAVEPOINT write_op')
+            try:
+                result = fn(conn, *args, **kwargs)
+            except Exception as e:
+                cursor.execute('ROLLBACK TO SAVEPOINT write_op')
+                cursor.execute('RELEASE SAVEPOINT write_op')
+                results.append((future, None, e))
+            else:
+                cursor.execute('RELEASE SAVEPOINT write_op')
+                results.append((future, result, None))
+        conn.commit()
+        cursor.close()
+        self.batches += 1
+        self.operations += len(results)
+        # Результаты отдаём только после коммита: вызывающий не увидит незафиксированную запись
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+class Replica:
+    def __init__(self, url, check_interval=REPLICA_CHECK_INTERVAL, retry_interval=REPLICA_RETRY_INTERVAL):
+        self.url = url
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        self.healthy = True
+        self.checked_at = 0.0
+        self.retry_at = 0.0
+        self.failures = 0
+        self.last_error = None
+
+    def available(self, now):
+        return self.healthy or now >= self.retry_at
+
+    def needs_check(self, now):
+        return not self.healthy or now - self.checked_at >= self.check_interval
+
+    def mark_up(self, now):
+        if not self.healthy:
+            print(f"[db] replica {safe_url(self.url)[:50]} is back")
+        self.healthy = True
+        self.checked_at = now
+
+    def mark_down(self, error, now):
+        if self.healthy:
+            print(f"[db] replica {safe_url(self.url)[:50]} is down: {error}")
+        self.healthy = False
+        self.failures += 1
+        self.last_error = str(error)
+        self.checked_at = now
+        self.retry_at = now + self.retry_interval
+
+    def status(self):
+        return {'url': safe_url(self.url), 'healthy': self.healthy, 'failures': self.failures,
+                'last_error': self.last_error}
+
+
+def _preparing_connection_class(psycopg2):
+    class PreparingConnection(psycopg2.extensions.connection):
+        """Соединение psycopg2 с реестром подготовленных запросов: текст -> имя."""
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.prepared_statements = {}
+
+    return PreparingConnection
 
 
 class DatabaseHandler:
-    def __init__(self, database_url=None):
+    def __init__(self, database_url=None, sqlite_tuning=SQLITE_TUNING,
+                 checkpoint_interval=SQLITE_CHECKPOINT_INTERVAL, write_queue=SQLITE_WRITE_QUEUE,
+                 replica_urls=None, read_your_writes_window=READ_YOUR_WRITES_WINDOW, shard_urls=None,
+                 shard_map_ttl=SHARD_MAP_TTL):
         self.database_url = database_url or DATABASE_URL
-        self.use_postgresql = USE_POSTGRESQL and HAS_PSYCOPG2
+        self._use_postgresql = None
+        self._psycopg2 = None
+        self._cursor_factory = None
+        # listener(query, params, seconds) вызывается после каждого запроса
+        self.query_listeners = []
+        self.sqlite_tuning = sqlite_tuning
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpointer = None
+        # WAL хранится в файле базы, поэтому переключаем его один раз на процесс
+        self._wal_ready_pid = None
+        self._checkpointer_pid = None
+        self._sqlite_lock = threading.Lock()
+        self.write_queue = write_queue
+        self.write_coordinator = None
+        self._coordinator_pid = None
+        urls = DATABASE_REPLICA_URLS if replica_urls is None else replica_urls
+        self.replicas = [Replica(url) for url in urls]
+        self._replica_cycle = itertools.count()
+        # user_id -> True, пока после его записи не истекло окно read-your-writes
+        self.primary_pins = TTLCache(maxsize=100_000, ttl=read_your_writes_window)
+        self.read_routing = {'replica': 0, 'primary_pinned': 0, 'primary_fallback': 0}
+        self.prepared_statements = PREPARED_STATEMENTS
+        self._connection_factory = None
+        self.prepare_stats = {'prepared': 0, 'reused': 0}
+        urls = DATABASE_SHARD_URLS if shard_urls is None else shard_urls
+        # Каждый шард - обычный обработчик со своей очередью записи и checkpoint; реплик у шардов нет
+        self.shards = [DatabaseHandler(url, sqlite_tuning=sqlite_tuning, checkpoint_interval=checkpoint_interval,
+                                       write_queue=write_queue, replica_urls=[], shard_urls=[]) for url in urls]
+        for shard in self.shards:
+            shard.query_listeners = self.query_listeners
+        # user_id -> номер шарда; пользователи в процессе переноса не кэшируются
+        self.shard_map = TTLCache(maxsize=100_000, ttl=shard_map_ttl)
+        self.shard_routing = {'cached': 0, 'directory': 0, 'waited_for_move': 0}
+
+    def add_query_listener(self, listener):
+        self.query_listeners.append(listener)
+
+    def configure(self):
+        # Драйвер выбирается при первом обращении, а не при импорте модуля
+        if self._use_postgresql is not None:
+            return self
+        if is_postgresql_url(self.database_url):
+            try:
+                import psycopg2
+                from psycopg2.extras import RealDictCursor
+            except ImportError:
+                print("  psycopg2: NOT INSTALLED - Falling back to SQLite")
+                self.database_url = 'sqlite:///site.db'
+                self._use_postgresql = False
+            else:
+                self._psycopg2 = psycopg2
+                self._cursor_factory = RealDictCursor
+                self._connection_factory = _preparing_connection_class(psycopg2)
+                self._use_postgresql = True
+        else:
+            self._use_postgresql = False
+        return self
+
+    @property
+    def use_postgresql(self):
+        if self._use_postgresql is None:
+            self.configure()
+        return self._use_postgresql
+
+    def describe(self):
+        self.configure()
+        print(f"[Database Config]")
+        print(f"  DATABASE_URL: {self.database_url[:50]}...")
+        print(f"  Type: {'PostgreSQL' if self.use_postgresql else 'SQLite'}")
+        print(f"  psycopg2: {'Available' if self.use_postgresql else 'Not needed'}")
+        if not self.use_postgresql:
+            if self.sqlite_tuning:
+                print(f"  SQLite mode: WAL, synchronous={SQLITE_SYNCHRONOUS}, "
+                      f"busy_timeout={SQLITE_BUSY_TIMEOUT_MS}ms, checkpoint every {self.checkpoint_interval:g}s")
+            else:
+                print("  SQLite mode: defaults (SQLITE_TUNING=0)")
+        if self.replicas:
+            print(f"  Read replicas: {len(self.replicas)}")
+        if self.shards:
+            print(f"  User shards: {len(self.shards)} (directory in DATABASE_URL)")
+
+    @property
+    def sqlite_path(self):
+        return self.database_url.replace('sqlite:///', '')
+
+    def _tune_sqlite(self, conn):
+        if SQLITE_SYNCHRONOUS in SYNCHRONOUS_MODES:
+            conn.execute(f'PRAGMA synchronous={SQLITE_SYNCHRONOUS}')
+        # Отрицательное значение cache_size задаётся в КиБ, а не в страницах
+        conn.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}')
+        conn.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE_MB * 1024 * 1024}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+
+    def _prepare_sqlite(self, conn):
+        pid = os.getpid()
+        if self._wal_ready_pid != pid:
+            with self._sqlite_lock:
+                if self._wal_ready_pid != pid:
+                    mode = conn.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+                    if mode.lower() != 'wal':
+                        # Например, :memory: - WAL там недоступен
+                        print(f"[sqlite] journal_mode stays {mode}")
+                    self._wal_ready_pid = pid
+        self._tune_sqlite(conn)
+
+        if self.checkpoint_interval > 0 and self._checkpointer_pid != pid:
+            with self._sqlite_lock:
+                # После fork поток родителя не существует - запускаем свой
+                if self._checkpointer_pid != pid:
+                    self.checkpointer = WalCheckpointer(self.sqlite_path, self.checkpoint_interval).start()
+                    self._checkpointer_pid = pid
 
     def get_connection(self):
         if self.use_postgresql:
-            db_url = self.database_url.replace('postgresql://', '')
-            return psycopg2.connect(self.database_url, cursor_factory=RealDictCursor)
+            conn = self._psycopg2.connect(self.database_url, connection_factory=self._connection_factory,
+                                          cursor_factory=self._cursor_factory)
         else:
-            db_path = self.database_url.replace('sqlite:///', '')
-            conn = sqlite3.connect(db_path)
+            if self.sqlite_tuning:
+                conn = sqlite3.connect(self.sqlite_path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000.0)
+                self._prepare_sqlite(conn)
+            else:
+                conn = sqlite3.connect(self.sqlite_path)
             conn.row_factory = sqlite3.Row
+        return self._traced(conn)
+
+    def _traced(self, conn):
+        # Без подписчиков соединение отдаётся как есть, без накладных расходов
+        if self.query_listeners:
+            return TracedConnection(conn, self.query_listeners)
+        return conn
+
+    def _connect_replica(self, url):
+        if self.use_postgresql:
+            conn = self._psycopg2.connect(url, connection_factory=self._connection_factory,
+                                          cursor_factory=self._cursor_factory)
+            conn.set_session(readonly=True)
+        else:
+            # mode=ro: реплика никогда не создаётся и не меняется через это соединение
+            path = url.replace('sqlite:///', '')
+            conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000.0)
+            if self.sqlite_tuning:
+                self._tune_sqlite(conn)
+            conn.row_factory = sqlite3.Row
+        return conn
+
+    def _replica_connection(self):
+        now = time.monotonic()
+        start = next(self._replica_cycle)
+        for i in range(len(self.replicas)):
+            replica = self.replicas[(start + i) % len(self.replicas)]
+            if not replica.available(now):
+                continue
+            conn = None
+            try:
+                conn = self._connect_replica(replica.url)
+                if replica.needs_check(now):
+                    cursor = conn.cursor()
+                    cursor.execute('SELECT 1 FROM tasks LIMIT 1')
+                    cursor.fetchall()
+                    cursor.close()
+                    replica.mark_up(now)
+            except Exception as e:
+                replica.mark_down(e, now)
+                if conn is not None:
+                    conn.close()
+                continue
             return conn
+        return None
+
+    def get_read_connection(self, user_id=None, pinned=False):
+        """Соединение для единицы работы только на чтение: реплика, если можно, иначе основная база."""
+        if self.shards and user_id is not None:
+            return self.for_user(user_id).get_read_connection(user_id, pinned=pinned)
+        if not self.replicas:
+            return self.get_connection()
+        if pinned or (user_id is not None and self.primary_pins.get(user_id)):
+            self.read_routing['primary_pinned'] += 1
+            return self.get_connection()
+        conn = self._replica_connection()
+        if conn is None:
+            self.read_routing['primary_fallback'] += 1
+            return self.get_connection()
+        self.read_routing['replica'] += 1
+        return self._traced(conn)
+
+    def pin_to_primary(self, user_id):
+        if self.replicas and user_id is not None:
+            self.primary_pins.set(user_id, True)
+
+    def replica_status(self):
+        return {'replicas': [replica.status() for replica in self.replicas], 'routing': dict(self.read_routing)}
+
+    @property
+    def write_queue_enabled(self):
+        return self.write_queue and not self.use_postgresql
+
+    def _coordinator(self):
+        pid = os.getpid()
+        if self._coordinator_pid != pid:
+            with self._sqlite_lock:
+                # Поток-писатель не переживает fork (gunicorn --preload) - создаём заново
+                if self._coordinator_pid != pid:
+                    self.write_coordinator = WriteCoordinator(self)
+                    self._coordinator_pid = pid
+        return self.write_coordinator
+
+    def write(self, fn, *args, conn=None, for_user=None, move_wait=None, **kwargs):
+        """Выполняет fn(conn, *args, **kwargs) в транзакции и возвращает её результат.
+
+        С очередью записи операция уходит потоку-писателю и коммитится в пачке
+        с другими; иначе - на conn (или на новом соединении) с отдельным коммитом.
+        for_user на время окна read-your-writes переводит чтения пользователя на основную базу,
+        а при шардировании выбирает шард, на котором выполняется запись.
+        move_wait - сколько ждать пользователя, которого переносят на другой шард
+        (None - SHARD_MOVE_WAIT, 0 - сразу UserMoving).
+        При шардировании conn не используется: он мог быть открыт на старом шарде
+        переносимого пользователя, и запись пропала бы вместе со старой копией.
+        """
+        if self.shards and for_user is not None:
+            return self.for_user(for_user, for_write=True, wait=move_wait).write(fn, *args, for_user=for_user,
+                                                                                  **kwargs)
+        self.pin_to_primary(for_user)
+        if self.write_queue_enabled:
+            return self._coordinator().submit(fn, *args, **kwargs).result(timeout=WRITE_TIMEOUT)
+        own = conn is None
+        if own:
+            conn = self.get_connection()
+        try:
+            result = fn(conn, *args, **kwargs)
+            self.commit(conn)
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            if own:
+                self.close(conn)
+
+    def user_databases(self):
+        """Базы с данными пользователей: все шарды или сама база без шардирования."""
+        return self.shards or [self]
+
+    def _directory_lookup(self, column, value):
+        conn = self.get_connection()
+        try:
+            cursor = self.execute(conn, f'SELECT user_id, shard, moving FROM user_directory WHERE {column} = %s',
+                                  (value,))
+            row = self.fetchone(cursor)
+            cursor.close()
+        finally:
+            self.close(conn)
+        self.shard_routing['directory'] += 1
+        return row
+
+    def shard_index(self, user_id, for_write=False, wait=None):
+        index = self.shard_map.get(user_id)
+        if index is not None:
+            self.shard_routing['cached'] += 1
+            return index
+        deadline = time.monotonic() + (SHARD_MOVE_WAIT if wait is None else wait)
+        while True:
+            row = self._directory_lookup('user_id', user_id)
+            if row is None:
+                raise LookupError(f"user {user_id} is not in the shard directory")
+            if not row['moving']:
+                self.shard_map.set(user_id, row['shard'])
+                return row['shard']
+            if not for_write:
+                # Пока идёт перенос, старая копия полная - чтения продолжают идти туда
+                return row['shard']
+            if time.monotonic() >= deadline:
+                raise UserMoving(f"user {user_id} is still being moved to another shard")
+            self.shard_routing['waited_for_move'] += 1
+            time.sleep(0.1)
+
+    def for_user(self, user_id, for_write=False, wait=None):
+        """Обработчик базы с данными user_id; без шардирования (или без user_id) - сам self."""
+        if not self.shards or user_id is None:
+            return self
+        return self.shards[self.shard_index(user_id, for_write, wait)]
+
+    def for_username(self, username):
+        """Шард пользователя по имени для входа; None - такого пользователя нет."""
+        if not self.shards:
+            return self
+        row = self._directory_lookup('username', username)
+        return None if row is None else self.shards[row['shard']]
+
+    def _allocate_user(self, conn, username):
+        # Начальный шард - по хешу имени; дальше источник истины - справочник (shards.py move)
+        shard = zlib.crc32(username.encode('utf-8')) % len(self.shards)
+        if self.use_postgresql:
+            cursor = self.execute(conn, 'INSERT INTO user_directory (username, shard) VALUES (%s, %s) RETURNING user_id',
+                                  (username, shard))
+            user_id = cursor.fetchone()['user_id']
+        else:
+            cursor = self.execute(conn, 'INSERT INTO user_directory (username, shard) VALUES (%s, %s)',
+                                  (username, shard))
+            user_id = cursor.lastrowid
+        cursor.close()
+        return user_id, shard
+
+    def _release_user(self, conn, user_id):
+        self.execute(conn, 'DELETE FROM user_directory WHERE user_id = %s', (user_id,)).close()
+
+    def create_user(self, fn, username, *args, conn=None):
+        """fn(conn, user_id, username, *args) вставляет строку users и возвращает её id.
+
+        Без шардирования user_id=None и id выдаёт сама база. С шардированием id и шард
+        выдаёт справочник (уникальность имени - его UNIQUE), а строка создаётся на шарде.
+        """
+        if not self.shards:
+            return self.write(fn, None, username, *args, conn=conn)
+        user_id, index = self.write(self._allocate_user, username)
+        try:
+            return self.shards[index].write(fn, user_id, username, *args, for_user=user_id)
+        except Exception:
+            self.write(self._release_user, user_id)
+            raise
+
+    def shard_status(self):
+        return {'shards': [safe_url(shard.database_url) for shard in self.shards], 'routing': dict(self.shard_routing)}
+
+    def _init_shards(self, cursor):
+        if self.use_postgresql:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_directory (
+                    user_id SERIAL PRIMARY KEY,
+                    username VARCHAR(100) UNIQUE NOT NULL,
+                    shard INTEGER NOT NULL,
+                    moving INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+        else:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_directory (
+                    user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT UNIQUE NOT NULL,
+                    shard INTEGER NOT NULL,
+                    moving INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+        for index, shard in enumerate(self.shards):
+            if is_postgresql_url(shard.database_url) != self.use_postgresql:
+                raise ValueError(f"shard {index} must use the same database type as DATABASE_URL")
+            conn = shard.get_connection()
+            try:
+                shard.init_db(conn)
+                if shard.use_postgresql:
+                    if index:
+                        shard._reserve_task_ids(conn, index * SHARD_ID_STRIDE)
+                else:
+                    shard._init_task_id_counter(conn, index * SHARD_ID_STRIDE, (index + 1) * SHARD_ID_STRIDE)
+            finally:
+                shard.close(conn)
+
+    def _reserve_task_ids(self, conn, floor):
+        # Новые задачи шарда получат id больше floor; уже выданные id не меняются
+        cursor = conn.cursor()
+        if self.use_postgresql:
+            cursor.execute('''
+                SELECT setval(pg_get_serial_sequence('tasks', 'id'), GREATEST(
+                    COALESCE(pg_sequence_last_value(pg_get_serial_sequence('tasks', 'id')::regclass), 0), %s))
+            ''', (floor,))
+        else:
+            cursor.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'tasks' AND seq < ?", (floor, floor))
+            cursor.execute('''
+                INSERT INTO sqlite_sequence (name, seq)
+                SELECT 'tasks', ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'tasks')
+            ''', (floor,))
+        conn.commit()
+        cursor.close()
+
+    def _init_task_id_counter(self, conn, floor, ceiling):
+        # AUTOINCREMENT в SQLite продолжает счёт от самого большого id в таблице, а после переноса
+        # пользователя с шарда с большим номером это id чужого диапазона. Поэтому на шардах SQLite
+        # id задач выдаёт свой счётчик (insert_task); он помнит только id своего диапазона
+        cursor = conn.cursor()
+        cursor.execute('CREATE TABLE IF NOT EXISTS task_id_counter (last_id INTEGER NOT NULL, ceiling INTEGER NOT NULL)')
+        cursor.execute('''
+            INSERT INTO task_id_counter (last_id, ceiling)
+            SELECT MAX(?, COALESCE((SELECT MAX(id) FROM (SELECT id FROM tasks UNION ALL SELECT id FROM tasks_archive)
+                                    WHERE id >= ? AND id < ?), 0)), ?
+            WHERE NOT EXISTS (SELECT 1 FROM task_id_counter)
+        ''', (floor, floor, ceiling, ceiling))
+        conn.commit()
+        cursor.close()
+
+    def _next_task_id(self, conn):
+        # None - id выдаст сама база: без шардов или на PostgreSQL, где явные id не двигают последовательность
+        if not self.shards or self.use_postgresql:
+            return None
+        cursor = self.execute(conn, 'UPDATE task_id_counter SET last_id = last_id + 1 RETURNING last_id, ceiling')
+        row = self.fetchone(cursor)
+        cursor.close()
+        if row['last_id'] >= row['ceiling']:
+            raise RuntimeError(f"shard task id range is exhausted at {row['last_id']}; raise SHARD_ID_STRIDE")
+        return row['last_id']
+
+    def insert_task(self, conn, **values):
+        """Вставляет строку tasks из values (колонка -> значение) и возвращает id новой задачи."""
+        task_id = self._next_task_id(conn)
+        if task_id is not None:
+            values = {'id': task_id, **values}
+        cursor = self.execute(conn, f'''
+            INSERT INTO tasks ({", ".join(values)}) VALUES ({", ".join(["%s"] * len(values))})
+            RETURNING id
+        ''', tuple(values.values()))
+        task_id = self.fetchone(cursor)['id']
+        cursor.close()
+        return task_id
 
     def init_db(self, conn):
         cursor = conn.cursor()
@@ -68,6 +763,22 @@ class DatabaseHandler:
                     FOREIGN KEY (parent_id) REFERENCES tasks (id) ON DELETE CASCADE
                 )
             ''')
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS tasks_archive (
+                    id INTEGER PRIMARY KEY,
+                    title TEXT NOT NULL,
+                    description TEXT,
+                    status VARCHAR(20),
+                    priority VARCHAR(20),
+                    deadline DATE,
+                    user_id INTEGER NOT NULL,
+                    parent_id INTEGER,
+                    created_at TIMESTAMP,
+                    completed_at TIMESTAMP,
+                    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
         else:
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS users (
@@ -94,14 +805,88 @@ class DatabaseHandler:
                 )
             ''')
 
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS tasks_archive (
+                    id INTEGER PRIMARY KEY,
+                    title TEXT NOT NULL,
+                    description TEXT,
+                    status TEXT,
+                    priority TEXT,
+                    deadline TEXT,
+                    user_id INTEGER NOT NULL,
+                    parent_id INTEGER,
+                    created_at TEXT,
+                    completed_at TEXT,
+                    archived_at TEXT DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+        # Выполненные задачи старше ARCHIVE_AFTER_DAYS переносятся в tasks_archive (archive.py);
+        # статистика читает полную историю через представление tasks_history
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_tasks_completed_at ON tasks (completed_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_tasks_archive_user ON tasks_archive (user_id, completed_at)')
+        # Напоминания о дедлайнах (reminders.py): чат пользователя, индекс для сканирования
+        # по (deadline, id) и отправленные напоминания - по одному на задачу и вид
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS bot_chats (
+                user_id INTEGER PRIMARY KEY,
+                chat_id BIGINT NOT NULL,
+                lang VARCHAR(5)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS reminders_sent (
+                task_id INTEGER NOT NULL,
+                kind VARCHAR(20) NOT NULL,
+                deadline DATE NOT NULL,
+                user_id INTEGER NOT NULL,
+                PRIMARY KEY (task_id, kind)
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_tasks_deadline ON tasks (deadline, id)')
+        # Версия задач пользователя: растёт при каждой записи, по ней бот сбрасывает готовые виды
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS task_versions (
+                user_id INTEGER PRIMARY KEY,
+                version BIGINT NOT NULL
+            )
+        ''')
+        # Страницы списка задач по курсору (created_at, id) в app.load_tasks
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_tasks_user_created ON tasks (user_id, created_at, id)')
+        # Время отзыва сессионных идентичностей пользователя (SESSION_IDENTITY в app.py): общее для всех процессов
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS session_revocations (
+                user_id INTEGER PRIMARY KEY,
+                revoked_at DOUBLE PRECISION NOT NULL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_reminders_sent_user ON reminders_sent (user_id)')
+        columns = ', '.join(TASK_COLUMNS)
+        create_view = 'CREATE OR REPLACE VIEW' if self.use_postgresql else 'CREATE VIEW IF NOT EXISTS'
+        cursor.execute(f'''
+            {create_view} tasks_history AS
+            SELECT {columns} FROM tasks
+            UNION ALL
+            SELECT {columns} FROM tasks_archive
+        ''')
+
+        if self.shards:
+            self._init_shards(cursor)
+
         conn.commit()
         cursor.close()
         print(f"✓ Database initialized ({'PostgreSQL' if self.use_postgresql else 'SQLite'})")
 
-    def execute(self, conn, query, params=None):
+    def execute(self, conn, query, params=None, prepare=False):
+        """prepare=True - запрос, который повторяется на одном соединении: на PostgreSQL он
+        разбирается и планируется один раз. Пула нет, и соединение живёт одну единицу работы,
+        поэтому разовому запросу PREPARE только добавляет обращение к серверу.
+        """
         cursor = conn.cursor()
 
         if self.use_postgresql:
+            if prepare and self.prepared_statements:
+                return self._execute_prepared(conn, cursor, query, params)
             formatted_query = query
         else:
             formatted_query = query.replace('%s', '?')
@@ -113,6 +898,40 @@ class DatabaseHandler:
 
         return cursor
 
+    def _execute_prepared(self, conn, cursor, query, params):
+        statements = getattr(conn, 'prepared_statements', None)
+        if statements is None:
+            # Соединение создано не через get_connection - выполняем как обычно
+            cursor.execute(query, params or None)
+            return cursor
+        name = statements.get(query)
+        if name is None:
+            name = statement_name(query)
+            # PREPARE не откатывается вместе с транзакцией и живёт до закрытия соединения
+            cursor.execute(f'PREPARE {name} AS {numbered_placeholders(query)}')
+            statements[query] = name
+            self.prepare_stats['prepared'] += 1
+        else:
+            self.prepare_stats['reused'] += 1
+        if params:
+            cursor.execute(f'EXECUTE {name} ({", ".join(["%s"] * len(params))})', params)
+        else:
+            cursor.execute(f'EXECUTE {name}')
+        return cursor
+
+    def touch_tasks(self, conn, user_id):
+        """Отмечает изменение задач user_id в той же транзакции, что и сама запись."""
+        self.execute(conn, '''
+            INSERT INTO task_versions (user_id, version) VALUES (%s, 1)
+            ON CONFLICT (user_id) DO UPDATE SET version = task_versions.version + 1
+        ''', (user_id,)).close()
+
+    def tasks_version(self, conn, user_id):
+        cursor = self.execute(conn, 'SELECT version FROM task_versions WHERE user_id = %s', (user_id,))
+        row = self.fetchone(cursor)
+        cursor.close()
+        return row['version'] if row else 0
+
     def fetchone(self, cursor):
         return cursor.fetchone()
 
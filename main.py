@@ -3,54 +3,171 @@ import os
 import sys
 from pathlib import Path
 
+from supervisor import Child, Supervisor
 
-def run_flask_app():
-    from app import app, init_db
+WEB_SERVER = os.environ.get('WEB_SERVER', 'gunicorn')
+WEB_WORKERS = int(os.environ.get('WEB_WORKERS', '2'))
+WEB_THREADS = int(os.environ.get('WEB_THREADS', '4'))
+WEB_MAX_REQUESTS = int(os.environ.get('WEB_MAX_REQUESTS', '1000'))
+WEB_MAX_REQUESTS_JITTER = int(os.environ.get('WEB_MAX_REQUESTS_JITTER', '100'))
+WEB_TIMEOUT = int(os.environ.get('WEB_TIMEOUT', '30'))
+WEB_GRACEFUL_TIMEOUT = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', '30'))
+# Сколько держать простаивающее keep-alive соединение (uvicorn)
+WEB_KEEPALIVE = int(os.environ.get('WEB_KEEPALIVE', '5'))
+
+
+def gunicorn_options(port):
+    return {
+        'bind': f'0.0.0.0:{port}',
+        'workers': WEB_WORKERS,
+        'threads': WEB_THREADS,
+        'worker_class': 'gthread' if WEB_THREADS > 1 else 'sync',
+        # Приложение импортируется один раз в мастере, воркеры получают его через fork
+        'preload_app': True,
+        'max_requests': WEB_MAX_REQUESTS,
+        'max_requests_jitter': WEB_MAX_REQUESTS_JITTER,
+        'timeout': WEB_TIMEOUT,
+        'graceful_timeout': WEB_GRACEFUL_TIMEOUT,
+        'accesslog': '-',
+    }
+
+
+def run_gunicorn(app, port, ready=None):
+    from gunicorn.app.base import BaseApplication
+
+    class TaskManagerServer(BaseApplication):
+        # SIGHUP мастеру - плавный перезапуск воркеров, SIGTERM - плавная остановка
+        def __init__(self, application, options):
+            self.application = application
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return self.application
+
+    options = gunicorn_options(port)
+    if ready is not None:
+        options['when_ready'] = lambda server: ready.set()
+
+    print(f"✓ Gunicorn: {WEB_WORKERS} workers x {WEB_THREADS} threads on port {port}")
+    TaskManagerServer(app, options).run()
+
+
+def run_uvicorn(port, ready=None):
+    import uvicorn
+
+    class TaskManagerServer(uvicorn.Server):
+        async def startup(self, sockets=None):
+            await super().startup(sockets)
+            if self.started and ready is not None:
+                ready.set()
+
+    # Воркеры - отдельные процессы с собственным циклом событий; потоков на соединение нет
+    # X-Forwarded-* разбирает ProxyFix приложения (PROXY_HOPS), а не uvicorn
+    config = uvicorn.Config('asgi:application', host='0.0.0.0', port=port, workers=WEB_WORKERS,
+                            timeout_keep_alive=WEB_KEEPALIVE, timeout_graceful_shutdown=WEB_GRACEFUL_TIMEOUT,
+                            proxy_headers=False)
+    print(f"✓ Uvicorn: {config.workers} workers on port {port}")
+    if config.workers > 1:
+        from uvicorn.supervisors import Multiprocess
+
+        # Воркеры запускаются через spawn, поэтому сервер в них - обычный uvicorn.Server
+        sock = config.bind_socket()
+        if ready is not None:
+            ready.set()
+        Multiprocess(config, target=uvicorn.Server(config).run, sockets=[sock]).run()
+    else:
+        TaskManagerServer(config).run()
+
+
+def init_database():
+    from database import db_handler
+
+    db_handler.describe()
+    conn = db_handler.get_connection()
+    try:
+        db_handler.init_db(conn)
+    finally:
+        db_handler.close(conn)
+
+
+def prepare_metrics_dir():
+    # Несколько воркеров: без общего каталога каждый отдаёт на /metrics только свои счётчики,
+    # и от скрейпа к скрейпу значения прыгают между воркерами
+    if os.environ.get('METRICS_ENABLED', '0') != '1' or WEB_WORKERS < 2:
+        return
+    if not os.environ.get('METRICS_DIR'):
+        import tempfile
+
+        # Через окружение каталог получают и воркеры uvicorn, запускаемые через spawn
+        os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='task-manager-metrics-')
+    # metrics читает METRICS_DIR при импорте - только после того, как переменная задана
+    from metrics import reset_metrics_dir
+
+    reset_metrics_dir(os.environ['METRICS_DIR'])
+    print(f"✓ Metrics of {WEB_WORKERS} workers are aggregated in {os.environ['METRICS_DIR']}")
+
+
+def run_flask_app(ready=None, init_db=True):
+    import translations
+
+    # До импорта app: реестр метрик читает METRICS_DIR при создании
+    prepare_metrics_dir()
+    from app import app
+    
+    # Загружаем каталог переводов в мастере, чтобы воркеры получили его готовым
+    translations.catalog.load()
     
-    with app.app_context():
-        init_db()
+    # Схема создаётся один раз в мастере, до fork воркеров
+    if init_db:
+        init_database()
     
     port = int(os.environ.get('PORT', 8000))
+    
+    if WEB_SERVER == 'gunicorn':
+        try:
+            run_gunicorn(app, port, ready)
+            return
+        except ImportError:
+            print("⚠ gunicorn not available, falling back to the development server")
+    elif WEB_SERVER == 'uvicorn':
+        try:
+            run_uvicorn(port, ready)
+            return
+        except ImportError:
+            print("⚠ uvicorn not available, falling back to the development server")
+    
+    if ready is not None:
+        ready.set()
     app.run(host='0.0.0.0', port=port, debug=False)
 
-def run_telegram_bot():
+def run_telegram_bot(ready=None):
     from bot import main as bot_main
-    bot_main()
+    bot_main(ready=ready)
 
 def main():
     try:
-        conn = db_handler.get_connection()
-        db_handler.init_db(conn)
-        db_handler.close(conn)
+        init_database()
         print("✓ База данных успешно инициализирована")
     except Exception as e:
         print(f"Ошибка инициализации БД: {e}")
 
-    print("Starting Task Manager Application...")
     print("Starting Task Manager Application...")
     print(f"Python version: {sys.version}")
     print(f"Working directory: {Path.cwd()}")
     
-    flask_process = multiprocessing.Process(target=run_flask_app, name="FlaskApp")
-    bot_process = multiprocessing.Process(target=run_telegram_bot, name="TelegramBot")
-    
-    flask_process.start()
-    print("✓ Flask web application started")
-    
-    bot_process.start()
-    print("✓ Telegram bot started")
-    
-    try:
-        flask_process.join()
-        bot_process.join()
-    except KeyboardInterrupt:
-        print("\nShutting down...")
-        flask_process.terminate()
-        bot_process.terminate()
-        flask_process.join()
-        bot_process.join()
-        print("Application stopped")
+    supervisor = Supervisor([
+        Child("FlaskApp", run_flask_app, {'init_db': False}),
+        Child("TelegramBot", run_telegram_bot),
+    ])
+    exit_code = supervisor.run()
+    print("Application stopped")
+    sys.exit(exit_code)
 
 if __name__ == '__main__':
     multiprocessing.set_start_method('spawn', force=True)
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,393 @@
+import atexit
+import bisect
+import contextlib
+import fcntl
+import glob
+import json
+import os
+import threading
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '0') == '1'
+# Общий каталог метрик для нескольких воркеров: каждый процесс пишет туда свои значения,
+# /metrics в любом воркере отдаёт сумму по всем. Пусто - метрики только своего процесса
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+# Как часто воркер сохраняет свои значения в METRICS_DIR, секунды
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+    def snapshot(self):
+        with self._lock:
+            values = [[list(labels), value] for labels, value in self._values.items()]
+        return {'name': self.name, 'kind': self.kind, 'documentation': self.documentation,
+                'labelnames': list(self.labelnames), 'values': values}
+
+    @staticmethod
+    def from_snapshot(entry):
+        if entry['kind'] == 'histogram':
+            return Histogram(entry['name'], entry['documentation'], entry['labelnames'], entry['buckets'])
+        kind = Gauge if entry['kind'] == 'gauge' else Counter
+        return kind(entry['name'], entry['documentation'], entry['labelnames'])
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def merge(self, values):
+        for labels, value in values:
+            self.inc(*labels, amount=value)
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            lines.append(f'{self.name}{_labels(self.labelnames, labels)} {_number(value)}')
+        return lines
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def snapshot(self):
+        entry = super().snapshot()
+        entry['buckets'] = list(self.buckets)
+        return entry
+
+    def merge(self, values):
+        with self._lock:
+            for labels, (counts, total, count) in values:
+                entry = self._values.setdefault(tuple(labels), [[0] * (len(self.buckets) + 1), 0.0, 0])
+                entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                entry[1] += total
+                entry[2] += count
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            items = [(labels, (list(e[0]), e[1], e[2])) for labels, e in self._values.items()]
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = f'le="{_number(float(bound))}"'
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, labels)} {_number(total)}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, labels)} {count}')
+        return lines
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read_snapshot(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def _write_snapshot(path, snapshot):
+    # Через временный файл: читатель никогда не видит файл наполовину записанным
+    temp = f'{path}.{os.getpid()}.tmp'
+    with open(temp, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f)
+    os.replace(temp, path)
+
+
+def _merge_snapshots(snapshots):
+    merged = {}
+    for snapshot in snapshots:
+        for entry in snapshot:
+            metric = merged.get(entry['name'])
+            if metric is None:
+                metric = merged[entry['name']] = Metric.from_snapshot(entry)
+            metric.merge(entry['values'])
+    return list(merged.values())
+
+
+class Registry:
+    """Метрики процесса; с directory - сумма по всем процессам, пишущим в этот каталог.
+
+    Каждый воркер раз в flush_interval (и при выходе) сохраняет свои значения в
+    <directory>/<pid>.json. Счётчики и гистограммы завершившихся воркеров
+    переносятся в dead.json, так что сумма не убывает, когда gunicorn перезапускает
+    воркер. Gauge - текущее состояние, для них суммируются только живые процессы.
+    """
+
+    DEAD = 'dead.json'
+
+    def __init__(self, directory=None, flush_interval=METRICS_FLUSH_INTERVAL):
+        self._metrics = []
+        self._collectors = []
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._flusher_pid = None
+        self._flusher_lock = threading.Lock()
+        self._flush_stop = threading.Event()
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector):
+        # collector() возвращает список метрик, собранных в момент запроса
+        self._collectors.append(collector)
+
+    def collect(self):
+        metrics = list(self._metrics)
+        for collector in self._collectors:
+            metrics.extend(collector())
+        return metrics
+
+    def render(self):
+        lines = []
+        for metric in self._shared() if self.directory else self.collect():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def ensure_flusher(self):
+        """Запускает в текущем процессе поток, сохраняющий его значения в directory.
+
+        Вызывается на каждом запросе: после fork поток мастера в воркере не существует,
+        поэтому запуск ленивый, по смене pid.
+        """
+        pid = os.getpid()
+        if not self.directory or self._flusher_pid == pid:
+            return
+        with self._flusher_lock:
+            if self._flusher_pid == pid:
+                return
+            # Файл с нашим pid остался от завершившегося процесса: pid переиспользован
+            with self._directory_lock():
+                self._retire([self._own_path()])
+            self._flusher_pid = pid
+            threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True).start()
+            atexit.register(self.dump)
+
+    def dump(self):
+        if self._flusher_pid == os.getpid():
+            _write_snapshot(self._own_path(), [metric.snapshot() for metric in self.collect()])
+
+    def _flush_loop(self):
+        while not self._flush_stop.wait(self.flush_interval):
+            try:
+                self.dump()
+            except OSError as e:
+                print(f"⚠ Metrics flush to {self.directory} failed: {e}")
+
+    def _own_path(self):
+        return os.path.join(self.directory, f'{os.getpid()}.json')
+
+    @contextlib.contextmanager
+    def _directory_lock(self):
+        # Перенос в dead.json и чтение каталога - из разных воркеров, поэтому flock
+        with open(os.path.join(self.directory, '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _retire(self, paths):
+        # Вызывается под блокировкой каталога: переносит счётчики в dead.json и удаляет файлы
+        paths = [path for path in paths if os.path.exists(path)]
+        if not paths:
+            return
+        dead_path = os.path.join(self.directory, self.DEAD)
+        snapshots = [_read_snapshot(dead_path)]
+        snapshots += [[entry for entry in _read_snapshot(path) if entry['kind'] != 'gauge'] for path in paths]
+        _write_snapshot(dead_path, [metric.snapshot() for metric in _merge_snapshots(snapshots)])
+        for path in paths:
+            os.remove(path)
+
+    def _shared(self):
+        self.ensure_flusher()
+        self.dump()
+        with self._directory_lock():
+            live, dead = [], []
+            for path in glob.glob(os.path.join(self.directory, '[0-9]*.json')):
+                pid = int(os.path.basename(path).split('.')[0])
+                (live if _alive(pid) else dead).append(path)
+            self._retire(dead)
+            snapshots = [_read_snapshot(os.path.join(self.directory, self.DEAD))]
+            snapshots += [_read_snapshot(path) for path in live]
+        return _merge_snapshots(snapshots)
+
+
+def reset_metrics_dir(directory):
+    """Очищает каталог метрик перед стартом сервера: значения прошлого запуска не суммируются."""
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        os.remove(path)
+
+
+def password_hash_metrics(hasher):
+    # Переводит накопленные тайминги PasswordHasher в формат Prometheus
+    def collect():
+        seconds = Counter('password_hash_seconds_total', 'Time spent hashing passwords', ('op',))
+        count = Counter('password_hash_total', 'Password hashing operations', ('op',))
+        for op, entry in hasher.metrics.snapshot().items():
+            seconds.inc(op, amount=entry['total'])
+            count.inc(op, amount=entry['count'])
+        return [count, seconds]
+    return collect
+
+
+def throttle_metrics(*throttles):
+    def collect():
+        counter = Counter('auth_attempts_total', 'Login and registration attempts by throttle outcome',
+                          ('throttle', 'outcome'))
+        for throttle in throttles:
+            for outcome, value in throttle.snapshot().items():
+                counter.inc(throttle.name, outcome, amount=value)
+        return [counter]
+    return collect
+
+
+def outbound_metrics(dispatcher):
+    def collect():
+        messages = Counter('bot_outbound_requests_total', 'Paced Bot API requests by lane and outcome',
+                           ('lane', 'outcome'))
+        waited = Counter('bot_outbound_wait_seconds_total', 'Time paced requests spent queued', ('lane',))
+        queued = Gauge('bot_outbound_queued', 'Requests waiting for a global send slot', ('lane',))
+        for lane, values in dispatcher.snapshot().items():
+            for outcome in ('sent', 'retry_after', 'failed'):
+                messages.inc(lane, outcome, amount=values[outcome])
+            waited.inc(lane, amount=values['wait_seconds'])
+        for lane, depth in dispatcher.queued().items():
+            queued.set(lane, value=depth)
+        return [messages, waited, queued]
+    return collect
+
+
+def asgi_metrics(limit):
+    def collect():
+        requests = Counter('asgi_requests_total', 'Requests admitted or rejected by the ASGI concurrency limit',
+                           ('outcome',))
+        active = Gauge('asgi_requests_active', 'Requests being processed by the ASGI server')
+        waiting = Gauge('asgi_requests_waiting', 'Requests waiting for an ASGI processing slot')
+        for outcome, value in limit.counters.items():
+            requests.inc(outcome, amount=value)
+        active.set(value=limit.active)
+        waiting.set(value=limit.waiting)
+        return [requests, active, waiting]
+    return collect
+
+
+def serve_metrics(registry, port, host='127.0.0.1'):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True)
+    thread.start()
+    return server
+
+
+def dump_metrics_periodically(registry, interval, path=None):
+    # Без path метрики печатаются в stdout
+    stop = threading.Event()
+
+    def loop():
+        while not stop.wait(interval):
+            text = registry.render()
+            if path:
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(text)
+            else:
+                print(text, flush=True)
+
+    threading.Thread(target=loop, name='metrics-dump', daemon=True).start()
+    return stop
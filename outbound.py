@@ -0,0 +1,183 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from collections import OrderedDict
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+OUTBOUND_QUEUE = os.environ.get('OUTBOUND_QUEUE', '1') == '1'
+# Telegram допускает около 30 сообщений в секунду на бота
+OUTBOUND_GLOBAL_RATE = float(os.environ.get('OUTBOUND_GLOBAL_RATE', '30'))
+# Личный чат: не чаще сообщения в секунду, короткие всплески допустимы
+OUTBOUND_CHAT_RATE = float(os.environ.get('OUTBOUND_CHAT_RATE', '1'))
+OUTBOUND_CHAT_BURST = float(os.environ.get('OUTBOUND_CHAT_BURST', '3'))
+# Группы: около 20 сообщений в минуту
+OUTBOUND_GROUP_RATE = float(os.environ.get('OUTBOUND_GROUP_RATE', '20')) / 60.0
+OUTBOUND_MAX_RETRIES = int(os.environ.get('OUTBOUND_MAX_RETRIES', '3'))
+
+# Порядок полос - их приоритет: ответы пользователю всегда раньше рассылок
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+LANES = (INTERACTIVE, BULK)
+# Эти вызовы не создают сообщений в чате и отправляются без очереди
+UNPACED = frozenset({'answerCallbackQuery', 'sendChatAction', 'getMe', 'deleteWebhook', 'setWebhook'})
+
+
+def bulk(bot):
+    """Аргументы для массовых отправок: полоса bulk, если у бота есть диспетчер."""
+    if isinstance(getattr(bot, 'rate_limiter', None), OutboundDispatcher):
+        return {'rate_limit_args': {'lane': BULK}}
+    return {}
+
+
+class OutboundDispatcher(BaseRateLimiter):
+    """Очередь исходящих вызовов Bot API с общим и початовым темпом и полосами приоритета.
+
+    Подключается через ApplicationBuilder.rate_limiter(), поэтому через неё проходят
+    все send_message/edit_message_text и прочие вызовы с chat_id.
+    """
+
+    def __init__(self, global_rate=OUTBOUND_GLOBAL_RATE, chat_rate=OUTBOUND_CHAT_RATE, chat_burst=OUTBOUND_CHAT_BURST,
+                 group_rate=OUTBOUND_GROUP_RATE, max_retries=OUTBOUND_MAX_RETRIES, max_chats=10000):
+        self.global_interval = 1.0 / global_rate if global_rate > 0 else 0.0
+        self.chat_rate = chat_rate
+        self.chat_burst = max(chat_burst, 1.0)
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self._chats = OrderedDict()
+        self._waiting = []
+        self._seq = itertools.count()
+        self._next_slot = 0.0
+        self._paused_until = 0.0
+        self._wakeup = None
+        self._pump_task = None
+        self.counters = {lane: {'sent': 0, 'retry_after': 0, 'failed': 0, 'wait_seconds': 0.0} for lane in LANES}
+
+    async def initialize(self):
+        self._start()
+
+    async def shutdown(self):
+        if self._pump_task is not None:
+            self._pump_task.cancel()
+            try:
+                await self._pump_task
+            except asyncio.CancelledError:
+                pass
+            self._pump_task = None
+        for _, _, future in self._waiting:
+            future.cancel()
+        self._waiting.clear()
+
+    def _start(self):
+        if self._pump_task is None or self._pump_task.done():
+            self._wakeup = asyncio.Event()
+            self._pump_task = asyncio.get_running_loop().create_task(self._pump())
+
+    async def _pump(self):
+        # Единственный, кто раздаёт общие слоты: из очереди всегда берётся самая приоритетная заявка
+        while True:
+            if not self._waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = max(self._next_slot, self._paused_until) - time.monotonic()
+            if delay > 0:
+                # Пока ждём, может прийти заявка важнее - поэтому после сна выбираем заново
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._waiting)
+            if future.done():
+                continue
+            future.set_result(None)
+            self._next_slot = max(self._next_slot, time.monotonic()) + self.global_interval
+
+    async def _global_slot(self, lane):
+        self._start()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (LANES.index(lane), next(self._seq), future))
+        self._wakeup.set()
+        await future
+
+    def _chat_limits(self, chat_id):
+        # Отрицательный id - группа или канал, у них лимит строже
+        if str(chat_id).startswith('-'):
+            return self.group_rate, 1.0
+        return self.chat_rate, self.chat_burst
+
+    def _take_chat_token(self, chat_id, lane):
+        """Секунды до отправки в чат; 0 - можно сразу."""
+        rate, burst = self._chat_limits(chat_id)
+        if rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        tokens, updated = self._chats.get(chat_id, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        self._chats[chat_id] = (tokens, now)
+        self._chats.move_to_end(chat_id)
+        while len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
+
+        if lane == INTERACTIVE:
+            # Ответ бронирует место в очереди чата, даже если уходит в долг
+            self._chats[chat_id] = (tokens - 1, now)
+            return max(0.0, (1 - tokens) / rate)
+        # Рассылка оставляет в чате один токен под ответ пользователю и в долг не берёт
+        reserve = 1.0 if burst > 1 else 0.0
+        if tokens - 1 >= reserve:
+            self._chats[chat_id] = (tokens - 1, now)
+            return 0.0
+        return (reserve + 1 - tokens) / rate
+
+    async def _chat_slot(self, chat_id, lane):
+        while True:
+            wait = self._take_chat_token(chat_id, lane)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+            if lane == INTERACTIVE:
+                return
+
+    def _pause(self, seconds):
+        # 429 тормозит всю отправку: лимит у Telegram общий на бота
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        if endpoint in UNPACED or chat_id is None:
+            return await callback(*args, **kwargs)
+
+        lane = (rate_limit_args or {}).get('lane', INTERACTIVE)
+        counters = self.counters[lane]
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            await self._chat_slot(chat_id, lane)
+            await self._global_slot(lane)
+            counters['wait_seconds'] += time.monotonic() - started
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                counters['retry_after'] += 1
+                self._pause(float(e.retry_after))
+                if attempt == self.max_retries:
+                    counters['failed'] += 1
+                    raise
+                continue
+            except Exception:
+                counters['failed'] += 1
+                raise
+            counters['sent'] += 1
+            return result
+
+    def queued(self):
+        depth = {lane: 0 for lane in LANES}
+        for rank, _, future in self._waiting:
+            if not future.done():
+                depth[LANES[rank]] += 1
+        return depth
+
+    def snapshot(self):
+        return {lane: dict(values) for lane, values in self.counters.items()}
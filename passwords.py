@@ -0,0 +1,137 @@
+import atexit
+import os
+import threading
+import time
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+# Стоимость хеширования, например scrypt:32768:8:1 или pbkdf2:sha256:600000
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+# 0 - хешировать в текущем процессе (в потоке для asyncio)
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', '2'))
+
+
+def normalize_method(method):
+    name, *args = method.split(':')
+    if name == 'scrypt':
+        n, r, p = args if len(args) == 3 else (2 ** 15, 8, 1)
+        return f"scrypt:{n}:{r}:{p}"
+    if name == 'pbkdf2':
+        hash_name = args[0] if args else 'sha256'
+        iterations = args[1] if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS
+        return f"pbkdf2:{hash_name}:{iterations}"
+    return method
+
+
+def needs_rehash(password_hash, method=None):
+    current = normalize_method(method or PASSWORD_HASH_METHOD)
+    return password_hash.split('$', 1)[0] != current
+
+
+# Функции уровня модуля, чтобы их можно было передать в пул процессов
+def _hash(password, method):
+    return generate_password_hash(password, method=method)
+
+
+def _verify(password_hash, password, method):
+    ok = check_password_hash(password_hash, password)
+    new_hash = None
+    if ok and needs_rehash(password_hash, method):
+        new_hash = generate_password_hash(password, method=method)
+    return ok, new_hash
+
+
+class HashMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def observe(self, op, seconds):
+        with self._lock:
+            entry = self._data.setdefault(op, {'count': 0, 'total': 0.0, 'max': 0.0})
+            entry['count'] += 1
+            entry['total'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {op: dict(entry) for op, entry in self._data.items()}
+
+
+class PasswordHasher:
+    def __init__(self, method=PASSWORD_HASH_METHOD, workers=PASSWORD_HASH_WORKERS):
+        self.method = method
+        self.workers = workers
+        self.metrics = HashMetrics()
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        if self.workers <= 0:
+            return None
+        # Пул, созданный до fork, в дочернем процессе непригоден - создаём свой
+        if self._pool is None or self._pool_pid != os.getpid():
+            with self._lock:
+                if self._pool is None or self._pool_pid != os.getpid():
+                    from concurrent.futures import ProcessPoolExecutor
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                    self._pool_pid = os.getpid()
+        return self._pool
+
+    def shutdown(self):
+        if self._pool is not None and self._pool_pid == os.getpid():
+            self._pool.shutdown(wait=False, cancel_futures=True)
+        self._pool = None
+
+    def _run(self, op, fn, *args):
+        started = time.perf_counter()
+        pool = self._get_pool()
+        try:
+            if pool is None:
+                return fn(*args)
+            return pool.submit(fn, *args).result()
+        finally:
+            self.metrics.observe(op, time.perf_counter() - started)
+
+    async def _run_async(self, op, fn, *args):
+        import asyncio
+
+        started = time.perf_counter()
+        pool = self._get_pool()
+        loop = asyncio.get_running_loop()
+        try:
+            # Без пула уходим в поток по умолчанию, чтобы не блокировать event loop
+            return await loop.run_in_executor(pool, fn, *args)
+        finally:
+            self.metrics.observe(op, time.perf_counter() - started)
+
+    def hash(self, password):
+        return self._run('hash', _hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        # Возвращает (ok, new_hash); new_hash не None, если хеш пора обновить
+        started = time.perf_counter()
+        ok, new_hash = self._run('verify', _verify, password_hash, password, self.method)
+        if new_hash:
+            self.metrics.observe('upgrade', time.perf_counter() - started)
+        return ok, new_hash
+
+    async def hash_async(self, password):
+        return await self._run_async('hash', _hash, password, self.method)
+
+    async def verify_async(self, password_hash, password):
+        started = time.perf_counter()
+        ok, new_hash = await self._run_async('verify', _verify, password_hash, password, self.method)
+        if new_hash:
+            self.metrics.observe('upgrade', time.perf_counter() - started)
+        return ok, new_hash
+
+
+hasher = PasswordHasher()
+atexit.register(hasher.shutdown)
+
+hash_password = hasher.hash
+verify_password = hasher.verify
+hash_password_async = hasher.hash_async
+verify_password_async = hasher.verify_async
@@ -0,0 +1,127 @@
+import contextvars
+import functools
+import os
+import re
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+QUERY_TRACING = os.environ.get('QUERY_TRACING', '0') == '1'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+# Сколько раз один отпечаток может выполниться за единицу работы без предупреждения
+QUERY_REPEAT_LIMIT = int(os.environ.get('QUERY_REPEAT_LIMIT', '10'))
+# Тестовый режим: превышение лимита сразу роняет запрос/апдейт
+QUERY_REPEAT_STRICT = os.environ.get('QUERY_REPEAT_STRICT', '0') == '1'
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER = re.compile(r'%s|\?')
+_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_SPACES = re.compile(r'\s+')
+
+
+class RepeatedQueryError(AssertionError):
+    pass
+
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(query):
+    text = _STRING.sub('?', query)
+    text = _NUMBER.sub('?', text)
+    text = _PLACEHOLDER.sub('?', text)
+    text = _IN_LIST.sub('(?+)', text)
+    return _SPACES.sub(' ', text).strip()
+
+
+def redact(params):
+    if params is None:
+        return ''
+    if isinstance(params, dict):
+        return ', '.join(f'{k}=<{type(v).__name__}>' for k, v in params.items())
+    return ', '.join(f'<{type(v).__name__}>' for v in params)
+
+
+class UnitOfWork:
+    def __init__(self, name):
+        self.name = name
+        self.counts = Counter()
+        self.queries = 0
+        self.seconds = 0.0
+
+
+class QueryTracer:
+    def __init__(self, slow_ms=SLOW_QUERY_MS, repeat_limit=QUERY_REPEAT_LIMIT, strict=QUERY_REPEAT_STRICT):
+        self.slow_seconds = slow_ms / 1000.0
+        self.repeat_limit = repeat_limit
+        self.strict = strict
+        self._current = contextvars.ContextVar('query_unit', default=None)
+        self._lock = threading.Lock()
+        # fingerprint -> [count, total_seconds, max_seconds]
+        self.totals = {}
+
+    def install(self, handler):
+        if self.on_query not in handler.query_listeners:
+            handler.add_query_listener(self.on_query)
+        return self
+
+    def begin(self, name):
+        return self._current.set(UnitOfWork(name))
+
+    def end(self, token):
+        unit = self._current.get()
+        self._current.reset(token)
+        if unit is not None and not self.strict:
+            for fp, count in unit.counts.items():
+                if self.repeat_limit and count > self.repeat_limit:
+                    print(f"[query-trace] possible N+1 in {unit.name}: {count}x {fp}")
+        return unit
+
+    @contextmanager
+    def unit(self, name):
+        token = self.begin(name)
+        try:
+            yield self._current.get()
+        finally:
+            self.end(token)
+
+    def trace_callback(self, callback):
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            with self.unit(f"bot:{callback.__name__}"):
+                return await callback(update, context)
+        return wrapper
+
+    def on_query(self, query, params, seconds):
+        fp = fingerprint(query)
+        with self._lock:
+            entry = self.totals.get(fp)
+            if entry is None:
+                entry = self.totals[fp] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+        unit = self._current.get()
+        if seconds >= self.slow_seconds:
+            where = unit.name if unit else '-'
+            print(f"[slow-query] {seconds * 1000:.1f}ms in {where}: {fp} [{redact(params)}]")
+
+        if unit is not None:
+            unit.queries += 1
+            unit.seconds += seconds
+            unit.counts[fp] += 1
+            if self.strict and self.repeat_limit and unit.counts[fp] > self.repeat_limit:
+                raise RepeatedQueryError(
+                    f"{unit.name}: query ran {unit.counts[fp]} times (limit {self.repeat_limit}): {fp}")
+
+    def current(self):
+        return self._current.get()
+
+    def report(self, limit=20):
+        with self._lock:
+            items = sorted(self.totals.items(), key=lambda item: item[1][1], reverse=True)
+        return [{'fingerprint': fp, 'count': c, 'total_ms': round(t * 1000, 2), 'max_ms': round(m * 1000, 2)}
+                for fp, (c, t, m) in items[:limit]]
+
+
+query_tracer = QueryTracer()
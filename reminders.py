@@ -0,0 +1,156 @@
+import asyncio
+import os
+from datetime import date, timedelta
+
+import outbound
+import translations
+from database import db_handler
+
+REMINDERS_ENABLED = os.environ.get('REMINDERS_ENABLED', '1') == '1'
+REMINDER_INTERVAL = float(os.environ.get('REMINDER_INTERVAL', '300'))
+# "Скоро дедлайн" - за сколько дней до срока
+REMINDER_LEAD_DAYS = int(os.environ.get('REMINDER_LEAD_DAYS', '1'))
+REMINDER_BATCH_SIZE = int(os.environ.get('REMINDER_BATCH_SIZE', '200'))
+REMINDER_MAX_PER_RUN = int(os.environ.get('REMINDER_MAX_PER_RUN', '5000'))
+# После долгого простоя не рассылаем напоминания о давно прошедших сроках
+REMINDER_LOOKBACK_DAYS = int(os.environ.get('REMINDER_LOOKBACK_DAYS', '1'))
+# Пауза между сообщениями, если бот работает без очереди outbound (OUTBOUND_QUEUE=0)
+REMINDER_SEND_DELAY_MS = float(os.environ.get('REMINDER_SEND_DELAY_MS', '35'))
+
+KINDS = {'due_soon': 'bot_reminder_due_soon', 'overdue': 'bot_reminder_overdue'}
+
+reminder_stats = {'sent': 0, 'failed': 0, 'runs': 0}
+
+
+def scan_window(kind, today):
+    """(первый, последний) дедлайн включительно, о котором напоминает этот вид."""
+    if kind == 'due_soon':
+        return today, today + timedelta(days=REMINDER_LEAD_DAYS)
+    return today - timedelta(days=REMINDER_LOOKBACK_DAYS), today - timedelta(days=1)
+
+
+def _remember_chat(db, user_id, chat_id, lang):
+    db_handler.execute(db, '''
+        INSERT INTO bot_chats (user_id, chat_id, lang) VALUES (%s, %s, %s)
+        ON CONFLICT (user_id) DO UPDATE SET chat_id = excluded.chat_id, lang = excluded.lang
+    ''', (user_id, chat_id, lang)).close()
+
+
+def remember_chat(user_id, chat_id, lang):
+    db_handler.write(_remember_chat, user_id, chat_id, lang, for_user=user_id, move_wait=0)
+
+
+def _forget_chat(db, user_id):
+    db_handler.execute(db, 'DELETE FROM bot_chats WHERE user_id = %s', (user_id,)).close()
+
+
+def forget_chat(user_id):
+    db_handler.write(_forget_chat, user_id, for_user=user_id, move_wait=0)
+
+
+def _due_batch(handler, kind, today, after, batch_size):
+    first, last = scan_window(kind, today)
+    after = after or (first.isoformat(), 0)
+    conn = handler.get_connection()
+    try:
+        # Весь срок окна сканируется заново каждый запуск: задача, созданная или перенесённая
+        # на срок внутри окна, попадает в выборку, пока для её дедлайна нет записи об отправке.
+        # Внутри запуска пачки идут по (deadline, id), чтобы неотправленные не выбирались повторно
+        cursor = handler.execute(conn, '''
+            SELECT t.id, t.user_id, t.title, t.deadline, c.chat_id, c.lang
+            FROM tasks t JOIN bot_chats c ON c.user_id = t.user_id
+            WHERE t.deadline IS NOT NULL AND t.parent_id IS NULL AND t.status != 'done'
+                  AND (t.deadline > %s OR (t.deadline = %s AND t.id > %s)) AND t.deadline <= %s
+                  AND NOT EXISTS (
+                      SELECT 1 FROM reminders_sent s
+                      WHERE s.task_id = t.id AND s.kind = %s AND s.deadline = t.deadline
+                  )
+            ORDER BY t.deadline ASC, t.id ASC
+            LIMIT %s
+        ''', (after[0], after[0], after[1], last.isoformat(), kind, batch_size))
+        rows = [dict(row, deadline=str(row['deadline'])[:10]) for row in handler.fetchall(cursor)]
+        cursor.close()
+        return rows
+    finally:
+        handler.close(conn)
+
+
+def due_batch(kind, today=None, after=None, batch_size=REMINDER_BATCH_SIZE, handler=db_handler):
+    """Следующая пачка задач без отправленного напоминания; after - (deadline, id) последней строки прошлой пачки."""
+    return _due_batch(handler, kind, today or date.today(), after, batch_size)
+
+
+def _mark_sent(db, handler, kind, rows):
+    for row in rows:
+        handler.execute(db, '''
+            INSERT INTO reminders_sent (task_id, kind, deadline, user_id) VALUES (%s, %s, %s, %s)
+            ON CONFLICT (task_id, kind) DO UPDATE SET deadline = excluded.deadline
+        ''', (row['id'], kind, row['deadline'], row['user_id'])).close()
+
+
+def mark_sent(kind, rows, handler=db_handler):
+    """Записывает доставку после отправки: неотправленное напоминание уйдёт в следующий запуск."""
+    handler.write(_mark_sent, handler, kind, rows)
+
+
+def _prune_sent(db, handler, before):
+    handler.execute(db, 'DELETE FROM reminders_sent WHERE deadline < %s', (before.isoformat(),)).close()
+
+
+def prune_sent(today=None, handler=db_handler):
+    # Записи о сроках, вышедших из обоих окон, больше ни на что не влияют
+    first = min(scan_window(kind, today or date.today())[0] for kind in KINDS)
+    handler.write(_prune_sent, handler, first)
+
+
+async def send_reminders(bot, today=None):
+    from telegram.error import Forbidden, TelegramError
+
+    today = today or date.today()
+    # С диспетчером рассылка идёт в полосе bulk и темп задаёт он
+    send_args = outbound.bulk(bot)
+    delay = 0 if send_args else REMINDER_SEND_DELAY_MS / 1000.0
+    sent = failed = 0
+    # У каждого шарда свои задачи, чаты и записи об отправке
+    for handler in db_handler.user_databases():
+        await asyncio.to_thread(prune_sent, today, handler)
+        for kind, text_key in KINDS.items():
+            claimed, after = 0, None
+            while claimed < REMINDER_MAX_PER_RUN:
+                rows = await asyncio.to_thread(due_batch, kind, today, after, REMINDER_BATCH_SIZE, handler)
+                if not rows:
+                    break
+                claimed += len(rows)
+                after = (rows[-1]['deadline'], rows[-1]['id'])
+                delivered = []
+                for row in rows:
+                    text = translations.t(row['lang'] or 'en', text_key).format(row['title'], row['deadline'])
+                    try:
+                        await bot.send_message(row['chat_id'], text, **send_args)
+                        sent += 1
+                        delivered.append(row)
+                    except Forbidden as e:
+                        # Пользователь заблокировал бота - повтор не поможет, напоминание пропускаем
+                        failed += 1
+                        delivered.append(row)
+                        print(f"Reminder for task {row['id']} dropped: {e}")
+                    except TelegramError as e:
+                        # Сеть, лимиты и т.п. - записи об отправке нет, следующий запуск повторит
+                        failed += 1
+                        print(f"Reminder for task {row['id']} failed, will retry: {e}")
+                    if delay:
+                        await asyncio.sleep(delay)
+                if delivered:
+                    await asyncio.to_thread(mark_sent, kind, delivered, handler)
+                if len(rows) < REMINDER_BATCH_SIZE:
+                    break
+    reminder_stats['sent'] += sent
+    reminder_stats['failed'] += failed
+    reminder_stats['runs'] += 1
+    return sent, failed
+
+
+async def reminder_job(context):
+    sent, failed = await send_reminders(context.bot)
+    if sent or failed:
+        print(f"Deadline reminders: {sent} sent, {failed} failed")
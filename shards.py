@@ -0,0 +1,186 @@
+import argparse
+import time
+
+from database import SHARD_MAP_TTL, TASK_COLUMNS, db_handler, safe_url
+
+# Данные пользователя на шарде: (таблица, колонки, колонка с user_id, порядок вставки)
+USER_TABLES = (
+    ('users', ('id', 'username', 'password_hash'), 'id', 'id'),
+    # Родительские задачи раньше подзадач - из-за внешнего ключа parent_id
+    ('tasks', TASK_COLUMNS, 'user_id', 'parent_id IS NOT NULL, id'),
+    ('tasks_archive', TASK_COLUMNS + ('archived_at',), 'user_id', 'id'),
+    ('bot_chats', ('user_id', 'chat_id', 'lang'), 'user_id', 'user_id'),
+    ('reminders_sent', ('task_id', 'kind', 'deadline', 'user_id'), 'user_id', 'task_id, kind'),
+    ('session_revocations', ('user_id', 'revoked_at'), 'user_id', 'user_id'),
+    ('task_versions', ('user_id', 'version'), 'user_id', 'user_id'),
+)
+
+
+def _delete_user_rows(conn, handler, user_id):
+    for table, _, key, _ in reversed(USER_TABLES):
+        if table == 'tasks':
+            handler.execute(conn, 'DELETE FROM tasks WHERE user_id = %s AND parent_id IS NOT NULL', (user_id,)).close()
+        handler.execute(conn, f'DELETE FROM {table} WHERE {key} = %s', (user_id,)).close()
+
+
+def _read_user_rows(handler, user_id):
+    conn = handler.get_connection()
+    try:
+        rows = {}
+        for table, columns, key, order in USER_TABLES:
+            cursor = handler.execute(conn, f'SELECT {", ".join(columns)} FROM {table} WHERE {key} = %s ORDER BY {order}',
+                                     (user_id,))
+            rows[table] = [tuple(row[column] for column in columns) for row in handler.fetchall(cursor)]
+            cursor.close()
+        return rows
+    finally:
+        handler.close(conn)
+
+
+def _write_user_rows(conn, handler, user_id, rows):
+    # Остатки прошлой неудачной попытки удаляются, поэтому перенос можно повторять
+    _delete_user_rows(conn, handler, user_id)
+    for table, columns, _, _ in USER_TABLES:
+        marks = ', '.join(['%s'] * len(columns))
+        for values in rows[table]:
+            handler.execute(conn, f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({marks})', values).close()
+
+
+def _count_user_rows(handler, user_id):
+    return {table: len(values) for table, values in _read_user_rows(handler, user_id).items()}
+
+
+def _set_directory(conn, handler, user_id, shard, moving):
+    handler.execute(conn, 'UPDATE user_directory SET shard = %s, moving = %s WHERE user_id = %s',
+                    (shard, moving, user_id)).close()
+
+
+def move_user(user_id, target, handler=db_handler, settle=None):
+    """Переносит пользователя на шард target без остановки сервиса; возвращает число строк по таблицам.
+
+    1. В справочнике ставится moving: записи пользователя ждут, чтения идут в старую копию.
+    2. Пауза settle, чтобы процессы забыли закэшированный шард.
+    3. Данные копируются на новый шард одной транзакцией и сверяются по числу строк.
+    4. Справочник переключается на новый шард, moving снимается.
+    5. Ещё одна пауза - дочитываются запросы по старой карте - и старая копия удаляется.
+    """
+    if not handler.shards:
+        raise SystemExit("sharding is off: set DATABASE_SHARD_URLS")
+    if not 0 <= target < len(handler.shards):
+        raise SystemExit(f"no shard {target}: there are {len(handler.shards)}")
+    source = handler.shard_index(user_id)
+    if source == target:
+        return {}
+    settle = SHARD_MAP_TTL + 1 if settle is None else settle
+    source_db, target_db = handler.shards[source], handler.shards[target]
+
+    handler.write(_set_directory, handler, user_id, source, 1)
+    handler.shard_map.pop(user_id)
+    try:
+        time.sleep(settle)
+        rows = _read_user_rows(source_db, user_id)
+        target_db.write(_write_user_rows, target_db, user_id, rows)
+        copied = _count_user_rows(target_db, user_id)
+        expected = {table: len(values) for table, values in rows.items()}
+        if copied != expected:
+            raise RuntimeError(f"copy of user {user_id} is incomplete: {copied} != {expected}")
+        handler.write(_set_directory, handler, user_id, target, 0)
+    except BaseException:
+        handler.write(_set_directory, handler, user_id, source, 0)
+        raise
+    handler.shard_map.pop(user_id)
+
+    time.sleep(settle)
+    source_db.write(_delete_user_rows, source_db, user_id)
+    return copied
+
+
+def _backfill_shard(conn, handler, index, users):
+    added = 0
+    for user_id, username in users:
+        cursor = handler.execute(conn, '''
+            INSERT INTO user_directory (user_id, username, shard) VALUES (%s, %s, %s)
+            ON CONFLICT DO NOTHING
+        ''', (user_id, username, index))
+        added += cursor.rowcount
+        cursor.close()
+    if handler.use_postgresql:
+        # Явные id не двигают последовательность - новые пользователи получат id после перенесённых
+        handler.execute(conn, '''
+            SELECT setval(pg_get_serial_sequence('user_directory', 'user_id'),
+                          GREATEST((SELECT MAX(user_id) FROM user_directory), 1))
+        ''').close()
+    return added
+
+
+def backfill(handler=db_handler):
+    """Вносит в справочник пользователей, которые уже лежат на шардах (например, бывшая единая база)."""
+    added = 0
+    for index, shard in enumerate(handler.shards):
+        conn = shard.get_connection()
+        cursor = shard.execute(conn, 'SELECT id, username FROM users ORDER BY id')
+        users = [(row['id'], row['username']) for row in shard.fetchall(cursor)]
+        cursor.close()
+        shard.close(conn)
+        added += handler.write(_backfill_shard, handler, index, users)
+    return added
+
+
+def find_user_id(username, handler=db_handler):
+    conn = handler.get_connection()
+    cursor = handler.execute(conn, 'SELECT user_id FROM user_directory WHERE username = %s', (username,))
+    row = handler.fetchone(cursor)
+    cursor.close()
+    handler.close(conn)
+    return row['user_id'] if row else None
+
+
+def status(handler=db_handler):
+    conn = handler.get_connection()
+    cursor = handler.execute(conn, '''
+        SELECT shard, COUNT(*) AS users, SUM(moving) AS moving FROM user_directory GROUP BY shard ORDER BY shard
+    ''')
+    counts = {row['shard']: (row['users'], row['moving'] or 0) for row in handler.fetchall(cursor)}
+    cursor.close()
+    handler.close(conn)
+    return [(index, safe_url(shard.database_url)) + counts.get(index, (0, 0))
+            for index, shard in enumerate(handler.shards)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Справочник шардов пользователей и перенос между шардами')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('status', help='пользователи по шардам')
+    commands.add_parser('backfill', help='внести в справочник пользователей, уже лежащих на шардах')
+    move = commands.add_parser('move', help='перенести пользователя на другой шард')
+    move.add_argument('--user-id', type=int)
+    move.add_argument('--username')
+    move.add_argument('--to', type=int, required=True, help='номер шарда в DATABASE_SHARD_URLS, с 0')
+    move.add_argument('--settle', type=float, help='пауза до и после переключения, секунды (по умолчанию SHARD_MAP_TTL + 1)')
+    args = parser.parse_args()
+
+    if not db_handler.shards:
+        raise SystemExit("sharding is off: set DATABASE_SHARD_URLS")
+    conn = db_handler.get_connection()
+    db_handler.init_db(conn)
+    db_handler.close(conn)
+
+    if args.command == 'status':
+        for index, url, users, moving in status():
+            print(f"shard {index}: {users} users{f', {moving} moving' if moving else ''}  {url}")
+    elif args.command == 'backfill':
+        print(f"✓ Added {backfill()} users to the shard directory")
+    else:
+        user_id = args.user_id
+        if user_id is None:
+            user_id = find_user_id(args.username)
+            if user_id is None:
+                raise SystemExit(f"unknown user: {args.username}")
+        started = time.perf_counter()
+        copied = move_user(user_id, args.to, settle=args.settle)
+        print(f"✓ User {user_id} is on shard {args.to} ({copied or 'already there'}) "
+              f"in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+import json
+import multiprocessing
+import os
+import signal
+import time
+from multiprocessing.connection import wait
+
+SUPERVISOR_BACKOFF_BASE = float(os.environ.get('SUPERVISOR_BACKOFF_BASE', '1'))
+SUPERVISOR_BACKOFF_MAX = float(os.environ.get('SUPERVISOR_BACKOFF_MAX', '60'))
+# Процесс, проработавший дольше этого, считается стабильным - счётчик неудач сбрасывается
+SUPERVISOR_STABLE_AFTER = float(os.environ.get('SUPERVISOR_STABLE_AFTER', '60'))
+SUPERVISOR_READY_TIMEOUT = float(os.environ.get('SUPERVISOR_READY_TIMEOUT', '60'))
+SUPERVISOR_DRAIN_TIMEOUT = float(os.environ.get('SUPERVISOR_DRAIN_TIMEOUT', '30'))
+# 0 - перезапускать без ограничений
+SUPERVISOR_MAX_FAILURES = int(os.environ.get('SUPERVISOR_MAX_FAILURES', '0'))
+SUPERVISOR_STATUS_INTERVAL = float(os.environ.get('SUPERVISOR_STATUS_INTERVAL', '300'))
+SUPERVISOR_STATUS_FILE = os.environ.get('SUPERVISOR_STATUS_FILE')
+
+
+class Child:
+    def __init__(self, name, target, kwargs=None):
+        self.name = name
+        self.target = target
+        self.kwargs = kwargs or {}
+        self.process = None
+        self.ready = None
+        self.state = 'stopped'
+        self.pid = None
+        self.started_at = None
+        self.ready_at = None
+        # Когда ушёл SIGTERM зависшему при старте процессу; после drain_timeout - SIGKILL
+        self.terminated_at = None
+        self.restarts = 0
+        self.failures = 0
+        self.last_exitcode = None
+        self.next_start = 0.0
+
+    def status(self, now):
+        return {
+            'name': self.name,
+            'state': self.state,
+            'pid': self.pid,
+            'uptime': round(now - self.started_at, 1) if self.started_at and self.state in ('starting', 'ready') else 0,
+            'restarts': self.restarts,
+            'failures': self.failures,
+            'last_exitcode': self.last_exitcode,
+            'ready_after': round(self.ready_at - self.started_at, 2) if self.ready_at else None,
+        }
+
+
+class Supervisor:
+    def __init__(self, children, backoff_base=SUPERVISOR_BACKOFF_BASE, backoff_max=SUPERVISOR_BACKOFF_MAX,
+                 stable_after=SUPERVISOR_STABLE_AFTER, ready_timeout=SUPERVISOR_READY_TIMEOUT,
+                 drain_timeout=SUPERVISOR_DRAIN_TIMEOUT, max_failures=SUPERVISOR_MAX_FAILURES,
+                 status_interval=SUPERVISOR_STATUS_INTERVAL, status_file=SUPERVISOR_STATUS_FILE):
+        self.children = children
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.stable_after = stable_after
+        self.ready_timeout = ready_timeout
+        self.drain_timeout = drain_timeout
+        self.max_failures = max_failures
+        self.status_interval = status_interval
+        self.status_file = status_file
+        self.stopping = False
+        self.exit_code = 0
+        self._report_requested = False
+
+    def _log(self, message):
+        print(f"[supervisor] {message}", flush=True)
+
+    def start_child(self, child):
+        child.ready = multiprocessing.Event()
+        kwargs = dict(child.kwargs, ready=child.ready)
+        child.process = multiprocessing.Process(target=child.target, kwargs=kwargs, name=child.name)
+        child.process.start()
+        child.pid = child.process.pid
+        child.started_at = time.monotonic()
+        child.ready_at = None
+        child.terminated_at = None
+        child.state = 'starting'
+        self._log(f"{child.name} started (pid {child.pid})")
+
+    def _backoff(self, child):
+        return min(self.backoff_max, self.backoff_base * (2 ** (child.failures - 1)))
+
+    def _handle_exit(self, child, now):
+        exitcode = child.process.exitcode
+        child.process = None
+        child.last_exitcode = exitcode
+        if self.stopping:
+            child.state = 'stopped'
+            return
+
+        if now - child.started_at >= self.stable_after:
+            child.failures = 0
+        child.failures += 1
+        delay = self._backoff(child)
+        child.next_start = now + delay
+        child.state = 'backoff'
+        self._log(f"{child.name} exited with code {exitcode}, restarting in {delay:.1f}s "
+                  f"(failure {child.failures})")
+
+        if self.max_failures and child.failures > self.max_failures:
+            self._log(f"{child.name} failed {child.failures} times in a row, giving up")
+            self.exit_code = 1
+            self.stopping = True
+
+    def _check(self, now):
+        for child in self.children:
+            if child.process is not None and not child.process.is_alive():
+                child.process.join()
+                self._handle_exit(child, now)
+                continue
+
+            if child.state == 'starting':
+                if child.ready.is_set():
+                    child.state = 'ready'
+                    child.ready_at = now
+                    self._log(f"{child.name} is ready ({now - child.started_at:.2f}s)")
+                elif now - child.started_at > self.ready_timeout:
+                    self._log(f"{child.name} not ready after {self.ready_timeout:.0f}s, restarting")
+                    child.process.terminate()
+                    child.terminated_at = now
+                    child.state = 'restarting'
+
+            elif child.state == 'restarting' and now - child.terminated_at > self.drain_timeout:
+                # Как при остановке: SIGTERM не помог за drain_timeout - убиваем
+                self._log(f"{child.name} did not stop in {self.drain_timeout:.0f}s, killing")
+                child.process.kill()
+                child.state = 'killing'
+
+            elif child.state == 'backoff' and now >= child.next_start and not self.stopping:
+                child.restarts += 1
+                self.start_child(child)
+
+    def status(self):
+        now = time.monotonic()
+        return [child.status(now) for child in self.children]
+
+    def report(self):
+        statuses = self.status()
+        for item in statuses:
+            self._log(f"{item['name']}: {item['state']} pid={item['pid']} uptime={item['uptime']}s "
+                      f"restarts={item['restarts']} last_exit={item['last_exitcode']}")
+        if self.status_file:
+            with open(self.status_file, 'w', encoding='utf-8') as f:
+                json.dump({'time': time.time(), 'children': statuses}, f, indent=2)
+
+    def _on_stop_signal(self, signum, frame):
+        if not self.stopping:
+            self._log(f"received {signal.Signals(signum).name}, shutting down")
+        self.stopping = True
+
+    def _on_report_signal(self, signum, frame):
+        self._report_requested = True
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self._on_stop_signal)
+        signal.signal(signal.SIGINT, self._on_stop_signal)
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self._on_report_signal)
+
+    def shutdown(self):
+        running = [child for child in self.children if child.process is not None]
+        for child in running:
+            child.state = 'stopping'
+            child.process.terminate()
+
+        # Общий срок на корректное завершение всех дочерних процессов
+        deadline = time.monotonic() + self.drain_timeout
+        for child in running:
+            child.process.join(max(0.0, deadline - time.monotonic()))
+            if child.process.is_alive():
+                self._log(f"{child.name} did not stop in {self.drain_timeout:.0f}s, killing")
+                child.process.kill()
+                child.process.join()
+            child.last_exitcode = child.process.exitcode
+            child.process = None
+            child.state = 'stopped'
+        for child in self.children:
+            child.state = 'stopped'
+
+    def run(self):
+        self.install_signal_handlers()
+        for child in self.children:
+            self.start_child(child)
+
+        next_report = time.monotonic() + self.status_interval
+        while not self.stopping:
+            sentinels = [child.process.sentinel for child in self.children if child.process is not None]
+            wait(sentinels, timeout=0.5)
+            now = time.monotonic()
+            self._check(now)
+            if self._report_requested or (self.status_interval and now >= next_report):
+                self._report_requested = False
+                next_report = now + self.status_interval
+                self.report()
+
+        self.shutdown()
+        self.report()
+        return self.exit_code
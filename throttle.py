@@ -0,0 +1,84 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def _rate(name, default):
+    # Лимиты задаются в попытках в минуту; 0 отключает проверку
+    return float(os.environ.get(name, default)) / 60.0
+
+
+def _burst(name, default):
+    return float(os.environ.get(name, default))
+
+
+class TokenBucketLimiter:
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key, cost=1.0):
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                tokens = self.burst
+            else:
+                tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                self._buckets.move_to_end(key)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class AuthThrottle:
+    def __init__(self, name, user_rate, user_burst, source_rate, source_burst):
+        self.name = name
+        self.by_user = TokenBucketLimiter(user_rate, user_burst)
+        self.by_source = TokenBucketLimiter(source_rate, source_burst)
+        self._lock = threading.Lock()
+        self.counters = {'allowed': 0, 'rejected_user': 0, 'rejected_source': 0}
+
+    def _count(self, key):
+        with self._lock:
+            self.counters[key] += 1
+
+    def allow(self, username, source):
+        # Дешёвая проверка до обращения к БД и хеширования пароля
+        if source is not None and not self.by_source.allow(str(source)):
+            self._count('rejected_source')
+            return False
+        if username and not self.by_user.allow(username.strip().lower()):
+            self._count('rejected_user')
+            return False
+        self._count('allowed')
+        return True
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+login_throttle = AuthThrottle(
+    'login',
+    _rate('LOGIN_USER_RATE', '10'), _burst('LOGIN_USER_BURST', '5'),
+    _rate('LOGIN_SOURCE_RATE', '30'), _burst('LOGIN_SOURCE_BURST', '10'),
+)
+register_throttle = AuthThrottle(
+    'register',
+    _rate('REGISTER_USER_RATE', '5'), _burst('REGISTER_USER_BURST', '3'),
+    _rate('REGISTER_SOURCE_RATE', '10'), _burst('REGISTER_SOURCE_BURST', '5'),
+)
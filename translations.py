@@ -0,0 +1,152 @@
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+from markupsafe import Markup
+
+TRANSLATION_PATH = os.environ.get(
+    'TRANSLATION_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'translation.json')
+)
+RELOAD_INTERVAL = float(os.environ.get('TRANSLATION_RELOAD_INTERVAL', '0'))
+
+# Ключи, которые index.html использует из JavaScript (имя в JS -> ключ перевода)
+I18N_JS_KEYS = {
+    'notStarted': 'not_started_label',
+    'inProgress': 'in_progress_label',
+    'completed': 'completed_label',
+    'priorityLow': 'priority_low',
+    'priorityMedium': 'priority_medium',
+    'priorityHigh': 'priority_high',
+    'tasksCount': 'tasks_count',
+    'noTasksYet': 'no_tasks_yet',
+    'createFirstTask': 'create_first_task',
+    'deleteConfirm': 'delete_task_confirm',
+    'noData': 'no_data',
+    'completedTasks': 'bot_completed_tasks',
+    'subtaskN': 'subtask_n',
+}
+
+_EMPTY = MappingProxyType({})
+
+# Всё, что отдаёт каталог, собирается целиком и подменяется одним присваиванием
+_Snapshot = namedtuple('_Snapshot', ('tables', 'lookups', 'bundles'))
+
+
+def _identity(key):
+    return key
+
+
+def _make_lookup(table):
+    get = table.get
+    return lambda key: get(key, key)
+
+
+def _make_js_bundle(table):
+    bundle = {name: table.get(key, key) for name, key in I18N_JS_KEYS.items()}
+    text = json.dumps(bundle, ensure_ascii=False)
+    # Экранируем символы, которые могут закрыть <script> или сломать HTML
+    text = text.replace('<', '\\u003c').replace('>', '\\u003e').replace('&', '\\u0026')
+    return Markup(text)
+
+
+class TranslationCatalog:
+    def __init__(self, path=TRANSLATION_PATH, reload_interval=RELOAD_INTERVAL):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._mtime = None
+        self._next_check = 0.0
+
+    def _read(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            raw = json.load(f)
+        return raw, os.path.getmtime(self.path)
+
+    def _build(self, raw, mtime):
+        tables = {lang: MappingProxyType(dict(values)) for lang, values in raw.items()}
+        lookups = {lang: _make_lookup(table) for lang, table in tables.items()}
+        bundles = {lang: _make_js_bundle(table) for lang, table in tables.items()}
+        # Читатели берут снимок один раз и не видят смесь старых и новых переводов
+        self._snapshot = _Snapshot(MappingProxyType(tables), MappingProxyType(lookups), MappingProxyType(bundles))
+        self._mtime = mtime
+
+    def _current(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            self.load()
+            snapshot = self._snapshot
+        return snapshot
+
+    def load(self):
+        with self._lock:
+            if self._snapshot is None:
+                try:
+                    raw, mtime = self._read()
+                except FileNotFoundError:
+                    raw, mtime = {}, None
+                self._build(raw, mtime)
+        return self
+
+    def reload(self):
+        try:
+            raw, mtime = self._read()
+        except (OSError, ValueError) as e:
+            # Файл могли сохранить наполовину или на время удалить - остаёмся на текущих переводах
+            print(f"⚠ Translations not reloaded from {self.path}: {e}")
+            return self
+        with self._lock:
+            self._build(raw, mtime)
+        return self
+
+    def maybe_reload(self):
+        if not self.reload_interval:
+            return False
+        now = time.monotonic()
+        if now < self._next_check:
+            return False
+        self._next_check = now + self.reload_interval
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return False
+        if mtime != self._mtime:
+            # Неудачная попытка не повторяется, пока файл не изменится снова
+            self._mtime = mtime
+            self.reload()
+            return True
+        return False
+
+    def languages(self):
+        return tuple(self._current().tables)
+
+    def table(self, lang):
+        return self._current().tables.get(lang, _EMPTY)
+
+    def translator(self, lang):
+        return self._current().lookups.get(lang, _identity)
+
+    def t(self, lang, key):
+        table = self._current().tables.get(lang)
+        if table is None:
+            return key
+        return table.get(key, key)
+
+    def js_bundle(self, lang):
+        bundle = self._current().bundles.get(lang)
+        if bundle is None:
+            bundle = _make_js_bundle(_EMPTY)
+        return bundle
+
+catalog = TranslationCatalog()
+
+t = catalog.t
+translator = catalog.translator
+get_table = catalog.table
+js_bundle = catalog.js_bundle
+reload_translations = catalog.reload
+maybe_reload = catalog.maybe_reload